@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import bz2
+import sys
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+__all__ = ('Codec', 'CodecGet', 'CodecRegister',)
+#------------------------------------------------------------------------------#
+# Codec                                                                        #
+#------------------------------------------------------------------------------#
+class Codec (object):
+    """Compression codec
+
+    Codec is identified by its name ``codec`` or ``codec:level``, which is
+    recorded in headers of the compressed data owners (mappings, streams).
+    Codec with dictionary needs it to be trained (see Train) before use, and
+    dictionary must be stored by the owner next to the codec name.
+    """
+    level_default = None
+    dictionary = False # codec uses dictionary
+
+    def __init__ (self, codec, level = None, zdict = None):
+        self.level = self.level_default if level is None else level
+        self.zdict = zdict
+        self.name = codec if level is None else '{}:{}'.format (codec, level)
+
+    def Compress (self, data):
+        """Compress data
+        """
+        compressor = self.Compressor ()
+        return compressor.compress (data) + compressor.flush ()
+
+    def Decompress (self, data):
+        """Decompress data
+        """
+        raise NotImplementedError ()
+
+    def Compressor (self):
+        """Create incremental compressor (object with compress and flush methods)
+        """
+        raise NotImplementedError ()
+
+    def Train (self, samples):
+        """Train dictionary from samples of data
+
+        Returns trained dictionary.
+        """
+        raise ValueError ('Codec {} does not use dictionary'.format (self.name))
+
+    def __str__ (self):
+        """String representation
+        """
+        return '<Codec [{}]>'.format (self.name)
+
+    def __repr__ (self):
+        """String representation
+        """
+        return str (self)
+
+#------------------------------------------------------------------------------#
+# Codecs                                                                       #
+#------------------------------------------------------------------------------#
+class ZlibCodec (Codec):
+    """Zlib codec
+    """
+    level_default = 6
+
+    def Decompress (self, data):
+        return zlib.decompress (data)
+
+    def Compressor (self):
+        return zlib.compressobj (self.level)
+
+class ZlibDictCodec (Codec):
+    """Zlib codec with preset dictionary
+
+    Dictionary is built from samples, so even small data (B+Tree leaves)
+    compresses well with a low compression level. Preset dictionary is only
+    supported by zlib module of python 3.3 or later.
+    """
+    level_default = 6
+    dictionary = True
+    dictionary_size = 1 << 15 # zlib uses only last 32KB of the dictionary
+
+    def __init__ (self, codec, level = None, zdict = None):
+        if sys.version_info < (3, 3):
+            raise ValueError ('Codec {} is not available: zlib dictionary requires python 3.3 or later'
+                              .format (codec))
+        Codec.__init__ (self, codec, level, zdict)
+
+    def Decompress (self, data):
+        decompressor = zlib.decompressobj (zdict = self.zdict)
+        return decompressor.decompress (data) + decompressor.flush ()
+
+    def Compressor (self):
+        if self.zdict is None:
+            raise ValueError ('Codec {} has not been trained'.format (self.name))
+        return zlib.compressobj (self.level, zlib.DEFLATED, zlib.MAX_WBITS, 8, zlib.Z_DEFAULT_STRATEGY, self.zdict)
+
+    def Train (self, samples):
+        # zlib uses the last dictionary bytes, so samples are simply
+        # concatenated (the last samples are the most relevant)
+        self.zdict = b''.join (samples) [-self.dictionary_size:]
+        return self.zdict
+
+class LzmaCodec (Codec):
+    """LZMA codec (preset is used as level)
+    """
+    level_default = 6
+
+    def __init__ (self, codec, level = None, zdict = None):
+        if lzma is None:
+            raise ValueError ('Codec {} is not available'.format (codec))
+        Codec.__init__ (self, codec, level, zdict)
+
+    def Decompress (self, data):
+        return lzma.decompress (data)
+
+    def Compressor (self):
+        return lzma.LZMACompressor (preset = self.level)
+
+class Bz2Codec (Codec):
+    """BZip2 codec
+    """
+    level_default = 9
+
+    def Decompress (self, data):
+        return bz2.decompress (data)
+
+    def Compressor (self):
+        return bz2.BZ2Compressor (self.level)
+
+#------------------------------------------------------------------------------#
+# Registry                                                                     #
+#------------------------------------------------------------------------------#
+codecs = {
+    'zlib'      : ZlibCodec,
+    'zlib+dict' : ZlibDictCodec,
+    'lzma'      : LzmaCodec,
+    'bz2'       : Bz2Codec,
+}
+
+def CodecRegister (name, codec_type):
+    """Register codec type (Codec subclass) by name
+    """
+    codecs [name] = codec_type
+
+def CodecGet (compress, zdict = None):
+    """Get codec by its name
+
+    Legacy integer compression level means zlib codec with this level, zero
+    (or None) means no compression, in which case None is returned.
+    """
+    if not compress:
+        return None
+    elif isinstance (compress, int):
+        return ZlibCodec ('zlib', compress)
+
+    name, _, level = compress.partition (':')
+    codec_type = codecs.get (name)
+    if codec_type is None:
+        raise ValueError ('Unknown codec: {}'.format (compress))
+    return codec_type (name, int (level) if level else None, zdict)
+
+# vim: nu ft=python columns=120 :
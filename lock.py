@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import threading
+
+try:
+    from threading import get_ident as thread_ident
+except ImportError:
+    from thread import get_ident as thread_ident
+
+__all__ = ('RWLock',)
+#------------------------------------------------------------------------------#
+# Reader/Writer Lock                                                           #
+#------------------------------------------------------------------------------#
+class RWLock (object):
+    """Reader/writer lock
+
+    Lock can be held either by any number of readers or by a single writer.
+    Waiting writer blocks new readers, so writers are never starved. Writer
+    lock is reentrant, and thread holding writer lock can also acquire reader
+    lock. Reader lock can not be upgraded to writer lock.
+    """
+    __slots__ = ('cond', 'readers', 'writer', 'writer_depth', 'writers_waiting',)
+
+    def __init__ (self):
+        self.cond = threading.Condition (threading.Lock ())
+        self.readers = 0
+        self.writer = None
+        self.writer_depth = 0
+        self.writers_waiting = 0
+
+    #--------------------------------------------------------------------------#
+    # Reader                                                                   #
+    #--------------------------------------------------------------------------#
+    def ReaderAcquire (self):
+        """Acquire reader lock
+        """
+        with self.cond:
+            if self.writer == thread_ident ():
+                self.writer_depth += 1
+                return
+            while self.writer is not None or self.writers_waiting:
+                self.cond.wait ()
+            self.readers += 1
+
+    def ReaderRelease (self):
+        """Release reader lock
+        """
+        with self.cond:
+            if self.writer == thread_ident ():
+                self.writer_depth -= 1
+                return
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all ()
+
+    def Reader (self):
+        """Reader lock context
+        """
+        return RWLockContext (self.ReaderAcquire, self.ReaderRelease)
+
+    #--------------------------------------------------------------------------#
+    # Writer                                                                   #
+    #--------------------------------------------------------------------------#
+    def WriterAcquire (self):
+        """Acquire writer lock
+        """
+        ident = thread_ident ()
+        with self.cond:
+            if self.writer == ident:
+                self.writer_depth += 1
+                return
+            self.writers_waiting += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.cond.wait ()
+            finally:
+                self.writers_waiting -= 1
+            self.writer = ident
+            self.writer_depth = 1
+
+    def WriterRelease (self):
+        """Release writer lock
+        """
+        with self.cond:
+            self.writer_depth -= 1
+            if not self.writer_depth:
+                self.writer = None
+                self.cond.notify_all ()
+
+    def Writer (self):
+        """Writer lock context
+        """
+        return RWLockContext (self.WriterAcquire, self.WriterRelease)
+
+#------------------------------------------------------------------------------#
+# Reader/Writer Lock Context                                                   #
+#------------------------------------------------------------------------------#
+class RWLockContext (object):
+    """Reader/writer lock context
+    """
+    __slots__ = ('acquire', 'release',)
+
+    def __init__ (self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__ (self):
+        self.acquire ()
+        return self
+
+    def __exit__ (self, et, eo, tb):
+        self.release ()
+        return False
+
+# vim: nu ft=python columns=120 :
@@ -22,6 +22,8 @@ class BPTree (MutableMapping):
             return 'Nothing'
     value_nothing = value_nothing ()
 
+    prefetch_leafs = 4 # number of sibling leafs loaded together by ItemRange
+
     def __init__ (self, provider):
         self.provider = provider
 
@@ -57,28 +59,73 @@ class BPTree (MutableMapping):
         if low_key is not None and high_key is not None and low_key >= high_key:
             return
 
-        # find first leaf
         desc_node = self.provider.DescToNode
+        descs_nodes = self.provider.DescsToNodes
+
+        # path of (node, child index) pairs to the current leaf, used to load
+        # leafs of the same parent together, up to prefetch_leafs at a time
+        path = []
+        prefetch_end = [0] # end index of prefetched children of the leaf parent
+
+        def leaf_prefetch ():
+            parent, index = path [-1]
+            index_end = min (len (parent.children), index + self.prefetch_leafs)
+            if high_key is not None:
+                index_end = min (index_end, bisect (parent.keys, high_key) + 1)
+            prefetch_end [0] = index_end
+            if index_end - index > 1:
+                descs_nodes (parent.children [index:index_end])
+
+        def leaf_next (leaf):
+            if path:
+                path [-1][1] += 1
+                if path [-1][1] < len (path [-1][0].children):
+                    if path [-1][1] >= prefetch_end [0]:
+                        leaf_prefetch ()
+                else:
+                    # find closest ancestor with unvisited children
+                    level = len (path) - 1
+                    while level > 0 and path [level][1] >= len (path [level][0].children):
+                        level -= 1
+                        path [level][1] += 1
+                    if path [level][1] >= len (path [level][0].children):
+                        del path [:]
+                    else:
+                        # descend to the parent of the next leaf
+                        for level in range (level + 1, len (path)):
+                            node, index = path [level - 1]
+                            path [level] = [desc_node (node.children [index]), 0]
+                        leaf_prefetch ()
+            return desc_node (leaf.next)
+
+        # find first leaf
         node = self.provider.Root ()
         if low_key is not None:
             for depth in range (self.provider.Depth () - 1):
-                node = desc_node (node.children [bisect (node.keys, low_key)])
+                index = bisect (node.keys, low_key)
+                path.append ([node, index])
+                node = desc_node (node.children [index])
+            if path:
+                leaf_prefetch ()
             index = bisect_left (node.keys, low_key)
             if index >= len (node.keys):
-                next = desc_node (node.next)
+                next = leaf_next (node)
                 if next is None:
                     return
                 node, index = next, 0
         else:
             for depth in range (self.provider.Depth () - 1):
+                path.append ([node, 0])
                 node = desc_node (node.children [0])
+            if path:
+                leaf_prefetch ()
             index = 0
 
         # iterate over whole leafs
         while not high_key or node.keys [-1] < high_key:
             for index in range (index, len (node.keys)):
                 yield node.keys [index], node.children [index]
-            node = desc_node (node.next)
+            node = leaf_next (node)
             if node is None:
                 return
             index = 0
@@ -90,7 +137,6 @@ class BPTree (MutableMapping):
                 return
             yield key, value
 
-
     def ItemSet (self, key, value):
         """Associate key with value
 
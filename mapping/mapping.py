@@ -8,9 +8,17 @@ __all__ = ('StoreMapping',)
 #------------------------------------------------------------------------------#
 class StoreMapping (BPTree):
     """B+Tree with store as back end
+
+    If concurrent is set, lookups hold provider's reader lock and updates hold
+    provider's writer lock, so any number of threads can do lookups in
+    parallel with each other (but not with updates and flushes).
     """
-    def __init__ (self, store, header, order = None, key_type = None, value_type = None, compress = None):
+    range_batch = 1 << 6 # items collected by single step of the locked range iterator
+
+    def __init__ (self, store, header, order = None, key_type = None, value_type = None, compress = None,
+                  concurrent = None):
         BPTree.__init__ (self, StoreBPTreeProvider (store, header, order, key_type, value_type, compress))
+        self.lock = self.provider.lock if concurrent else None
 
     #--------------------------------------------------------------------------#
     # Properties                                                               #
@@ -33,6 +41,56 @@ class StoreMapping (BPTree):
         """
         return self.provider.SizeOnStore ()
 
+    #--------------------------------------------------------------------------#
+    # Items                                                                    #
+    #--------------------------------------------------------------------------#
+    def ItemGet (self, key, value = BPTree.value_nothing):
+        if self.lock is None:
+            return BPTree.ItemGet (self, key, value)
+        with self.lock.Reader ():
+            return BPTree.ItemGet (self, key, value)
+
+    def ItemRange (self, low_key = None, high_key = None):
+        if self.lock is None:
+            return BPTree.ItemRange (self, low_key, high_key)
+        return self.item_range_locked (low_key, high_key)
+
+    def ItemSet (self, key, value):
+        if self.lock is None:
+            return BPTree.ItemSet (self, key, value)
+        with self.lock.Writer ():
+            return BPTree.ItemSet (self, key, value)
+
+    def ItemPop (self, key, value = BPTree.value_nothing):
+        if self.lock is None:
+            return BPTree.ItemPop (self, key, value)
+        with self.lock.Writer ():
+            return BPTree.ItemPop (self, key, value)
+
+    def item_range_locked (self, low_key, high_key):
+        """Range iterator which holds reader lock only while advancing
+
+        Each step collects at most range_batch items of a new range starting
+        from the last yielded key under reader lock, so steps remain valid if
+        the tree is changed between them. Lock is not held while items are
+        yielded, so abandoned iterator never blocks writers.
+        """
+        key, key_skip = low_key, False
+        while True:
+            with self.lock.Reader ():
+                batch = []
+                for item in BPTree.ItemRange (self, key, high_key):
+                    if key_skip and item [0] == key:
+                        continue # yielded by previous step
+                    batch.append (item)
+                    if len (batch) >= self.range_batch:
+                        break
+            for item in batch:
+                yield item
+            if len (batch) < self.range_batch:
+                return
+            key, key_skip = batch [-1][0], True
+
     #--------------------------------------------------------------------------#
     # Flush                                                                    #
     #--------------------------------------------------------------------------#
@@ -55,7 +113,7 @@ class StoreMapping (BPTree):
     def Dispose (self):
         """Flush dirty nodes to store
         """
-        self.Flush (prune = True)
+        self.provider.Dispose ()
 
     def __enter__ (self):
         return self
@@ -43,6 +43,13 @@ class BPTreeProvider (object):
         """
         raise NotImplementedError ()
 
+    def DescsToNodes (self, descs):
+        """Get nodes by their descriptors
+
+        Providers can load multiple nodes more efficiently then one by one.
+        """
+        return [self.DescToNode (desc) for desc in descs]
+
     def NodeCreate (self, keys, children, is_leaf):
         """Create new node
         """
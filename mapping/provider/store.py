@@ -2,12 +2,9 @@
 import io
 import sys
 import json
-import zlib
 import struct
 import codecs
 import binascii
-import operator
-import functools
 from bisect import bisect
 
 if sys.version_info [0] > 2:
@@ -18,7 +15,9 @@ else:
 from .provider import BPTreeProvider
 from ..bptree import BPTreeNode, BPTreeLeaf
 from ...serialize import Serializer
-from ...store.alloc import StoreBlock
+from ...lock import RWLock
+from ...store.alloc import desc_size, descs_size
+from ...codec import CodecGet
 
 
 __all__ = ('StoreBPTreeProvider',)
@@ -30,7 +29,15 @@ class StoreBPTreeProvider (BPTreeProvider):
 
     Keeps serialized (possible compressed) nodes inside store. Keys and values
     are serialized according to specified type. Possible values for type are
-    'bytes', 'pickle:protocol', 'struct:struct_type', 'json'.
+    'bytes', 'pickle:protocol', 'struct:struct_type', 'json'. Nodes are
+    compressed by codec (see CodecGet), dictionary of the codec is trained on
+    leaves saved by the first flush.
+
+    Nodes can be loaded concurrently by holding reader lock, flush holds
+    writer lock.
+
+    Space occupied by nodes on the store is maintained as they are saved and
+    released, and persisted in the header (see SizeOnStore).
     """
 
     order_default    = 128
@@ -39,13 +46,15 @@ class StoreBPTreeProvider (BPTreeProvider):
     desc_struct      = struct.Struct ('>Q')
     crc32_struct     = struct.Struct ('>I')
     leaf_struct      = struct.Struct ('>QQ')
+    relocate_batch   = 1 << 8
 
     def __init__ (self, store, header, order = None, key_type = None, value_type = None, compress = None):
         """Create provider
 
         Creates new provider or loads existing one identified by name. Compress
-        argument specifies compression level default is 9 (maximum compression).
-        If key_type (value_type) is not specified they are set to 'pickle'
+        argument specifies codec name (see CodecGet) or zlib compression level,
+        default is 9 (maximum compression). If key_type (value_type) is not
+        specified they are set to 'pickle'
         """
         self.store = store
         self.header = header
@@ -53,11 +62,13 @@ class StoreBPTreeProvider (BPTreeProvider):
         self.d2n = {}
         self.desc_next = -1
         self.dirty = set ()
+        self.lock = RWLock ()
+        self.relocator = False # relocator is registered in the store
 
         # get header
         header_data = header ()
         if header_data:
-            state_json = header_data [:-self.crc32_struct.size]
+            state_json = bytes (header_data [:-self.crc32_struct.size])
             crc32 = self.crc32_struct.unpack (header_data [-self.crc32_struct.size:]) [0]
 
             if crc32 != binascii.crc32 (state_json) & 0xffffffff:
@@ -79,6 +90,13 @@ class StoreBPTreeProvider (BPTreeProvider):
 
             # options
             self.compress = state.get ('compress', 0)
+            self.codec_desc = state.get ('compress_dict', 0)
+            self.codec = CodecGet (self.compress)
+            if self.codec is not None and self.codec.dictionary:
+                self.codec.zdict = bytes (store.Load (self.codec_desc))
+
+            # space on store (computed on demand for legacy header)
+            self.size_on_store = state.get ('size_on_store')
 
             # root
             self.root = self.node_load (state ['root'])
@@ -98,10 +116,17 @@ class StoreBPTreeProvider (BPTreeProvider):
 
             # options
             self.compress = compress if compress is not None else self.compress_default
+            self.codec_desc = 0
+            self.codec = CodecGet (self.compress)
+
+            # space on store
+            self.size_on_store = 0
 
             # root
             self.root = self.NodeCreate ([], [], True)
 
+        self.relocator_attach ()
+
     #--------------------------------------------------------------------------#
     # Properties                                                               #
     #--------------------------------------------------------------------------#
@@ -123,9 +148,30 @@ class StoreBPTreeProvider (BPTreeProvider):
     def Flush (self, prune = None):
         """Flush provider and store
         """
+        with self.lock.Writer (), self.store.Batch ():
+            self.flush (prune)
+
+    def flush (self, prune):
+        """Flush provider and store (lock must be held)
+        """
+        if self.dirty:
+            self.relocator_attach () # provider is being used after drop or dispose
+
         # relocated nodes
         d2n_reloc = {}
 
+        # train codec dictionary
+        codec = self.codec
+        if codec is not None and codec.dictionary and codec.zdict is None:
+            samples = []
+            for leaf in self.dirty:
+                if leaf.is_leaf:
+                    sample = io.BytesIO ()
+                    self.keys_to_stream (sample, leaf.keys)
+                    self.values_to_stream (sample, leaf.children)
+                    samples.append (sample.getvalue ())
+            self.codec_desc = self.store.Save (codec.Train (samples))
+
         #----------------------------------------------------------------------#
         # Flush Leafs                                                          #
         #----------------------------------------------------------------------#
@@ -134,9 +180,8 @@ class StoreBPTreeProvider (BPTreeProvider):
             leaf_stream = io.BytesIO ()
 
             # save leaf
-            leaf_stream.seek (self.leaf_struct.size)
-            if self.compress:
-                with CompressorStream (leaf_stream, self.compress) as stream:
+            if codec is not None:
+                with CompressorStream (leaf_stream, codec) as stream:
                     self.keys_to_stream (stream, leaf.keys)
                     self.values_to_stream (stream, leaf.children)
             else:
@@ -147,7 +192,8 @@ class StoreBPTreeProvider (BPTreeProvider):
             leaf_queue [leaf] = leaf_stream
 
             # allocate space
-            desc = self.store.Reserve (leaf_stream.tell () + 1, None if leaf.desc < 0 else leaf.desc)
+            desc = self.store.Reserve (self.leaf_struct.size + leaf_stream.tell () + 1,
+                None if leaf.desc < 0 else leaf.desc)
             if leaf.desc != desc:
                 # queue parent for update
                 if leaf is not self.root:
@@ -178,6 +224,7 @@ class StoreBPTreeProvider (BPTreeProvider):
                             leaf_enqueue (self.node_load (sibling_desc))
 
                 # update descriptor maps
+                self.node_moved (leaf.desc, desc)
                 self.d2n.pop (leaf.desc)
                 d2n_reloc [leaf.desc], leaf.desc = leaf, desc
                 self.d2n [desc] = leaf
@@ -201,16 +248,9 @@ class StoreBPTreeProvider (BPTreeProvider):
             if next is not None:
                 leaf.next = next.desc
 
-            # leaf header (perv, next)
-            leaf_stream.seek (0)
-            leaf_stream.write (self.leaf_struct.pack (leaf.prev, leaf.next))
-
-            # leaf tag
-            leaf_stream.seek (0, io.SEEK_END)
-            leaf_stream.write (b'\x01')
-
-            # put leaf in store
-            desc = self.store.Save (leaf_stream.getvalue (), leaf.desc)
+            # put leaf in store: header (prev, next), data, leaf tag
+            desc = self.store.Save ((self.leaf_struct.pack (leaf.prev, leaf.next),
+                leaf_stream.getvalue (), b'\x01'), leaf.desc)
             assert leaf.desc == desc
 
         #----------------------------------------------------------------------#
@@ -232,19 +272,16 @@ class StoreBPTreeProvider (BPTreeProvider):
 
             # node
             node_stream = io.BytesIO ()
-            if self.compress:
-                with CompressorStream (node_stream, self.compress) as stream:
+            if codec is not None:
+                with CompressorStream (node_stream, codec) as stream:
                     self.keys_to_stream (stream, node.keys)
                     Serializer (stream).StructListWrite (node.children, self.desc_struct)
             else:
                 self.keys_to_stream (node_stream, node.keys)
                 Serializer (node_stream).StructListWrite (node.children, self.desc_struct)
 
-            # node tag
-            node_stream.write (b'\x00')
-
-            # put node in store
-            desc = self.store.Save (node_stream.getvalue (), None if node.desc < 0 else node.desc)
+            # put node in store: data, node tag
+            desc = self.store.Save ((node_stream.getvalue (), b'\x00'), None if node.desc < 0 else node.desc)
 
             # check if node has been relocated
             if node.desc != desc:
@@ -260,6 +297,7 @@ class StoreBPTreeProvider (BPTreeProvider):
                         node_queue.add (parent)
 
                 # update descriptor maps
+                self.node_moved (node.desc, desc)
                 self.d2n.pop (node.desc)
                 d2n_reloc [node.desc], node.desc = node, desc
                 self.d2n [desc] = node
@@ -291,6 +329,10 @@ class StoreBPTreeProvider (BPTreeProvider):
             'compress'   : self.compress,
             'root'       : self.root.desc
         }
+        if self.size_on_store is not None:
+            state ['size_on_store'] = self.size_on_store
+        if self.codec_desc:
+            state ['compress_dict'] = self.codec_desc
         state_json = json.dumps (state, sort_keys = True).encode ()
         crc32 = binascii.crc32 (state_json) & 0xffffffff
 
@@ -319,9 +361,13 @@ class StoreBPTreeProvider (BPTreeProvider):
 
     def SizeOnStore (self):
         """Size occupied on store
+
+        Size is maintained incrementally, it is computed by iterating over all
+        nodes only once for the header saved without it.
         """
-        return functools.reduce (operator.add, (StoreBlock.FromDesc (node.desc).size
-            for node in self if node.desc > 0), 0)
+        if self.size_on_store is None:
+            self.size_on_store = descs_size (node.desc for node in self if node.desc > 0)
+        return self.size_on_store
 
     #--------------------------------------------------------------------------#
     # Nodes                                                                    #
@@ -334,6 +380,14 @@ class StoreBPTreeProvider (BPTreeProvider):
         if desc:
             return self.d2n.get (desc) or self.node_load (desc)
 
+    def DescsToNodes (self, descs):
+        d2n = self.d2n
+        descs_load = [desc for desc in descs if desc and desc not in d2n]
+        if descs_load:
+            for desc, node_data in zip (descs_load, self.store.LoadMany (descs_load)):
+                self.node_parse (desc, node_data)
+        return [self.DescToNode (desc) for desc in descs]
+
     def NodeCreate (self, keys, children, is_leaf):
         desc, self.desc_next = self.desc_next, self.desc_next - 1
         node = StoreBPTreeLeaf (desc, keys, children) if is_leaf else \
@@ -350,6 +404,7 @@ class StoreBPTreeProvider (BPTreeProvider):
         self.d2n.pop (node.desc)
         self.dirty.discard (node)
         if node.desc >= 0:
+            self.node_moved (node.desc, 0)
             self.store.Delete (node.desc)
 
     #--------------------------------------------------------------------------#
@@ -363,24 +418,59 @@ class StoreBPTreeProvider (BPTreeProvider):
         for node in tuple (self):
             self.store.Delete (node.desc)
         self.header (b'')
+        self.d2n.clear ()
+        self.dirty.clear ()
+
+        if self.codec_desc:
+            self.store.Delete (self.codec_desc)
+            self.codec_desc = 0
+        if self.codec is not None and self.codec.dictionary:
+            self.codec.zdict = None
 
         self.size  = 0
         self.depth = 1
         self.root  = self.NodeCreate ([], [], True)
+        self.size_on_store = 0
+
+        self.relocator_detach ()
+
+    #--------------------------------------------------------------------------#
+    # Dispose                                                                  #
+    #--------------------------------------------------------------------------#
+    def Dispose (self):
+        """Flush provider and stop relocation of its nodes
+
+        Provider can be disposed more than once.
+        """
+        self.Flush (prune = True)
+        self.relocator_detach ()
 
     #--------------------------------------------------------------------------#
     # Private                                                                  #
     #--------------------------------------------------------------------------#
+    def node_moved (self, desc, desc_new):
+        """Update space on store when node's descriptor changes
+        """
+        if self.size_on_store is not None:
+            if desc > 0:
+                self.size_on_store -= desc_size (desc)
+            if desc_new > 0:
+                self.size_on_store += desc_size (desc_new)
+
     def node_load (self, desc):
         """Load node by its descriptor
         """
-        node_data   = self.store.Load (desc)
+        return self.node_parse (desc, self.store.Load (desc))
+
+    def node_parse (self, desc, node_data):
+        """Create node from its descriptor and data
+        """
         node_tag    = node_data [-1:]
 
         if node_tag != b'\x01':
             # load node
-            node_stream = io.BytesIO (node_data [:-1]) if not self.compress else \
-                          io.BytesIO (zlib.decompress (node_data [:-1]))
+            node_stream = io.BytesIO (node_data [:-1]) if self.codec is None else \
+                          io.BytesIO (self.codec.Decompress (node_data [:-1]))
 
             node =  StoreBPTreeNode (desc,
                 self.keys_from_stream (node_stream),
@@ -389,8 +479,8 @@ class StoreBPTreeProvider (BPTreeProvider):
             # load leaf
             prev, next = self.leaf_struct.unpack (node_data [:self.leaf_struct.size])
 
-            node_stream = io.BytesIO (node_data [self.leaf_struct.size:-1]) if not self.compress else \
-                          io.BytesIO (zlib.decompress (node_data [self.leaf_struct.size:-1]))
+            node_stream = io.BytesIO (node_data [self.leaf_struct.size:-1]) if self.codec is None else \
+                          io.BytesIO (self.codec.Decompress (node_data [self.leaf_struct.size:-1]))
 
             node = StoreBPTreeLeaf (desc,
                 self.keys_from_stream (node_stream),
@@ -398,8 +488,55 @@ class StoreBPTreeProvider (BPTreeProvider):
             node.prev = prev
             node.next = next
 
-        self.d2n [desc] = node
-        return node
+        # concurrent reader could have already loaded this node
+        return self.d2n.setdefault (desc, node)
+
+    def relocator_attach (self):
+        """Register relocator in the store (if it is not registered)
+        """
+        if not self.relocator:
+            self.store.RelocatorRegister (self.relocate)
+            self.relocator = True
+
+    def relocator_detach (self):
+        """Unregister relocator from the store (if it is registered)
+        """
+        if self.relocator:
+            self.store.RelocatorUnregister (self.relocate)
+            self.relocator = False
+
+    def relocate (self):
+        """Relocate nodes (store relocator)
+
+        Each step walks at most relocate_batch nodes in keys order starting
+        from the key where previous step has stopped, so steps remain valid
+        if the tree is changed between them.
+        """
+        def relocate_walk (node, key):
+            # returns key to continue from, or None if subtree is done
+            count [0] += 1
+            if node.desc > 0 and self.store.Relocatable (node.desc):
+                self.dirty.add (node)
+            if node.is_leaf:
+                return None
+
+            start = 0 if key is None else bisect (node.keys, key)
+            for index in range (start, len (node.children)):
+                if index > start and count [0] >= self.relocate_batch:
+                    return node.keys [index - 1]
+                key = relocate_walk (self.DescToNode (node.children [index]), key if index == start else None)
+                if key is not None:
+                    return key
+
+        key = None
+        while True:
+            with self.lock.Writer ():
+                count = [0]
+                key = relocate_walk (self.root, key)
+                self.Flush (prune = True)
+            yield
+            if key is None:
+                return
 
     def type_parse (self, type):
         """Parse type
@@ -483,9 +620,9 @@ class CompressorStream (object):
     """
     __slots__ = ('stream', 'compressor',)
 
-    def __init__ (self, stream, level):
+    def __init__ (self, stream, codec):
         self.stream = stream
-        self.compressor = zlib.compressobj (level)
+        self.compressor = codec.Compressor ()
 
     def write (self, data):
         return self.stream.write (self.compressor.compress (data))
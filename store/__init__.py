@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
-from . import store, stream
+from . import store, stream, memory, replica, cache, instrument
 
 from .store import *
 from .stream import *
+from .memory import *
+from .replica import *
+from .cache import *
+from .instrument import *
 
-__all__ = store.__all__ + stream.__all__
+__all__ = store.__all__ + stream.__all__ + memory.__all__ + replica.__all__ + cache.__all__ + instrument.__all__
 # vim: nu ft=python columns=120 :
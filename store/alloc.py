@@ -1,8 +1,6 @@
 # -*- coding: utf-8 -*-
-import operator
-import functools
+import heapq
 import struct
-from bisect import bisect_left, insort
 
 from ..serialize import Serializer
 
@@ -15,20 +13,39 @@ class StoreBlock (object):
 
     Descriptor format:
 
-        0       6      7 + order         64
-        +-------+------+-----------------+
-        | order | used | offset >> order |
-        +-------+------+-----------------+
+        0       6      7 + order         62           64
+        +-------+------+-----------------+------------+
+        | order | used | offset >> order | size class |
+        +-------+------+-----------------+------------+
 
         Because data offset is always aligned by its order, first order bits
         of the offset can be used to store used size.
+
+        Size class is zero for the whole block, otherwise block occupies only
+        (4 + size class) / 8 of its order size (see StoreAllocator). Offset
+        must be below offset_limit (32 PiB), so it does not reach size class.
+
+    Slab slot descriptor format (order field is set to 0x3f):
+
+        0       6      10         18
+        +-------+------+----------+-------------+
+        | 0x3f  | slot | used - 1 | offset >> 4 |
+        +-------+------+----------+-------------+
+
+        Slot is a block of ``(slot + 1) * 16`` bytes inside of the slab page
+        (see Store), order field of such block is set to slot.
     """
-    __slots__ = ('order', 'offset', 'used',)
+    __slots__ = ('order', 'offset', 'used', 'size_class', 'slab',)
+
+    slab_order = 0x3f
+    offset_limit = 1 << 55
 
-    def __init__ (self, order, offset, used = 0):
+    def __init__ (self, order, offset, used = 0, size_class = 0, slab = False):
         self.order = order
         self.offset = offset
         self.used = used
+        self.size_class = size_class
+        self.slab = slab
 
     #--------------------------------------------------------------------------#
     # Compare                                                                  #
@@ -55,6 +72,10 @@ class StoreBlock (object):
     def size (self):
         """Size of the block
         """
+        if self.slab:
+            return (self.order + 1) << 4
+        if self.size_class:
+            return (4 + self.size_class) << (self.order - 3)
         return 1 << self.order
 
     #--------------------------------------------------------------------------#
@@ -63,17 +84,23 @@ class StoreBlock (object):
     def ToDesc (self):
         """Convert block to integer descriptor
         """
-        return self.order | (self.used << 6) | (self.offset << 7)
+        if self.slab:
+            return self.slab_order | (self.order << 6) | ((self.used - 1) << 10) | ((self.offset >> 4) << 18)
+        if self.offset >= self.offset_limit:
+            raise ValueError ('Block offset is out of descriptor range: {}'.format (self.offset))
+        return self.order | (self.used << 6) | (self.offset << 7) | (self.size_class << 62)
 
     @classmethod
     def FromDesc (cls, desc):
         """Restore block from integer descriptor
         """
         order = desc & 0x3f
-        value = desc >> 6
+        if order == cls.slab_order:
+            return cls ((desc >> 6) & 0xf, (desc >> 18) << 4, ((desc >> 10) & 0xff) + 1, 0, True)
+        value = (desc & 0x3fffffffffffffff) >> 6
         value_mask = (1 << (order + 1)) - 1
 
-        return cls (order, (value & ~value_mask) >> 1, value & value_mask)
+        return cls (order, (value & ~value_mask) >> 1, value & value_mask, desc >> 62)
 
     #--------------------------------------------------------------------------#
     # To String                                                                #
@@ -81,74 +108,465 @@ class StoreBlock (object):
     def __str__ (self):
         """String representation
         """
-        return '<StoreBLock [order:{} offset:{} used:{}]>'.format (
-            self.order, self.offset, self.used)
+        return '<StoreBLock [order:{} offset:{} used:{} class:{}{}]>'.format (
+            self.order, self.offset, self.used, self.size_class, ' slab' if self.slab else '')
 
     def __repr__ (self):
         """String representation
         """
         return str (self)
 
+#------------------------------------------------------------------------------#
+# Descriptor                                                                   #
+#------------------------------------------------------------------------------#
+# Integer only counterparts of StoreBlock.FromDesc, used on hot paths where only
+# some fields of the block are needed (see StoreBlock for descriptor format)
+
+def desc_order (desc):
+    """Order field of the descriptor (StoreBlock.slab_order for slab slot)
+    """
+    return desc & 0x3f
+
+def desc_offset (desc):
+    """Offset of the block
+    """
+    order = desc & 0x3f
+    if order == 0x3f:
+        return (desc >> 18) << 4
+    return ((desc & 0x3fffffffffffffff) >> (order + 7)) << order
+
+def desc_used (desc):
+    """Used size of the block
+    """
+    order = desc & 0x3f
+    if order == 0x3f:
+        return ((desc >> 10) & 0xff) + 1
+    return (desc >> 6) & ((1 << (order + 1)) - 1)
+
+def desc_size (desc):
+    """Size of the block
+    """
+    order = desc & 0x3f
+    if order == 0x3f:
+        return (((desc >> 6) & 0xf) + 1) << 4
+    size_class = desc >> 62
+    if size_class:
+        return (4 + size_class) << (order - 3)
+    return 1 << order
+
+def descs_size (descs):
+    """Total size of blocks of descriptors (zero descriptors are skipped)
+    """
+    size = 0
+    for desc in descs:
+        if not desc:
+            continue
+        order = desc & 0x3f
+        if order == 0x3f:
+            size += (((desc >> 6) & 0xf) + 1) << 4
+        elif desc >> 62:
+            size += (4 + (desc >> 62)) << (order - 3)
+        else:
+            size += 1 << order
+    return size
+
+def descs_locations (descs):
+    """List of (offset, used, index) of non-zero descriptors
+    """
+    locations = []
+    for index, desc in enumerate (descs):
+        if not desc:
+            continue
+        order = desc & 0x3f
+        if order == 0x3f:
+            locations.append (((desc >> 18) << 4, ((desc >> 10) & 0xff) + 1, index))
+        else:
+            locations.append ((((desc & 0x3fffffffffffffff) >> (order + 7)) << order,
+                               (desc >> 6) & ((1 << (order + 1)) - 1), index))
+    return locations
+
 #------------------------------------------------------------------------------#
 # Store Allocator                                                              #
 #------------------------------------------------------------------------------#
 class StoreAllocator (object):
     """Store buddy allocator
 
-    ``blocks`` is a sorted list of free blocks.
+    Free blocks are kept by order: ``free`` is a list of sets of offsets and
+    ``heaps`` is a list of (lazily cleaned) heaps of the same offsets used to
+    find block with the lowest offset, ``mask`` has bit set for each order
+    with free blocks. So all operations are O(log n).
+
+    If size_classes is set, allocated blocks (of at least ``class_order_min``
+    order) are rounded up to quarter steps between powers of two instead of
+    the power of two. Such block is allocated as a whole block of its order,
+    and unused tail pieces are freed as buddies. Space addressed by such
+    blocks is limited to ``1 << 55`` bytes.
+
+    Address space is divided into regions of ``1 << region_order`` bytes, and
+    blocks of at least region order belong to the separate ``region_large``.
+    ``dirty`` is a set of regions with changed free blocks, so allocator state
+    can be persisted incrementally (see Region).
+
+    Allocator keeps counters of allocated bytes per order ``orders_size`` and
+    requested bytes ``requested`` (see Use), they are None if unknown (state
+    has been loaded from the stream without them), see Stats.
     """
     max_order = 57 # 64 - 6 (used by order) - 1 (used by size)
-
-    def __init__ (self, blocks = None):
-        self.blocks = blocks or [StoreBlock (self.max_order, 0)]
+    region_order = 24
+    region_large = 1 << (max_order - region_order)
+    class_order_min = 6
+
+    def __init__ (self, blocks = None, size_classes = None):
+        self.size_classes = bool (size_classes)
+        self.free = [set () for _ in range (self.max_order + 1)]
+        self.heaps = [[] for _ in range (self.max_order + 1)]
+        self.mask = 0
+        self.regions = {}
+        self.free_size = 0
+
+        self.dirty = set ()
+        self.orders_size = [0] * (self.max_order + 1)
+        self.requested = 0
+
+        region_order, region_large = self.region_order, self.region_large
+        for block in blocks or (StoreBlock (self.max_order, 0),):
+            order, offset = block.order, block.offset
+            self.free [order].add (offset)
+            self.heaps [order].append (offset)
+            region = region_large if order >= region_order else offset >> region_order
+            region_keys = self.regions.get (region)
+            if region_keys is None:
+                region_keys = self.regions [region] = set ()
+            region_keys.add (order << self.max_order | offset)
+            self.free_size += 1 << order
+
+        for order, heap in enumerate (self.heaps):
+            if heap:
+                heapq.heapify (heap)
+                self.mask |= 1 << order
 
     def Alloc (self, size):
         """Allocate block by size
 
         Block it is an order-offset pair.
         """
-        return self.AllocByOrder ((size - 1).bit_length ())
+        order, size_class = self.size_order (size)
+        return self.AllocByOrder (order, size_class = size_class)
 
-    def AllocByOrder (self, order):
-        """Allocate block by order
+    def Realloc (self, block, size):
+        """Resize allocated block in place
 
-        Block it is an order-offset pair.
+        Block grows if space following it up to the end of the resized block is
+        free (resized block must be aligned by its order), and shrinks by
+        returning its tail to free space. Returns resized block with the same
+        offset and used size, or None if block can not be resized in place.
         """
-        index = bisect_left (self.blocks, StoreBlock (order, 0))
-        if index >= len (self.blocks):
-            raise ValueError ('Out of space')
-
-        block = self.blocks.pop (index)
-        for block_order in range (order, block.order):
-            insort (self.blocks, StoreBlock (block_order, block.offset + (1 << block_order)))
+        order, size_class = self.size_order (size)
+        offset = block.offset
+        if offset & ((1 << order) - 1):
+            return None
+
+        block_new = StoreBlock (order, offset, block.used, size_class)
+        end, end_prev = offset + block_new.size, offset + block.size
+        if end > end_prev:
+            for piece_order, piece_offset in self.range_pieces (end_prev, end):
+                if self.block_containing (piece_order, piece_offset) is None:
+                    return None
+
+        self.Free (block)
+        self.block_take (block_new)
+        return block_new
+
+    def AllocByOrder (self, order, limit = None, size_class = None):
+        """Allocate block by order
 
-        return StoreBlock (order, block.offset)
+        Block it is an order-offset pair. If limit is set, block with the lowest
+        offset is allocated, and None is returned if there is no free block
+        below limit. If size class is set, tail of the block is freed.
+        """
+        if limit is None:
+            mask = self.mask >> order
+            if not mask:
+                raise ValueError ('Out of space')
+            block_order = order + (mask & -mask).bit_length () - 1
+            block_offset = self.heap_lowest (block_order)
+        else:
+            block = self.Lowest (order, limit)
+            if block is None:
+                return None
+            block_order, block_offset = block.order, block.offset
+
+        self.block_remove (block_order, block_offset)
+        for buddy_order in range (order, block_order):
+            self.block_add (buddy_order, block_offset + (1 << buddy_order))
+
+        if size_class:
+            for piece_order, piece_offset in self.pieces (order, block_offset, 4 + size_class, 8):
+                self.free_block (piece_order, piece_offset)
+            block = StoreBlock (order, block_offset, 0, size_class)
+        else:
+            block = StoreBlock (order, block_offset)
+
+        if self.orders_size is not None:
+            self.orders_size [order] += block.size
+        return block
 
     def Free (self, block):
         """Free previously allocated block
         """
-        for order in range (block.order, self.max_order):
-            buddy = StoreBlock (order, block.offset ^ (1 << order))
+        self.free_sized (block.order, block.offset, block.size_class)
 
-            index = bisect_left (self.blocks, buddy)
-            if index < len (self.blocks) and buddy == self.blocks [index]:
-                self.blocks.pop (index)
-                block = StoreBlock (order + 1,
-                    buddy.offset if block.offset & (1 << order) else block.offset)
+    def FreeDesc (self, desc):
+        """Free previously allocated block by its descriptor (not a slab slot)
+        """
+        self.free_sized (desc & 0x3f, desc_offset (desc), desc >> 62)
 
-            else:
-                self.blocks.insert (index, block)
-                return
+    def Lowest (self, order, limit = None):
+        """Find free block with the lowest offset
+
+        Block has at least specified order, and its offset is lower then limit
+        if limit is set. Returns None if there is no such block.
+        """
+        lowest = None
+        mask = self.mask >> order
+        while mask:
+            if mask & 1:
+                offset = self.heap_lowest (order)
+                if lowest is None or offset < lowest.offset:
+                    lowest = StoreBlock (order, offset)
+            mask >>= 1
+            order += 1
+
+        if lowest is None or (limit is not None and lowest.offset >= limit):
+            return None
+        return lowest
 
-        assert not self.blocks
-        self.blocks.append (block)
+    @property
+    def End (self):
+        """End of the allocated block with the highest offset
+        """
+        end = 1 << self.max_order
+        while end:
+            # free block with the highest order which ends at the end
+            for order in range ((end & -end).bit_length () - 1, -1, -1):
+                if end - (1 << order) in self.free [order]:
+                    end -= 1 << order
+                    break
+            else:
+                break
+        return end
 
     @property
     def Size (self):
         """Size of allocated space
         """
-        return (1 << self.max_order) - functools.reduce (operator.add,
-                (block.size for block in self.blocks), 0)
+        return (1 << self.max_order) - self.free_size
+
+    def Use (self, size):
+        """Account change of requested (used) size of allocated blocks
+        """
+        if self.requested is not None:
+            self.requested += size
+
+    def Stats (self):
+        """Allocator statistics
+
+        Returns dictionary with allocated and requested bytes, end of the
+        allocated space, free bytes below the end, largest free block below the
+        end, fragmentation ratio of the free space below the end, and allocated
+        bytes per order.
+        """
+        end = self.End
+        allocated = self.Size
+        free = end - allocated
+
+        free_largest = 0
+        for order in range (self.mask.bit_length () - 1, -1, -1):
+            if self.mask & (1 << order) and self.heap_lowest (order) + (1 << order) <= end:
+                free_largest = 1 << order
+                break
+
+        return {
+            'allocated'     : allocated,
+            'requested'     : self.requested,
+            'end'           : end,
+            'free'          : free,
+            'free_largest'  : free_largest,
+            'fragmentation' : 1.0 - float (free_largest) / free if free else 0.0,
+            'orders'        : None if self.orders_size is None else
+                              dict ((order, size) for order, size in enumerate (self.orders_size) if size),
+        }
+
+    @property
+    def blocks (self):
+        """Sorted list of free blocks
+        """
+        return [StoreBlock (order, offset)
+            for order in range (self.max_order + 1) for offset in sorted (self.free [order])]
+
+    def Region (self, region):
+        """Free blocks of the region
+        """
+        return [StoreBlock (key >> self.max_order, key & self.offset_mask)
+            for key in sorted (self.regions.get (region, ()))]
+
+    def RegionDescs (self, region):
+        """Descriptors of free blocks of the region (see blocks_read)
+        """
+        return [(key >> self.max_order) | ((key & self.offset_mask) << 7)
+            for key in sorted (self.regions.get (region, ()))]
+
+    #--------------------------------------------------------------------------#
+    # Private                                                                  #
+    #--------------------------------------------------------------------------#
+    offset_mask = (1 << max_order) - 1
+
+    def region (self, order, offset):
+        """Region of the block
+        """
+        return self.region_large if order >= self.region_order else offset >> self.region_order
+
+    def block_add (self, order, offset):
+        """Add free block
+        """
+        self.free [order].add (offset)
+        heapq.heappush (self.heaps [order], offset)
+        self.mask |= 1 << order
+        self.free_size += 1 << order
+
+        region = self.region (order, offset)
+        region_keys = self.regions.get (region)
+        if region_keys is None:
+            region_keys = self.regions [region] = set ()
+        region_keys.add (order << self.max_order | offset)
+        self.dirty.add (region)
+
+    def block_remove (self, order, offset):
+        """Remove free block
+        """
+        free = self.free [order]
+        free.remove (offset)
+        heap = self.heaps [order]
+        if not free:
+            self.mask &= ~(1 << order)
+            del heap [:]
+        elif len (heap) > 2 * len (free) + 64:
+            # too many removed offsets in the heap
+            heap [:] = free
+            heapq.heapify (heap)
+        self.free_size -= 1 << order
+
+        region = self.region (order, offset)
+        region_keys = self.regions [region]
+        region_keys.discard (order << self.max_order | offset)
+        if not region_keys:
+            del self.regions [region]
+        self.dirty.add (region)
+
+    def free_sized (self, order, offset, size_class):
+        """Free allocated block by order, offset and size class
+        """
+        if self.orders_size is not None:
+            self.orders_size [order] -= (4 + size_class) << (order - 3) if size_class else 1 << order
+        if size_class:
+            for piece_order, piece_offset in self.pieces (order, offset, 0, 4 + size_class):
+                self.free_block (piece_order, piece_offset)
+        else:
+            self.free_block (order, offset)
+
+    def free_block (self, order, offset):
+        """Free block by order and offset
+        """
+        while order < self.max_order:
+            buddy_offset = offset ^ (1 << order)
+            if buddy_offset not in self.free [order]:
+                break
+            self.block_remove (order, buddy_offset)
+            offset &= ~(1 << order)
+            order += 1
+
+        assert order < self.max_order or not self.mask
+        self.block_add (order, offset)
+
+    def size_order (self, size):
+        """Order and size class of the block which fits size
+        """
+        order = (size - 1).bit_length ()
+        if self.size_classes and order >= self.class_order_min:
+            # smallest quarter step (in eighths of the order size) which fits size
+            eighths = -(-size // (1 << (order - 3)))
+            return order, eighths - 4 if eighths < 8 else 0
+        return order, 0
+
+    def block_containing (self, order, offset):
+        """Free block (order, offset) containing block of the order at the offset
+
+        Returns None if there is no such free block.
+        """
+        mask = self.mask >> order
+        while mask:
+            if mask & 1:
+                block_offset = offset & ~((1 << order) - 1)
+                if block_offset in self.free [order]:
+                    return order, block_offset
+            mask >>= 1
+            order += 1
+        return None
+
+    def block_take (self, block):
+        """Allocate block at its offset (space it occupies must be free)
+        """
+        for order, offset in self.range_pieces (block.offset, block.offset + block.size):
+            free_order, free_offset = self.block_containing (order, offset)
+            self.block_remove (free_order, free_offset)
+            while free_order > order:
+                # split containing free block, and free half without the piece
+                free_order -= 1
+                half_offset = free_offset + (1 << free_order)
+                if offset >= half_offset:
+                    self.block_add (free_order, free_offset)
+                    free_offset = half_offset
+                else:
+                    self.block_add (free_order, half_offset)
+
+        if self.orders_size is not None:
+            self.orders_size [block.order] += block.size
+
+    def range_pieces (self, begin, end):
+        """Split range [begin, end) into buddy blocks
+
+        Returns list of (order, offset) pairs.
+        """
+        pieces = []
+        while begin < end:
+            order = ((begin & -begin) if begin else 1 << self.max_order).bit_length () - 1
+            while begin + (1 << order) > end:
+                order -= 1
+            pieces.append ((order, begin))
+            begin += 1 << order
+        return pieces
+
+    def pieces (self, order, offset, start, end):
+        """Split part of the block in eighths [start, end) into buddy blocks
+
+        Returns list of (order, offset) pairs.
+        """
+        pieces = []
+        while start < end:
+            size = start & -start if start else 8
+            while start + size > end:
+                size >>= 1
+            pieces.append ((order - 3 + size.bit_length () - 1, offset + (start << (order - 3))))
+            start += size
+        return pieces
+
+    def heap_lowest (self, order):
+        """Lowest offset of the free block of the order
+        """
+        heap, free = self.heaps [order], self.free [order]
+        while heap [0] not in free:
+            heapq.heappop (heap)
+        return heap [0]
 
     #--------------------------------------------------------------------------#
     # Serialization                                                            #
@@ -159,14 +577,36 @@ class StoreAllocator (object):
         """Save allocator to stream
         """
         Serializer (stream).StructListWrite (
-            [block.ToDesc () for block in self.blocks], self.desc_struct)
+            [block.order | (block.offset << 7) for block in self.blocks], self.desc_struct)
         return stream
 
     @classmethod
     def FromStream (cls, stream):
         """Load allocator from stream
         """
-        return cls ([StoreBlock.FromDesc (desc)
-            for desc in Serializer (stream).StructListRead (cls.desc_struct)])
+        alloc = cls (cls.blocks_read (stream))
+        alloc.orders_size, alloc.requested = None, None
+        return alloc
+
+    @classmethod
+    def FromStreams (cls, streams):
+        """Load allocator from streams of regions (see Region)
+        """
+        blocks = []
+        for stream in streams:
+            blocks.extend (cls.blocks_read (stream))
+        alloc = cls (blocks)
+        alloc.orders_size, alloc.requested = None, None
+        return alloc
+
+    @classmethod
+    def blocks_read (cls, stream):
+        """Read free blocks from stream
+
+        Free blocks are never size classed, and their used size is always zero,
+        so offset occupies all descriptor bits after order and used bit.
+        """
+        return [StoreBlock (desc & 0x3f, desc >> 7)
+            for desc in Serializer (stream).StructListRead (cls.desc_struct)]
 
 # vim: nu ft=python columns=120 :
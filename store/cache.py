@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+
+__all__ = ('StorePageCache',)
+#------------------------------------------------------------------------------#
+# Store Page Cache                                                             #
+#------------------------------------------------------------------------------#
+class StorePageCache (object):
+    """Page cache
+
+    Keeps aligned pages of the backing storage in memory. Least recently used
+    pages are evicted when size of cached pages exceeds capacity. Saved data
+    only updates cached pages (write-back), dirty pages are written on flush or
+    when they are evicted.
+
+    ``load (offset, size)`` and ``save (offset, datas)`` are used to access
+    backing storage.
+    """
+    page_order_default = 12
+
+    def __init__ (self, load, save, capacity, page_order = None):
+        self.load = load
+        self.save = save
+        self.page_order = page_order or self.page_order_default
+        self.page_size = 1 << self.page_order
+        self.capacity = capacity
+        self.end = 0 # end of data known to the cache (loaded or saved)
+
+        self.pages = OrderedDict ()
+        self.dirty = set ()
+        self.lock = threading.RLock ()
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    #--------------------------------------------------------------------------#
+    # Properties                                                               #
+    #--------------------------------------------------------------------------#
+    @property
+    def Size (self):
+        """Size of cached pages
+        """
+        return len (self.pages) << self.page_order
+
+    #--------------------------------------------------------------------------#
+    # Load                                                                     #
+    #--------------------------------------------------------------------------#
+    def Load (self, offset, size):
+        """Load data by offset and size
+        """
+        with self.lock:
+            page_size = self.page_size
+            index, page_offset = offset >> self.page_order, offset & (page_size - 1)
+
+            datas = []
+            while size > 0:
+                page = self.page_get (index)
+                if len (page) < page_size:
+                    # page was partially filled when it was loaded, but data
+                    # has been saved after it since then (gap is zero filled)
+                    page_end = min (page_size, self.end - (index << self.page_order))
+                    if len (page) < page_end:
+                        page.extend (bytearray (page_end - len (page)))
+                data = memoryview (page) [page_offset:page_offset + size]
+                if not data:
+                    break
+                datas.append (data)
+                size -= len (data)
+                if len (page) < page_size:
+                    break # end of data
+                index, page_offset = index + 1, 0
+
+            # memory views are converted, as python 2 can not join them
+            return datas [0].tobytes () if len (datas) == 1 else b''.join ([data.tobytes () for data in datas])
+
+    #--------------------------------------------------------------------------#
+    # Save                                                                     #
+    #--------------------------------------------------------------------------#
+    def Save (self, offset, data):
+        """Save data by offset
+        """
+        with self.lock:
+            page_size = self.page_size
+            index, page_offset = offset >> self.page_order, offset & (page_size - 1)
+
+            data = memoryview (data)
+            data_size = len (data)
+            data_offset = 0
+            self.end = max (self.end, offset + data_size)
+            while data_offset < data_size:
+                chunk_size = min (page_size - page_offset, data_size - data_offset)
+                chunk = data [data_offset:data_offset + chunk_size]
+                if chunk_size == page_size:
+                    # whole page is overwritten, there is no need to load it
+                    self.page_put (index, bytearray (chunk))
+                else:
+                    page = self.page_get (index)
+                    if len (page) < page_offset:
+                        page.extend (bytearray (page_offset - len (page)))
+                    page [page_offset:page_offset + chunk_size] = chunk
+                self.dirty.add (index)
+
+                data_offset += chunk_size
+                index, page_offset = index + 1, 0
+
+            return data_size
+
+    def SaveVector (self, offset, datas):
+        """Save sequence of data continuously starting from offset
+        """
+        with self.lock:
+            size = 0
+            for data in datas:
+                size += self.Save (offset + size, data)
+            return size
+
+    #--------------------------------------------------------------------------#
+    # Flush                                                                    #
+    #--------------------------------------------------------------------------#
+    def Flush (self):
+        """Write dirty pages
+
+        Consecutive dirty pages are written together.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+
+            indices, self.dirty = sorted (self.dirty), set ()
+            run_index, run = indices [0], []
+            for index in indices:
+                if index != run_index + len (run) or (run and len (run [-1]) < self.page_size):
+                    self.save (run_index << self.page_order, run)
+                    run_index, run = index, []
+                run.append (self.pages [index])
+            self.save (run_index << self.page_order, run)
+
+    def Clear (self):
+        """Write dirty pages and drop all pages
+        """
+        with self.lock:
+            self.Flush ()
+            self.pages.clear ()
+
+    #--------------------------------------------------------------------------#
+    # Private                                                                  #
+    #--------------------------------------------------------------------------#
+    def page_get (self, index):
+        """Get page by its index (load it if needed)
+        """
+        page = self.pages.get (index)
+        if page is None:
+            self.misses += 1
+            page = bytearray (self.load (index << self.page_order, self.page_size))
+            self.end = max (self.end, (index << self.page_order) + len (page))
+            self.page_put (index, page)
+        else:
+            self.hits += 1
+            self.page_touch (index)
+        return page
+
+    def page_put (self, index, page):
+        """Put page into the cache, evicting least recently used pages
+        """
+        if index in self.pages:
+            self.page_touch (index)
+        self.pages [index] = page
+
+        while len (self.pages) << self.page_order > self.capacity and len (self.pages) > 1:
+            evict_index, evict_page = self.pages.popitem (last = False)
+            if evict_index in self.dirty:
+                self.dirty.discard (evict_index)
+                self.save (evict_index << self.page_order, (evict_page,))
+            self.evictions += 1
+
+    if hasattr (OrderedDict, 'move_to_end'):
+        def page_touch (self, index):
+            """Mark page as most recently used
+            """
+            self.pages.move_to_end (index)
+    else:
+        def page_touch (self, index):
+            """Mark page as most recently used
+            """
+            self.pages [index] = self.pages.pop (index)
+
+# vim: nu ft=python columns=120 :
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import functools
+
+from .alloc import desc_used
+
+__all__ = ('StoreInstrument',)
+
+timer = getattr (time, 'perf_counter', time.time)
+#------------------------------------------------------------------------------#
+# Store Instrument                                                             #
+#------------------------------------------------------------------------------#
+class StoreInstrument (object):
+    """Store instrumentation
+
+    Counts calls, bytes and time of store operations, keeps latency histogram
+    of each operation, and counts seeks (low level I/O which does not start
+    where previous one ended). Instrument is attached to the store (see
+    Store.Instrument) by replacing its methods with instance attributes, so
+    detached instrumentation costs nothing.
+
+    Hooks are called as ``hook (op, arg, size, elapsed)`` after each operation
+    in the thread which called it, where arg is descriptor (descriptors for
+    LoadMany) or offset of the data. If scope is set (see Scope), counters are
+    also accumulated per scope, so load can be attributed to the owner
+    (mapping, stream) of the data.
+    """
+    ops_desc = ('Load', 'Save', 'Delete', 'Reserve')
+    ops_offset = ('LoadByOffset', 'SaveByOffset', 'SaveByOffsetVector')
+    ops = ops_desc + ops_offset + ('LoadMany', 'Flush')
+
+    def __init__ (self, hooks = None):
+        self.hooks = list (hooks or ())
+        self.lock = threading.Lock ()
+        self.local = threading.local ()
+
+        self.counters = dict ((op, [0, 0, 0.0]) for op in self.ops) # op -> [count, bytes, time]
+        self.histograms = dict ((op, []) for op in self.ops)        # op -> counts by log2 of microseconds
+        self.scopes = {}                                            # scope -> op -> [count, bytes]
+        self.seeks = 0
+        self.position = None
+
+    #--------------------------------------------------------------------------#
+    # Attach                                                                   #
+    #--------------------------------------------------------------------------#
+    def Attach (self, store):
+        """Attach instrument to the store
+        """
+        for op in self.ops:
+            setattr (store, op, self.wrap (op, getattr (store, op)))
+        return self
+
+    def Detach (self, store):
+        """Detach instrument from the store
+        """
+        for op in self.ops:
+            store.__dict__.pop (op, None)
+
+    #--------------------------------------------------------------------------#
+    # Hooks                                                                    #
+    #--------------------------------------------------------------------------#
+    def Hook (self, hook):
+        """Add hook
+        """
+        self.hooks.append (hook)
+        return hook
+
+    def Unhook (self, hook):
+        """Remove hook
+        """
+        self.hooks.remove (hook)
+
+    def Scope (self, scope):
+        """Scope context
+
+        Operations done inside the context (in the same thread) are accounted
+        in the scope too.
+        """
+        return StoreInstrumentScope (self, scope)
+
+    #--------------------------------------------------------------------------#
+    # Stats                                                                    #
+    #--------------------------------------------------------------------------#
+    def Stats (self):
+        """Instrumentation statistics
+
+        Returns dictionary with count, bytes, time and latency histogram for
+        each operation which has been called, where histogram is a list of
+        (microseconds upper bound, count) pairs. Also contains number of seeks
+        and counters per scope.
+        """
+        with self.lock:
+            stats = {}
+            for op, (count, size, elapsed) in self.counters.items ():
+                if count:
+                    stats [op] = {
+                        'count'     : count,
+                        'bytes'     : size,
+                        'time'      : elapsed,
+                        'histogram' : [(1 << bucket, count) for bucket, count in
+                                       enumerate (self.histograms [op]) if count],
+                    }
+            stats ['seeks'] = self.seeks
+            stats ['scopes'] = dict ((scope, dict ((op, {'count': count, 'bytes': size})
+                for op, (count, size) in ops.items ())) for scope, ops in self.scopes.items ())
+            return stats
+
+    #--------------------------------------------------------------------------#
+    # Private                                                                  #
+    #--------------------------------------------------------------------------#
+    def wrap (self, op, method):
+        """Wrap store method
+        """
+        size_of = self.size_of (op)
+        record = self.record
+        result_arg = op in ('Save', 'Reserve') # descriptor is a result
+        @functools.wraps (method)
+        def method_instrumented (*args, **keys):
+            start = timer ()
+            result = method (*args, **keys)
+            elapsed = timer () - start
+            record (op, result if result_arg else (args [0] if args else None), size_of (args, result), elapsed)
+            return result
+        return method_instrumented
+
+    def size_of (self, op):
+        """Function which returns size of the data of operation from arguments and result
+        """
+        if op in ('Load', 'LoadByOffset'):
+            return lambda args, result: len (result)
+        elif op == 'LoadMany':
+            return lambda args, result: sum (len (data) for data in result)
+        elif op == 'Save':
+            return lambda args, result: (sum (len (data) for data in args [0])
+                if isinstance (args [0], (list, tuple)) else len (args [0]))
+        elif op == 'SaveByOffset':
+            return lambda args, result: len (args [1])
+        elif op == 'SaveByOffsetVector':
+            return lambda args, result: sum (len (data) for data in args [1])
+        elif op == 'Delete':
+            return lambda args, result: desc_used (args [0]) if args [0] else 0
+        elif op == 'Reserve':
+            return lambda args, result: args [0]
+        return lambda args, result: 0
+
+    def record (self, op, arg, size, elapsed):
+        """Record operation
+        """
+        bucket = int (elapsed * 1e6).bit_length ()
+        with self.lock:
+            counter = self.counters [op]
+            counter [0] += 1
+            counter [1] += size
+            counter [2] += elapsed
+
+            histogram = self.histograms [op]
+            if len (histogram) <= bucket:
+                histogram.extend ((0,) * (bucket + 1 - len (histogram)))
+            histogram [bucket] += 1
+
+            if op in self.ops_offset:
+                if arg != self.position:
+                    self.seeks += 1
+                self.position = arg + size
+
+            scope = getattr (self.local, 'scope', None)
+            if scope is not None:
+                scope_ops = self.scopes.get (scope)
+                if scope_ops is None:
+                    scope_ops = self.scopes [scope] = {}
+                scope_counter = scope_ops.get (op)
+                if scope_counter is None:
+                    scope_counter = scope_ops [op] = [0, 0]
+                scope_counter [0] += 1
+                scope_counter [1] += size
+
+        for hook in self.hooks:
+            hook (op, arg, size, elapsed)
+
+#------------------------------------------------------------------------------#
+# Store Instrument Scope                                                       #
+#------------------------------------------------------------------------------#
+class StoreInstrumentScope (object):
+    """Store instrument scope context
+    """
+    __slots__ = ('instrument', 'scope', 'scope_prev',)
+
+    def __init__ (self, instrument, scope):
+        self.instrument = instrument
+        self.scope = scope
+        self.scope_prev = None
+
+    def __enter__ (self):
+        local = self.instrument.local
+        self.scope_prev = getattr (local, 'scope', None)
+        local.scope = self.scope
+        return self.instrument
+
+    def __exit__ (self, et, eo, tb):
+        self.instrument.local.scope = self.scope_prev
+        return False
+
+# vim: nu ft=python columns=120 :
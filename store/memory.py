@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+
+from .store import Store
+
+__all__ = ('MemoryStore',)
+#------------------------------------------------------------------------------#
+# Memory Store                                                                 #
+#------------------------------------------------------------------------------#
+class MemoryStore (Store):
+    """Memory based store
+
+    Data is kept in fixed size chunks (``1 << chunk_order`` bytes), so growing
+    store never copies or moves existing data. Chunks are aligned to the start
+    of allocated space (header is kept in its own chunk), so blocks which are
+    not bigger than chunk never cross chunk boundary. Loaded data which lies
+    inside single chunk is a memory view into it, so it is not copied, and it
+    is only valid until the block it belongs to is saved or deleted (on python 2
+    loaded data is always copied, as memory views can not be used as bytes).
+
+    Store content is the same as content of the file store, it can be saved to
+    the file (see Dump), and store can be loaded from the file (if path is set)
+    with a single read per chunk.
+    """
+    chunk_order = 20
+    load_view = sys.version_info [0] > 2 # loaded data can be a memory view
+
+    def __init__ (self, path = None, offset = None, chunk_order = None, cow = None, size_classes = None,
+                  slab = None, dedup = None):
+        self.chunk_order = chunk_order or self.chunk_order
+        self.chunk_base = (offset or 0) + self.header_struct.size
+        self.chunks = [memoryview (bytearray (self.chunk_base))] # header chunk
+        self.size = 0 # end of saved data
+
+        if path is not None:
+            with io.open (path, 'rb', buffering = 0) as stream:
+                self.chunks_read (stream, os.fstat (stream.fileno ()).st_size)
+
+        Store.__init__ (self, offset, cow, size_classes, slab, dedup)
+
+    def SaveByOffset (self, offset, data):
+        data_size = len (data)
+        data_end = offset + data_size
+        if data_end > self.size:
+            self.chunks_reserve (data_end)
+            self.size = data_end
+
+        index, chunk_offset = self.chunk_locate (offset)
+        chunk = self.chunks [index]
+        if chunk_offset + data_size <= len (chunk):
+            chunk [chunk_offset:chunk_offset + data_size] = data
+        else:
+            data = memoryview (data)
+            data_offset = 0
+            while data_offset < data_size:
+                chunk = self.chunks [index]
+                piece_size = min (len (chunk) - chunk_offset, data_size - data_offset)
+                chunk [chunk_offset:chunk_offset + piece_size] = data [data_offset:data_offset + piece_size]
+                data_offset += piece_size
+                index, chunk_offset = index + 1, 0
+        return data_size
+
+    def SaveByOffsetVector (self, offset, datas):
+        size = 0
+        for data in datas:
+            size += self.SaveByOffset (offset + size, data)
+        return size
+
+    def LoadByOffset (self, offset, size):
+        end = min (offset + size, self.size)
+        if offset >= end:
+            return b''
+
+        index, chunk_offset = self.chunk_locate (offset)
+        chunk = self.chunks [index]
+        if chunk_offset + end - offset <= len (chunk):
+            data = chunk [chunk_offset:chunk_offset + end - offset]
+            return data if self.load_view else data.tobytes ()
+
+        # data crosses chunk boundary
+        pieces = []
+        while offset < end:
+            chunk = self.chunks [index]
+            piece_size = min (len (chunk) - chunk_offset, end - offset)
+            pieces.append (chunk [chunk_offset:chunk_offset + piece_size].tobytes ()) # python 2 can not join views
+            offset += piece_size
+            index, chunk_offset = index + 1, 0
+        return b''.join (pieces)
+
+    def Dump (self, path):
+        """Flush and save store content to the file
+
+        Saved file can be opened by file store as well.
+        """
+        self.Flush ()
+        with io.open (path, 'wb', buffering = 0) as stream:
+            size = self.size
+            for chunk in self.chunks:
+                if size <= 0:
+                    break
+                chunk = chunk [:size]
+                written = 0
+                while written < len (chunk):
+                    written += stream.write (chunk [written:])
+                size -= len (chunk)
+
+    #--------------------------------------------------------------------------#
+    # Private                                                                  #
+    #--------------------------------------------------------------------------#
+    def chunk_locate (self, offset):
+        """Find chunk index and offset inside of this chunk
+        """
+        offset -= self.chunk_base
+        if offset < 0:
+            return 0, offset + self.chunk_base
+        return (offset >> self.chunk_order) + 1, offset & ((1 << self.chunk_order) - 1)
+
+    def chunks_reserve (self, size):
+        """Allocate chunks to hold at least size bytes
+        """
+        count = ((size - self.chunk_base + (1 << self.chunk_order) - 1) >> self.chunk_order) + 1
+        while len (self.chunks) < count:
+            self.chunks.append (memoryview (bytearray (1 << self.chunk_order)))
+
+    def chunks_read (self, stream, size):
+        """Read size bytes of content from the stream into chunks
+        """
+        self.chunks_reserve (size)
+        self.size = size
+        for chunk in self.chunks:
+            if size <= 0:
+                break
+            chunk = chunk [:size]
+            read = 0
+            while read < len (chunk):
+                count = stream.readinto (chunk [read:])
+                if not count:
+                    raise ValueError ('Unexpected end of file')
+                read += count
+            size -= len (chunk)
+
+# vim: nu ft=python columns=120 :
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from .wal import StoreWAL
+from .stream import FileStore, file_open
+from ..lock import RWLock
+
+__all__ = ('StoreFollower',)
+#------------------------------------------------------------------------------#
+# Store Follower                                                               #
+#------------------------------------------------------------------------------#
+class StoreFollower (object):
+    """Follower of the replicated store
+
+    Applies log shipped by the primary store (see Store.Replicate) to its own
+    file, and serves read-only store which is reopened after each applied
+    commit (flush of the primary). Writes of a frame are applied only when
+    frame with the header (commit) is received, and they are applied under
+    writer lock, so readers (see Reader) always see committed state. Store
+    and data loaded from it (mappings, streams) must not be used outside of
+    the reader context.
+
+    Frames received before the first commit (content shipped by full
+    replication) are applied immediately.
+    """
+    read_size = 1 << 16
+
+    def __init__ (self, path, offset = None):
+        self.path = path
+        self.offset = offset
+        self.header_offset = offset or 0
+
+        self.stream = file_open (path, 'c')
+        self.lock = RWLock ()
+        self.buffer = b''  # received data which does not contain complete frame
+        self.pending = []  # writes of received frames without header
+        self.commits = 0   # number of applied commits
+
+        self.store = FileStore (path, 'r', offset)
+
+    #--------------------------------------------------------------------------#
+    # Properties                                                               #
+    #--------------------------------------------------------------------------#
+    @property
+    def Commits (self):
+        """Number of applied commits
+        """
+        return self.commits
+
+    #--------------------------------------------------------------------------#
+    # Apply                                                                    #
+    #--------------------------------------------------------------------------#
+    def Apply (self, data):
+        """Apply received part of the log
+
+        Incomplete frame is kept until the rest of it is received. Returns
+        number of applied commits.
+        """
+        def buffer_load (offset, size):
+            return buffer [offset:offset + size]
+
+        buffer = self.buffer + data if self.buffer else data
+        offset, commits = 0, 0
+        while True:
+            writes, frame_size = StoreWAL.FrameDecode (buffer_load, offset)
+            if writes is None:
+                frame_struct = StoreWAL.frame_struct
+                if len (buffer) - offset >= frame_struct.size:
+                    magic, payload_size, _ = frame_struct.unpack_from (buffer, offset)
+                    if magic != StoreWAL.frame_magic or len (buffer) - offset >= frame_struct.size + payload_size:
+                        raise ValueError ('Replication log is corrupted')
+                break
+            offset += frame_size
+
+            self.pending.extend (writes)
+            if writes [-1][0] == self.header_offset:
+                self.commit ()
+                commits += 1
+            elif not self.commits:
+                self.commit (False)
+
+        self.buffer = buffer [offset:]
+        return commits
+
+    def Follow (self, stream):
+        """Apply log read from the stream until it is exhausted
+
+        Returns number of applied commits.
+        """
+        commits = 0
+        while True:
+            data = stream.read (self.read_size)
+            if not data:
+                return commits
+            commits += self.Apply (data)
+
+    #--------------------------------------------------------------------------#
+    # Reader                                                                   #
+    #--------------------------------------------------------------------------#
+    def Reader (self):
+        """Reader context
+
+        Returns read-only store, which is not changed until context is exited.
+        """
+        return StoreFollowerReader (self)
+
+    #--------------------------------------------------------------------------#
+    # Dispose                                                                  #
+    #--------------------------------------------------------------------------#
+    def Dispose (self):
+        """Close follower
+        """
+        with self.lock.Writer ():
+            if self.store is not None:
+                self.store.Dispose ()
+                self.store = None
+            self.stream.close ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, et, eo, tb):
+        self.Dispose ()
+        return False
+
+    #--------------------------------------------------------------------------#
+    # Private                                                                  #
+    #--------------------------------------------------------------------------#
+    def commit (self, reopen = True):
+        """Write pending writes to the file and reopen store
+        """
+        writes, self.pending = self.pending, []
+        with self.lock.Writer ():
+            # store is disposed before its data is changed, as its disposables
+            # (mappings) compare their state with the stored one
+            if reopen:
+                self.store.Dispose ()
+            for offset, data in writes:
+                self.stream.seek (offset)
+                data = memoryview (data)
+                while data:
+                    data = data [self.stream.write (data):]
+            if reopen:
+                self.store = FileStore (self.path, 'r', self.offset)
+                self.commits += 1
+
+#------------------------------------------------------------------------------#
+# Store Follower Reader                                                        #
+#------------------------------------------------------------------------------#
+class StoreFollowerReader (object):
+    """Store follower reader context
+    """
+    __slots__ = ('follower',)
+
+    def __init__ (self, follower):
+        self.follower = follower
+
+    def __enter__ (self):
+        self.follower.lock.ReaderAcquire ()
+        return self.follower.store
+
+    def __exit__ (self, et, eo, tb):
+        self.follower.lock.ReaderRelease ()
+        return False
+
+# vim: nu ft=python columns=120 :
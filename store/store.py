@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 import io
+import zlib
+import time
 import struct
+import hashlib
+import binascii
+import threading
+from collections import OrderedDict
 
-from .alloc import StoreBlock, StoreAllocator
+from .alloc import (StoreBlock, StoreAllocator, desc_order, desc_offset, desc_used, desc_size,
+                    descs_size, descs_locations)
+from .wal import StoreWAL
 from ..serialize import Serializer
 
 __all__ = ('Store',)
@@ -15,34 +23,72 @@ class Store (object):
     Data can be named and unnamed. Named data addressed by its name.
     Unnamed data addressed by its descriptor which can change if data changed.
     Descriptor is an unsigned 64-bit integer.
+
+    If cow is set, store works in copy-on-write mode: saved blocks always go
+    to space allocated since the last flush, so committed state is never
+    overwritten and can be read by snapshots (see Snapshot) while store is
+    being changed.
+
+    If size_classes is set, allocator rounds sizes up to quarter steps between
+    powers of two instead of powers of two (see StoreAllocator). This mode is
+    persisted, so it is only needed to be set once.
+
+    If slab is set, data of at most ``slab_max`` bytes is packed into slots of
+    shared slab pages (slots of a page have the same size, which is a multiple
+    of 16 bytes, and page header is a bitmap of used slots). Slot descriptors
+    are understood by Load and Delete as any other descriptors. Slab slots are
+    never relocated by Compact, and slab packing can not be used with
+    copy-on-write (slots are updated in place).
+
+    If dedup is set, saved data of at least ``dedup_min`` bytes is
+    deduplicated: identical data is stored once and its descriptor is reference
+    counted (see dedup_save). Deduplication index is stored as a B+Tree under
+    ``dedup_name`` name, and once it exists it is used by Delete regardless of
+    the dedup flag. Deduplicated data is never relocated by Compact.
+
+    Changes can be tracked since named checkpoints (see Checkpoint), which
+    allows to write only changed ranges of the store into a delta (see Delta)
+    and to apply it to a copy of the store (see DeltaApply).
+
+    Changes can be shipped to followers as they are flushed (see Replicate and
+    StoreFollower).
+
+    If readonly is set, store can not be changed and flush does nothing. Store
+    is opened by reading its header only: allocator state is never loaded
+    unless statistics are requested, and names directory is loaded on first
+    access to names.
     """
 
     header_struct = struct.Struct ('>QQ')
     desc_struct = struct.Struct ('>Q')
+    names_magic = b'\xffnames\x00'
+    alloc_magic = b'\xffalloc'
+    alloc_page_struct = struct.Struct ('>QQ')
 
-    def __init__ (self, offset = None):
-        offset = offset or 0
+    load_gap = 1 << 12 # blocks separated by smaller gap are loaded together
+    load_max = 1 << 20 # maximum size of single coalesced load
+    save_gap = 1 << 12 # maximum unused tail of the block padded to merge writes
 
-        self.offset = offset + self.header_struct.size
-        self.disposables = []
+    slab_page_order = 12 # size of the slab page
+    slab_max = 1 << 8    # maximum size of data packed into slab
 
-        header = self.LoadByOffset (offset, self.header_struct.size)
-        self.alloc_desc, self.names_desc = self.header_struct.unpack (header) if header else (0, 0)
+    dedup_name = b'.dedup'
+    dedup_min = 1 << 8        # minimum size of deduplicated data
+    dedup_struct = struct.Struct ('>QQ') # descriptor, references count
 
-        # allocator
-        if self.alloc_desc:
-            self.alloc = StoreAllocator.FromStream (io.BytesIO (self.Load (self.alloc_desc)))
-        else:
-            self.alloc = StoreAllocator ()
+    track_name = b'.track'
+    track_order = 16 # size of the range tracked by a bit of checkpoint bitmap
 
-        # names
-        if self.names_desc:
-            serialzer = Serializer (io.BytesIO (self.Load (self.names_desc)))
-            self.names = dict (zip (
-                serialzer.BytesListRead (),                   # names
-                serialzer.StructListRead (self.desc_struct))) # descriptors
-        else:
-            self.names = {}
+    def __init__ (self, offset = None, cow = None, size_classes = None, slab = None, dedup = None,
+                  readonly = None):
+        offset = offset or 0
+        if cow and slab:
+            raise ValueError ('Slab packing can not be used with copy-on-write')
+
+        header = self.LoadByOffset (offset, self.header_struct.size)
+        alloc_desc, names_desc = self.header_struct.unpack (header) if header else (0, 0)
+        self.state_init (offset + self.header_struct.size, alloc_desc, names_desc,
+                         cow, size_classes, slab, dedup, readonly)
 
     #--------------------------------------------------------------------------#
     # Load                                                                     #
@@ -52,9 +98,41 @@ class Store (object):
         """
         if not desc:
             return b''
+        if self.batch_writes:
+            self.batch_flush ()
 
-        block = StoreBlock.FromDesc (desc)
-        return self.LoadByOffset (self.offset + block.offset, block.used)
+        return self.LoadByOffset (self.offset + desc_offset (desc), desc_used (desc))
+
+    def LoadMany (self, descs):
+        """Load data by descriptors
+
+        Blocks are sorted by offset and neighbour blocks (separated by less then
+        ``load_gap`` bytes) are loaded by single read. Returns list of data in
+        order of descriptors, each item has the same type as data returned by
+        Load.
+        """
+        datas = [b''] * len (descs)
+        if self.batch_writes:
+            self.batch_flush ()
+
+        blocks = descs_locations (descs)
+        if not blocks:
+            return datas
+        blocks.sort ()
+
+        run = [blocks [0]]
+        run_end = blocks [0][0] + blocks [0][1]
+        for block in blocks [1:]:
+            offset, used, index = block
+            if offset - run_end < self.load_gap and offset + used - run [0][0] <= self.load_max:
+                run.append (block)
+                run_end = max (run_end, offset + used)
+            else:
+                self.load_run (run, run_end, datas)
+                run, run_end = [block], offset + used
+        self.load_run (run, run_end, datas)
+
+        return datas
 
     def LoadByName (self, name):
         """Load data by name
@@ -78,13 +156,23 @@ class Store (object):
         """Save data by descriptor
 
         Try to save data inside space pointed by descriptor and
-        if its not enough allocate new space. Returns descriptor of saved data
+        if its not enough allocate new space. Data is either bytes like object
+        or a sequence (list or tuple) of them. Returns descriptor of saved data
         """
-        if not data:
+        if isinstance (data, (list, tuple)):
+            datas, data_size = data, sum (len (data) for data in data)
+        else:
+            datas, data_size = None, len (data)
+        if not data_size:
             return 0
 
-        block = self.ReserveBlock (len (data), desc)
-        self.SaveByOffset (self.offset + block.offset, data)
+        if self.dedup and data_size >= self.dedup_min:
+            desc_dedup = self.dedup_save (data, datas, data_size, desc)
+            if desc_dedup is not None:
+                return desc_dedup
+
+        block = self.ReserveBlock (data_size, desc)
+        self.block_write (block, data, datas)
         return block.ToDesc ()
 
     def SaveByName (self, name, data):
@@ -93,7 +181,14 @@ class Store (object):
         if not data:
             self.DeleteByName (name)
         else:
-            self.names [name] = self.Save (data, self.names.get (name))
+            desc = self.names.get (name)
+            desc_new = self.Save (data, desc)
+            if desc != desc_new:
+                self.names [name] = desc_new
+                if self.names_size is not None:
+                    self.names_size += desc_size (desc_new)
+                    if desc:
+                        self.names_size -= desc_size (desc)
         return data
 
     def __setitem__ (self, name, data):
@@ -106,6 +201,23 @@ class Store (object):
         """
         raise NotImplementedError ()
 
+    def SaveByOffsetVector (self, offset, datas):
+        """Save sequence of data continuously starting from offset
+        """
+        return self.SaveByOffset (offset, b''.join (datas))
+
+    #--------------------------------------------------------------------------#
+    # Batch                                                                    #
+    #--------------------------------------------------------------------------#
+    def Batch (self):
+        """Batch context
+
+        Data saved inside batch context is queued, and written when outermost
+        batch context exits or queued data is about to be loaded. Queued writes
+        are sorted by offset and neighbour writes are merged.
+        """
+        return StoreBatch (self)
+
     #--------------------------------------------------------------------------#
     # Delete                                                                   #
     #--------------------------------------------------------------------------#
@@ -114,10 +226,12 @@ class Store (object):
 
         Free space occupied by data pointed by descriptor
         """
-        if not desc:
+        if self.readonly:
+            raise ValueError ('Store is read-only')
+        if not desc or self.dedup_release (desc):
             return
 
-        self.alloc.Free (StoreBlock.FromDesc (desc))
+        self.block_free (desc)
 
     def DeleteByName (self, name):
         """Delete data by name
@@ -125,6 +239,8 @@ class Store (object):
         desc = self.names.pop (name, None)
         if desc:
             self.Delete (desc)
+            if self.names_size is not None:
+                self.names_size -= desc_size (desc)
 
     def __delitem__ (self, name):
         """Delete data by name
@@ -139,57 +255,420 @@ class Store (object):
 
         Returns store's block descriptor.
         """
+        if desc and self.dedup_release (desc):
+            desc = None
         return self.ReserveBlock (size, desc).ToDesc ()
 
     def ReserveBlock (self, size, desc = None):
         """Reserve space without actually writing anything in it
 
+        If desc is set, its block is reused if data fits, otherwise it is grown
+        in place if space following it is free (see StoreAllocator.Realloc), and
+        its unused tail is freed if data fits into its half. Deduplicated block
+        is shared, so its reference is released and new block is allocated.
         Return store block.
         """
+        if self.readonly:
+            raise ValueError ('Store is read-only')
+
+        if desc and self.dedup_release (desc):
+            desc = None
+
+        block = None
         if desc:
-            block = StoreBlock.FromDesc (desc)
-            if block.size >= size:
-                block.used = size
-                return block
-            self.alloc.Free (block)
+            # previous block is only built if it is kept
+            order, offset, size_prev = desc_order (desc), desc_offset (desc), desc_size (desc)
+            slab = order == StoreBlock.slab_order
+            # block can be changed in place (resized or reused)
+            inplace = (not self.cow or offset in self.cow_fresh)
+            resizable = (inplace and self.realloc and not slab and not self.compacting and
+                         not (self.slab and size <= self.slab_max))
+            if size_prev >= size:
+                if self.compacting and not slab:
+                    # move block towards the start of the store
+                    block = self.alloc.AllocByOrder (order, offset, desc >> 62)
+                if block is None and inplace:
+                    block_prev = StoreBlock.FromDesc (desc)
+                    if resizable and size <= size_prev >> 1:
+                        # return unused tail of the block to free space
+                        block_prev = self.alloc.Realloc (block_prev, size)
+                    self.alloc.Use (size - block_prev.used)
+                    block_prev.used = size
+                    return block_prev
+            elif resizable:
+                # grow block in place, so its offset is kept
+                block = self.alloc.Realloc (StoreBlock.FromDesc (desc), size)
+                if block is not None:
+                    self.alloc.Use (size - block.used)
+                    block.used = size
+                    return block
+            self.block_free (desc)
 
-        block = self.alloc.Alloc (size)
+        if block is None:
+            block = (self.slab_reserve (size) if self.slab and size <= self.slab_max else
+                     self.alloc.Alloc (size))
         block.used = size
+        self.alloc.Use (size)
+        if self.cow:
+            self.cow_fresh.add (block.offset)
         return block
 
+    #--------------------------------------------------------------------------#
+    # Compact                                                                  #
+    #--------------------------------------------------------------------------#
+    def Compact (self, budget = None):
+        """Move data towards the start of the store
+
+        Data is moved by relocators (see RelocatorRegister) of the descriptors
+        owners, named data is moved by the store itself. If budget (in seconds)
+        is set, compaction is suspended when it is exhausted, and resumed by the
+        next call. Returns True if compaction is complete.
+        """
+        if self.compact_queue is None:
+            self.compact_queue = [self.names_relocate ()]
+            self.compact_queue.extend (relocator () for relocator in self.relocators)
+        deadline = None if budget is None else time.time () + budget
+
+        self.compacting = True
+        try:
+            queue = self.compact_queue
+            while queue:
+                for _ in queue [0]:
+                    if deadline is not None and time.time () >= deadline:
+                        break
+                else:
+                    queue.pop (0)
+                    continue
+                break
+            else:
+                self.compact_queue = None
+
+            # names and allocator state are moved as well
+            self.Flush ()
+        finally:
+            self.compacting = False
+
+        return self.compact_queue is None
+
+    def Relocate (self, desc):
+        """Move data to the free block with lower offset if there is one
+
+        Returns new descriptor of the data.
+        """
+        if self.readonly:
+            raise ValueError ('Store is read-only')
+
+        order = desc_order (desc)
+        if order == StoreBlock.slab_order or self.dedup_lookup (desc) is not None:
+            return desc
+        block = self.alloc.AllocByOrder (order, desc_offset (desc), desc >> 62)
+        if block is None:
+            return desc
+
+        block.used = desc_used (desc)
+        self.alloc.Use (block.used)
+        if self.cow:
+            self.cow_fresh.add (block.offset)
+        self.block_write (block, bytes (self.Load (desc)))
+        self.block_free (desc)
+        return block.ToDesc ()
+
+    def Relocatable (self, desc):
+        """Check if data can be moved to the lower offset
+        """
+        order = desc_order (desc)
+        return (order != StoreBlock.slab_order and self.alloc.Lowest (order, desc_offset (desc)) is not None and
+                self.dedup_lookup (desc) is None)
+
+    def RelocatorRegister (self, relocator):
+        """Register relocator
+
+        Relocator is a callable which returns an iterable, each iteration
+        relocates some of the owned data (see Relocate) and updates its
+        descriptors.
+        """
+        self.relocators.append (relocator)
+
+    def RelocatorUnregister (self, relocator):
+        """Unregister relocator
+        """
+        self.relocators.remove (relocator)
+
     #--------------------------------------------------------------------------#
     # Flush                                                                    #
     #--------------------------------------------------------------------------#
     def Flush (self):
         """Flush current state
         """
-        # names
-        if self.names:
-            serializer = Serializer (io.BytesIO ())
-            serializer.BytesListWrite (tuple (self.names.keys ()))
-            serializer.StructListWrite (tuple (self.names.values ()), self.desc_struct)
-            self.names_desc = self.Save (serializer.Stream.getvalue (), self.names_desc)
+        if self.readonly:
+            return
 
-        else:
-            self.Delete (self.names_desc)
-            self.names_desc = 0
+        with self.Batch ():
+            self.flush_blocks ()
+
+            # blocks must be written before header which references them
+            self.batch_flush ()
+
+            # header (always included in delta)
+            header = self.header_struct.pack (self.alloc_desc, self.names_desc)
+            self.SaveByOffset (self.offset - self.header_struct.size, header)
+
+        if self.replica is not None:
+            self.replica_ship (header)
+        if self.cow:
+            self.cow_commit ()
+
+    def flush_blocks (self):
+        """Save tracking state, deduplication index, names and allocator state
+        """
+        # internal data is never deduplicated, so its blocks are not looked up
+        # in the deduplication index (which can be being saved)
+        dedup, self.dedup, self.dedup_updating = self.dedup, False, True
+        try:
+            # saved tracking state must cover writes of this flush too, so it is
+            # saved until flush does not change ranges which has not been changed
+            while True:
+                self.track_save ()
+                self.flush_names ()
+
+                # allocator has not been loaded, so it has not been changed
+                alloc = self.allocator
+                if alloc is not None:
+                    # allocator state is never packed into slabs, so space it
+                    # occupies is known (see alloc_size), and its blocks are
+                    # never resized in place, as resizing changes allocator
+                    # state being saved
+                    slab, self.slab, self.realloc = self.slab, False, False
+                    try:
+                        self.flush_alloc (alloc)
+                    finally:
+                        self.slab, self.realloc = slab, True
 
+                if not self.track_dirty:
+                    break
+        finally:
+            self.dedup, self.dedup_updating = dedup, False
+
+    def flush_names (self):
+        """Save deduplication index, names and headers of slab pages
+        """
+        # deduplication index
+        if self.dedup_mapping is not None and self.dedup_mapping is not False:
+            if len (self.dedup_mapping):
+                self.dedup_mapping.Flush ()
+            else:
+                self.dedup_mapping.Drop ()
+                self.dedup_mapping = None
+
+        # names (only dirty nodes are saved, names have not been changed if
+        # they have not been loaded)
+        names = self.names_mapping
+        if names is None:
+            pass
+        elif len (names):
+            names.Flush ()
+        elif self.names_desc:
+            names.Drop ()
+
+        # headers of slab pages
+        if self.slab_dirty:
+            for offset in self.slab_dirty:
+                slot, bitmap = self.slab_pages [offset]
+                header = self.slab_header (slot, bitmap)
+                self.block_write (StoreBlock ((self.slab_layout (slot) [2] >> 4) - 1, offset, len (header), 0, True),
+                                  header)
+            self.slab_dirty.clear ()
+
+    def flush_alloc (self, alloc):
+        """Save allocator state
+        """
         # Check if nothing is allocated of the only thing allocated is
         # allocator itself.
-        if self.alloc.Size - (StoreBlock.FromDesc (self.alloc_desc).size if self.alloc_desc else 0):
+        if alloc.Size - self.alloc_size ():
+            # save dirty regions and directory until saving does not change
+            # allocator state any more
+            pages = self.alloc_pages
             while True:
-                alloc_state = self.alloc.ToStream (io.BytesIO ()).getvalue ()
-                self.alloc_desc, alloc_desc = self.Save (alloc_state, self.alloc_desc), self.alloc_desc
-                if self.alloc_desc == alloc_desc:
+                while alloc.dirty:
+                    region = alloc.dirty.pop ()
+                    region_descs = alloc.RegionDescs (region)
+                    if region_descs:
+                        page = Serializer (io.BytesIO ())
+                        page.StructListWrite (region_descs, self.desc_struct)
+                        pages [region] = self.Save (page.Stream.getvalue (), pages.get (region))
+                    else:
+                        self.Delete (pages.pop (region, 0))
+
+                directory = Serializer (io.BytesIO ())
+                directory.Stream.write (self.alloc_magic)
+                slab_offsets = self.slab_offsets if self.slab_pages is None else sorted (self.slab_pages)
+                directory.Stream.write (struct.pack ('B', (1 if alloc.size_classes else 0) |
+                                                         (0 if alloc.orders_size is None else 2) |
+                                                         (4 if slab_offsets else 0)))
+                directory.StructListWrite (sorted (pages.items ()), self.alloc_page_struct, True)
+                if alloc.orders_size is not None:
+                    directory.StructListWrite ([alloc.requested] + alloc.orders_size, self.desc_struct)
+                if slab_offsets:
+                    directory.StructListWrite (slab_offsets, self.desc_struct)
+                if self.cow_freed:
+                    directory.StructListWrite ([desc for generation, desc in self.cow_freed], self.desc_struct)
+                directory = directory.Stream.getvalue ()
+                if directory == self.alloc_directory and not alloc.dirty:
                     break
+                self.alloc_desc = self.Save (directory, self.alloc_desc)
+                self.alloc_directory = directory
         else:
-            alloc_desc, self.alloc_desc = self.alloc_desc, 0
-            self.Delete (alloc_desc)
-            assert not self.alloc.Size, 'Allocator is broken'
+            for desc in self.alloc_pages.values ():
+                self.Delete (desc)
+            self.alloc_pages.clear ()
+            self.Delete (self.alloc_desc)
+            self.alloc_desc = 0
+            self.alloc_directory = None
+            alloc.dirty.clear ()
+            assert not alloc.Size, 'Allocator is broken'
+
+    #--------------------------------------------------------------------------#
+    # Snapshot                                                                 #
+    #--------------------------------------------------------------------------#
+    def Snapshot (self):
+        """Create read-only snapshot of the last committed (flushed) state
+
+        Available only in copy-on-write mode, where committed blocks are never
+        overwritten and freed blocks are released only when no snapshot can
+        reference them. Snapshot must be disposed to release its blocks.
+        """
+        if not self.cow:
+            raise ValueError ('Snapshot requires copy-on-write store')
+
+        with self.cow_lock:
+            generation = self.generation
+            self.cow_pins [generation] = self.cow_pins.get (generation, 0) + 1
+            alloc_desc, names_desc = self.committed
+
+        return StoreSnapshot (self, generation, names_desc)
+
+    #--------------------------------------------------------------------------#
+    # Checkpoint                                                               #
+    #--------------------------------------------------------------------------#
+    def Checkpoint (self, name):
+        """Start (or restart) tracking of changes since checkpoint
+
+        Changed ranges are tracked by ``1 << track_order`` bytes, they are
+        marked by writes of blocks and tracking state is persisted on flush.
+        Copy of the store made once checkpoint has been flushed can be updated
+        by deltas (see Delta).
+        """
+        self.track_get () [name] = bytearray ()
+        self.track_dirty = True
+
+    def CheckpointDrop (self, name):
+        """Stop tracking of changes since checkpoint
+        """
+        if self.track_get ().pop (name, None) is not None:
+            self.track_dirty = True
+
+    def Checkpoints (self):
+        """Names of checkpoints
+        """
+        return list (self.track_get ())
+
+    def Delta (self, name, stream):
+        """Write delta since checkpoint to the stream and restart checkpoint
+
+        Store is flushed, and its ranges changed since the checkpoint followed by
+        the header are written as a sequence of write-ahead log frames (see
+        StoreWAL), each of them is at most ``load_max`` bytes. Copy of the store
+        made at the checkpoint (or with previous delta applied) becomes the copy
+        of the current store once delta is applied (see DeltaApply). Returns
+        size of the delta.
+        """
+        bitmap = self.track_get ().get (name)
+        if bitmap is None:
+            raise ValueError ('Unknown checkpoint: {}'.format (name))
+        self.Flush ()
+
+        size = 0
+        writes, writes_size = [], 0
+        for offset, range_size in self.track_ranges (bitmap):
+            while range_size > 0:
+                data = self.LoadByOffset (offset, min (range_size, self.load_max))
+                if not data:
+                    break # beyond the end of the store
+                writes.append ((offset, data))
+                writes_size += len (data)
+                offset += len (data)
+                range_size -= len (data)
+                if writes_size >= self.load_max:
+                    size += stream.write (StoreWAL.FrameEncode (writes))
+                    writes, writes_size = [], 0
+
+        header_offset = self.offset - self.header_struct.size
+        writes.append ((header_offset, self.LoadByOffset (header_offset, self.header_struct.size)))
+        size += stream.write (StoreWAL.FrameEncode (writes))
+
+        self.Checkpoint (name)
+        return size
+
+    @classmethod
+    def DeltaApply (cls, delta, stream):
+        """Apply delta (see Delta) read from delta stream to the stream with copy of the store
+
+        Returns number of applied frames.
+        """
+        def delta_load (offset, size):
+            delta.seek (offset)
+            return delta.read (size)
+
+        # delta is applied only if all its frames are complete
+        frames = []
+        offset = 0
+        while True:
+            writes, frame_size = StoreWAL.FrameDecode (delta_load, offset)
+            if writes is None:
+                break
+            frames.append (offset)
+            offset += frame_size
+        if delta_load (offset, 1):
+            raise ValueError ('Delta is corrupted')
 
-        # header
-        self.SaveByOffset (self.offset - self.header_struct.size,
-            self.header_struct.pack (self.alloc_desc, self.names_desc))
+        for offset in frames:
+            for write_offset, data in StoreWAL.FrameDecode (delta_load, offset) [0]:
+                stream.seek (write_offset)
+                data = memoryview (data)
+                while data:
+                    size = stream.write (data)
+                    if size is None:
+                        break # file object of python 2 always writes all data
+                    data = data [size:]
+        return len (frames)
+
+    #--------------------------------------------------------------------------#
+    # Replication                                                              #
+    #--------------------------------------------------------------------------#
+    def Replicate (self, stream, full = None):
+        """Ship changes to the stream read by follower (see StoreFollower)
+
+        Store is flushed, then each flush writes a write-ahead log frame (see
+        StoreWAL) of writes made since previous flush followed by the header to
+        the stream. If full is set, current content of the store is shipped
+        first, so follower can start with an empty file, otherwise follower
+        must start with a copy of the store. Replication is stopped if stream
+        is None.
+        """
+        self.Flush ()
+        self.replica, self.replica_header = stream, None
+        self.replica_writes.clear ()
+        if stream is None or not full:
+            return
+
+        offset, end = self.offset, self.offset + self.alloc.End
+        while offset < end:
+            data = self.LoadByOffset (offset, min (end - offset, self.load_max))
+            if not data:
+                break
+            stream.write (StoreWAL.FrameEncode (((offset, data),)))
+            offset += len (data)
+        self.replica_ship (self.LoadByOffset (self.offset - self.header_struct.size, self.header_struct.size))
 
     #--------------------------------------------------------------------------#
     # Size                                                                     #
@@ -201,17 +680,43 @@ class Store (object):
         size = 0
 
         # allocator
-        if self.alloc_desc:
-            size += StoreBlock.FromDesc (self.alloc_desc).size
+        size += self.alloc_size ()
 
         # names
         if self.names_desc:
-            size += StoreBlock.FromDesc (self.names_desc).size
+            size += desc_size (self.names_desc)
+            size += self.names.SizeOnStore
+
+        return self.alloc.Size - size - self.names_values_size ()
 
-        for desc in self.names.values ():
-            size += StoreBlock.FromDesc (desc).size
+    def Stats (self):
+        """Space usage statistics
 
-        return self.alloc.Size - size
+        Returns allocator statistics (see StoreAllocator.Stats) extended with
+        number of names and space used by internal storage data (allocator
+        state and names directory). All values are maintained incrementally.
+        """
+        stats = self.alloc.Stats () # allocator must be loaded before slabs
+        stats ['names'] = len (self.names)
+        stats ['slab_pages'] = len (self.slab_offsets if self.slab_pages is None else self.slab_pages)
+        stats ['internal'] = self.alloc.Size - self.Size - self.names_values_size ()
+        return stats
+
+    #--------------------------------------------------------------------------#
+    # Instrument                                                               #
+    #--------------------------------------------------------------------------#
+    def Instrument (self, instrument = None):
+        """Attach instrument (see StoreInstrument)
+
+        Currently attached instrument is detached, so if instrument is None
+        instrumentation is disabled. Returns attached instrument.
+        """
+        if self.instrument is not None:
+            self.instrument.Detach (self)
+        self.instrument = instrument
+        if instrument is not None:
+            instrument.Attach (self)
+        return instrument
 
     #--------------------------------------------------------------------------#
     # Named Objects                                                            #
@@ -233,13 +738,14 @@ class Store (object):
                     self.SaveByName (name, value))
         return cell
 
-    def Mapping (self, name, order = None, key_type = None, value_type = None, compress = None):
+    def Mapping (self, name, order = None, key_type = None, value_type = None, compress = None,
+                 concurrent = None):
         """Create name mapping (B+Tree)
         """
         from ..mapping import StoreMapping
 
         cell = self.Cell ('.mapping:{}'.format (name))
-        mapping = StoreMapping (self, cell, order, key_type, value_type, compress)
+        mapping = StoreMapping (self, cell, order, key_type, value_type, compress, concurrent)
         self.disposables.append (mapping)
         return mapping
 
@@ -273,4 +779,646 @@ class Store (object):
         self.Dispose ()
         return False
 
+    #--------------------------------------------------------------------------#
+    # Private                                                                  #
+    #--------------------------------------------------------------------------#
+    def state_init (self, offset, alloc_desc, names_desc, cow = None, size_classes = None, slab = None,
+                    dedup = None, readonly = None):
+        """Initialize state of the store (shared by store and its snapshots)
+
+        Offset is the offset of the data (after the header), alloc_desc and
+        names_desc are descriptors loaded from the header.
+        """
+        self.offset = offset
+        self.disposables = []
+        self.readonly = bool (readonly)
+
+        self.batch_depth = 0
+        self.batch_writes = []
+
+        # copy-on-write
+        self.cow = bool (cow)
+        self.cow_lock = threading.Lock ()
+        self.cow_fresh = set ()  # offsets of blocks allocated since last commit
+        self.cow_freed = []      # (generation, desc) of freed committed blocks
+        self.cow_pins = {}       # generation -> number of snapshots
+        self.generation = 0
+
+        # compaction
+        self.relocators = []
+        self.compacting = False
+        self.compact_queue = None
+
+        # blocks are resized in place (see ReserveBlock)
+        self.realloc = True
+
+        # allocator (loaded on first access)
+        self.alloc_desc, self.names_desc = alloc_desc, names_desc
+        self.size_classes = size_classes
+        self.allocator = None
+        self.alloc_pages = {}        # region -> page descriptor
+        self.alloc_directory = None  # last saved directory
+        self.committed = self.alloc_desc, self.names_desc
+
+        # slabs (loaded on first access)
+        self.slab = bool (slab)
+        self.slab_pages = None   # page offset -> [slot, bitmap of used slots]
+        self.slab_offsets = []   # offsets of pages listed in allocator directory
+        self.slab_free = [set () for _ in range (self.slab_max >> 4)] # slot -> offsets of pages
+        self.slab_dirty = set () # offsets of pages with changed header
+
+        # deduplication
+        self.dedup = bool (dedup)
+        self.dedup_mapping = None   # index (loaded on first access), False if it does not exist
+        self.dedup_updating = False # index is being changed
+
+        # instrumentation (see Instrument)
+        self.instrument = None
+
+        # changes tracking
+        self.track = None        # checkpoint -> bitmap of changed ranges (loaded on first access)
+        self.track_dirty = False # tracking state has been changed since it was saved
+
+        # replication
+        self.replica = None                 # stream which receives log frames (see Replicate)
+        self.replica_writes = OrderedDict () # offset -> data written since last flush
+        self.replica_header = None          # last shipped header
+
+        # names (loaded on first access)
+        self.names_mapping = None
+        self.names_lock = threading.Lock ()
+        self.names_loaded = None # header of names directory loaded by names_open
+        self.names_size = None   # space used by named data (computed on demand)
+
+    @property
+    def names (self):
+        """Names directory (loaded on first access)
+        """
+        names = self.names_mapping
+        if names is None:
+            with self.names_lock:
+                names = self.names_mapping
+                if names is None:
+                    names = self.names_mapping = self.names_open ()
+        return names
+
+    @property
+    def alloc (self):
+        """Allocator (loaded on first access)
+        """
+        alloc = self.allocator
+        if alloc is None:
+            alloc = self.allocator = self.alloc_load ()
+        return alloc
+
+    def alloc_load (self):
+        """Load allocator
+
+        Allocator state is a directory block, which contains descriptors of
+        pages with free blocks of each region, allocator counters (see
+        StoreAllocator.Stats) and offsets of slab pages. Legacy state is a
+        single block with all free blocks.
+        """
+        if not self.alloc_desc:
+            return StoreAllocator (size_classes = self.size_classes)
+
+        alloc_data = self.Load (self.alloc_desc)
+        alloc_stream = io.BytesIO (alloc_data)
+        if bytes (alloc_data [:len (self.alloc_magic)]) == self.alloc_magic:
+            alloc_stream.seek (len (self.alloc_magic))
+            alloc_flags = ord (alloc_stream.read (1))
+            self.alloc_pages = dict (Serializer (alloc_stream).StructListRead (self.alloc_page_struct, True))
+            self.alloc_directory = bytes (alloc_data)
+            regions = sorted (self.alloc_pages)
+            alloc = StoreAllocator.FromStreams (io.BytesIO (page)
+                for page in self.LoadMany ([self.alloc_pages [region] for region in regions]))
+            alloc.size_classes = bool (alloc_flags & 1)
+            if alloc_flags & 2:
+                alloc_stats = Serializer (alloc_stream).StructListRead (self.desc_struct)
+                alloc.requested, alloc.orders_size = alloc_stats [0], list (alloc_stats [1:])
+            if alloc_flags & 4:
+                self.slab_offsets = Serializer (alloc_stream).StructListRead (self.desc_struct)
+        else:
+            alloc = StoreAllocator.FromStream (alloc_stream)
+            alloc.dirty.update (alloc.regions)
+
+        if self.size_classes is not None:
+            alloc.size_classes = bool (self.size_classes)
+
+        # blocks freed by copy-on-write store but not yet released when it
+        # was committed, nothing can reference them anymore
+        if alloc_stream.tell () < len (alloc_data):
+            for desc in Serializer (alloc_stream).StructListRead (self.desc_struct):
+                alloc.FreeDesc (desc)
+
+        return alloc
+
+    def alloc_size (self):
+        """Space used by allocator state
+        """
+        return descs_size ((self.alloc_desc,)) + descs_size (self.alloc_pages.values ())
+
+    def block_write (self, block, data, datas = None):
+        """Write data (or sequence of datas) to the reserved block
+        """
+        offset = self.offset + block.offset
+        if self.track is None or self.track:
+            self.track_mark (offset, block.used)
+        if self.replica is not None:
+            self.replica_writes.pop (offset, None) # reinsert, so writes are ordered by the time of last write
+            self.replica_writes [offset] = bytes (data) if datas is None else b''.join (datas)
+        if self.batch_depth:
+            self.batch_writes.append ((offset, block.used, datas or (data,), offset + block.size))
+        elif datas is None:
+            self.SaveByOffset (offset, data)
+        else:
+            self.SaveByOffsetVector (offset, datas)
+
+    def names_open (self):
+        """Open names directory
+
+        Names directory is a B+Tree (names are loaded lazily), its header is
+        stored in the block pointed by names descriptor. Legacy flat names
+        table is converted when loaded.
+        """
+        from ..mapping import StoreMapping
+
+        names = None
+        if self.names_desc:
+            names_data = self.Load (self.names_desc)
+            if bytes (names_data [:len (self.names_magic)]) != self.names_magic:
+                serialzer = Serializer (io.BytesIO (names_data))
+                names = zip (
+                    serialzer.BytesListRead (),                   # names
+                    serialzer.StructListRead (self.desc_struct))  # descriptors
+            else:
+                # header is passed to the mapping without loading it again
+                self.names_loaded = names_data [len (self.names_magic):]
+
+        mapping = StoreMapping (self, self.names_header, key_type = 'bytes',
+            value_type = 'struct:>Q', compress = 0, concurrent = True)
+        if names is not None:
+            for name, desc in names:
+                mapping [name] = desc
+        return mapping
+
+    def names_header (self, header = None):
+        """Names directory header cell
+        """
+        magic = self.names_magic
+        if header is None:
+            if self.names_loaded is not None:
+                header, self.names_loaded = self.names_loaded, None
+                return header
+            if not self.names_desc:
+                return b''
+            header = self.Load (self.names_desc)
+            return header [len (magic):] if bytes (header [:len (magic)]) == magic else b''
+
+        elif header:
+            self.names_desc = self.Save ((magic, header), self.names_desc)
+        else:
+            self.Delete (self.names_desc)
+            self.names_desc = 0
+        return header
+
+    def slab_load (self):
+        """Load headers of slab pages
+        """
+        if self.allocator is None:
+            # offsets of slab pages are loaded with allocator
+            self.allocator = self.alloc_load ()
+
+        pages, offsets, self.slab_offsets = {}, self.slab_offsets, []
+        header_max = self.slab_layout (0) [1]
+        headers = self.LoadMany ([StoreBlock (self.slab_page_order, offset, header_max).ToDesc ()
+                                  for offset in offsets])
+        for offset, header in zip (offsets, headers):
+            header = bytes (header)
+            slot = ord (header [:1])
+            count, header_size, header_area = self.slab_layout (slot)
+            bitmap = int (binascii.hexlify (header [1:header_size]), 16)
+            pages [offset] = [slot, bitmap]
+            if bitmap != (1 << count) - 1:
+                self.slab_free [slot].add (offset)
+        self.slab_pages = pages
+        return pages
+
+    def slab_layout (self, slot):
+        """Layout of slab page with slots of ``(slot + 1) * 16`` bytes
+
+        Returns number of slots, size of header and size of space reserved for
+        header (slots follow it).
+        """
+        page_size, slot_size = 1 << self.slab_page_order, (slot + 1) << 4
+        header_size = 1 + (page_size // slot_size + 7) // 8
+        header_area = (header_size + 15) & ~15
+        return (page_size - header_area) // slot_size, header_size, header_area
+
+    def slab_header (self, slot, bitmap):
+        """Header of slab page
+        """
+        header_size = self.slab_layout (slot) [1]
+        return struct.pack ('B', slot) + binascii.unhexlify ('{:0{}x}'.format (bitmap, (header_size - 1) * 2))
+
+    def slab_reserve (self, size):
+        """Reserve slot of the slab page
+        """
+        pages = self.slab_load () if self.slab_pages is None else self.slab_pages
+        slot = (size - 1) >> 4
+        count, header_size, header_area = self.slab_layout (slot)
+
+        free = self.slab_free [slot]
+        if free:
+            offset = next (iter (free))
+        else:
+            offset = self.alloc.AllocByOrder (self.slab_page_order).offset
+            pages [offset] = [slot, 0]
+            free.add (offset)
+
+        page = pages [offset]
+        bitmap = page [1]
+        index = (~bitmap & (bitmap + 1)).bit_length () - 1
+        page [1] = bitmap | (1 << index)
+        if page [1] == (1 << count) - 1:
+            free.discard (offset)
+        self.slab_dirty.add (offset)
+
+        return StoreBlock (slot, offset + header_area + index * ((slot + 1) << 4), size, 0, True)
+
+    def slab_release (self, slot_offset, slot_size):
+        """Release slot of the slab page
+
+        Page is freed when its last slot is released.
+        """
+        pages = self.slab_load () if self.slab_pages is None else self.slab_pages
+        offset = slot_offset & ~((1 << self.slab_page_order) - 1)
+        page = pages [offset]
+        slot = page [0]
+        page [1] &= ~(1 << ((slot_offset - offset - self.slab_layout (slot) [2]) // slot_size))
+        if not page [1]:
+            del pages [offset]
+            self.slab_free [slot].discard (offset)
+            self.slab_dirty.discard (offset)
+            self.block_free (StoreBlock (self.slab_page_order, offset).ToDesc ())
+        else:
+            self.slab_free [slot].add (offset)
+            self.slab_dirty.add (offset)
+
+    def dedup_index (self, create = None):
+        """Deduplication index (B+Tree)
+
+        Index maps ``b'h' + digest`` to packed descriptor and references count,
+        and ``b'd' + descriptor`` to digest. Returns None if index does not
+        exist and create is not set.
+        """
+        from ..mapping import StoreMapping
+
+        if self.dedup_mapping is None:
+            self.dedup_mapping = self.dedup_name in self.names
+        if self.dedup_mapping is True or (self.dedup_mapping is False and create):
+            self.dedup_mapping = StoreMapping (self, self.Cell (self.dedup_name), key_type = 'bytes',
+                                               value_type = 'bytes', compress = 0)
+        return None if self.dedup_mapping is False else self.dedup_mapping
+
+    def dedup_lookup (self, desc):
+        """Digest of deduplicated data by its descriptor
+
+        Returns None if data has not been deduplicated.
+        """
+        if self.dedup_updating:
+            # index nodes are released while index is being changed
+            return None
+        index = self.dedup_index ()
+        if index is None:
+            return None
+        return index.get (b'd' + self.desc_struct.pack (desc))
+
+    def dedup_save (self, data, datas, data_size, desc):
+        """Save deduplicated data
+
+        If data with the same digest has already been saved, its references
+        count is incremented and its descriptor is returned, otherwise data is
+        saved as a new block. Previous data (desc) is released. Returns None if
+        previous data has not been deduplicated, so it must be saved in place.
+        """
+        digest = hashlib.sha256 ()
+        for chunk in datas or (data,):
+            digest.update (chunk)
+        digest = digest.digest ()
+
+        if desc:
+            digest_prev = self.dedup_lookup (desc)
+            if digest_prev is None:
+                return None
+            elif digest_prev == digest:
+                return desc
+            self.dedup_release (desc)
+
+        index = self.dedup_index (True)
+        self.dedup_updating = True
+        try:
+            entry = index.get (b'h' + digest)
+            if entry is not None:
+                desc, count = self.dedup_struct.unpack (entry)
+                index [b'h' + digest] = self.dedup_struct.pack (desc, count + 1)
+                return desc
+
+            block = self.ReserveBlock (data_size)
+            self.block_write (block, data, datas)
+            desc = block.ToDesc ()
+            index [b'h' + digest] = self.dedup_struct.pack (desc, 1)
+            index [b'd' + self.desc_struct.pack (desc)] = digest
+            return desc
+        finally:
+            self.dedup_updating = False
+
+    def dedup_release (self, desc):
+        """Release reference to deduplicated data
+
+        Data is freed when the last reference is released. Returns False if
+        data has not been deduplicated.
+        """
+        digest = self.dedup_lookup (desc)
+        if digest is None:
+            return False
+
+        index = self.dedup_mapping
+        self.dedup_updating = True
+        try:
+            desc, count = self.dedup_struct.unpack (index [b'h' + digest])
+            if count > 1:
+                index [b'h' + digest] = self.dedup_struct.pack (desc, count - 1)
+                return True
+            del index [b'h' + digest]
+            del index [b'd' + self.desc_struct.pack (desc)]
+        finally:
+            self.dedup_updating = False
+
+        self.block_free (desc)
+        return True
+
+    def track_get (self):
+        """Tracking state (loaded on first access)
+        """
+        track = self.track
+        if track is None:
+            track = self.track = {}
+            track_desc = self.names.get (self.track_name)
+            if track_desc:
+                serializer = Serializer (io.BytesIO (zlib.decompress (self.Load (track_desc))))
+                track.update (zip (serializer.BytesListRead (),
+                    (bytearray (bitmap) for bitmap in serializer.BytesListRead ())))
+        return track
+
+    def track_save (self):
+        """Save tracking state
+        """
+        if not self.track_dirty:
+            return
+        self.track_dirty = False
+
+        track = self.track
+        if track:
+            names = sorted (track)
+            serializer = Serializer (io.BytesIO ())
+            serializer.BytesListWrite (names)
+            serializer.BytesListWrite ([bytes (track [name]) for name in names])
+            self.SaveByName (self.track_name, zlib.compress (serializer.Stream.getvalue (), 1))
+        else:
+            self.DeleteByName (self.track_name)
+
+    def track_mark (self, offset, size):
+        """Mark range as changed for all checkpoints
+        """
+        track = self.track_get ()
+        if not track or not size:
+            return
+        order = self.track_order
+        begin, end = offset >> order, ((offset + size - 1) >> order) + 1
+        for bitmap in track.values ():
+            if len (bitmap) < (end + 7) >> 3:
+                bitmap.extend (bytearray (((end + 7) >> 3) - len (bitmap)))
+            for index in range (begin, end):
+                bit = 1 << (index & 7)
+                if not bitmap [index >> 3] & bit:
+                    bitmap [index >> 3] |= bit
+                    self.track_dirty = True
+
+    def track_ranges (self, bitmap):
+        """Iterate over (offset, size) of changed ranges of the bitmap
+        """
+        order = self.track_order
+        begin = None
+        for byte_index, byte in enumerate (bytearray (bitmap)):
+            if byte == (0 if begin is None else 0xff):
+                continue
+            for bit in range (8):
+                index = (byte_index << 3) + bit
+                if byte & (1 << bit):
+                    if begin is None:
+                        begin = index
+                elif begin is not None:
+                    yield begin << order, (index - begin) << order
+                    begin = None
+        if begin is not None:
+            yield begin << order, ((len (bitmap) << 3) - begin) << order
+
+    def replica_ship (self, header):
+        """Ship writes made since previous flush and header to the follower
+        """
+        writes, self.replica_writes = self.replica_writes, OrderedDict ()
+        if not writes and header == self.replica_header:
+            return
+        writes [self.offset - self.header_struct.size] = header # header is the last write of the frame
+        self.replica.write (StoreWAL.FrameEncode (writes.items ()))
+        self.replica.flush ()
+        self.replica_header = header
+
+    def names_values_size (self):
+        """Space used by named data (computed once, then maintained)
+        """
+        if self.names_size is None:
+            self.names_size = descs_size (self.names.values ())
+        return self.names_size
+
+    def names_relocate (self):
+        """Relocate named data
+        """
+        name = None
+        while True:
+            for name, desc in self.names.ItemRange (low_key = name):
+                if self.Relocatable (desc):
+                    self.names [name] = self.Relocate (desc)
+                    break
+            else:
+                return
+            yield
+
+    def block_free (self, desc):
+        """Free block by its descriptor
+
+        Committed blocks of copy-on-write store are released only after next
+        commit, when they are not pinned by any snapshot.
+        """
+        self.alloc.Use (-desc_used (desc))
+        offset = desc_offset (desc)
+        if desc_order (desc) == StoreBlock.slab_order:
+            self.slab_release (offset, desc_size (desc))
+            return
+        if self.cow:
+            if offset in self.cow_fresh:
+                self.cow_fresh.discard (offset)
+            else:
+                self.cow_freed.append ((self.generation, desc))
+                return
+        self.alloc.FreeDesc (desc)
+
+    def cow_commit (self):
+        """Start new generation after header has been written
+        """
+        with self.cow_lock:
+            self.generation += 1
+            self.committed = self.alloc_desc, self.names_desc
+            self.cow_fresh.clear ()
+            self.cow_release ()
+
+    def cow_release (self):
+        """Release freed blocks which are not referenced by any snapshot
+        """
+        # block freed in generation is referenced only by this and older generations
+        generation_min = min (self.cow_pins) if self.cow_pins else self.generation
+        freed = []
+        for generation, desc in self.cow_freed:
+            if generation < generation_min:
+                self.alloc.FreeDesc (desc)
+            else:
+                freed.append ((generation, desc))
+        self.cow_freed = freed
+
+    def cow_unpin (self, generation):
+        """Unpin generation referenced by disposed snapshot
+        """
+        with self.cow_lock:
+            count = self.cow_pins.pop (generation) - 1
+            if count:
+                self.cow_pins [generation] = count
+
+    def batch_flush (self):
+        """Write queued writes
+        """
+        writes, self.batch_writes = self.batch_writes, []
+        if not writes:
+            return
+
+        # only the last write to the same offset matters, and items are
+        # reinserted so latest dictionary keeps order of the last writes
+        latest = OrderedDict ()
+        for write in writes:
+            latest.pop (write [0], None)
+            latest [write [0]] = write
+
+        runs = []
+        run_end, run_block_end = None, None
+        for offset, size, datas, block_end in sorted (latest.values (), key = lambda write: write [0]):
+            if offset == run_block_end and offset - run_end <= self.save_gap:
+                # pad unused tail of the previous block
+                if offset > run_end:
+                    runs [-1][1].append (bytes (bytearray (offset - run_end)))
+                runs [-1][1].extend (datas)
+            elif run_end is not None and offset < run_end:
+                # overlapping writes (block has been freed and reused with different
+                # order), keep writes order so the last write wins
+                runs = [(write [0], list (write [2])) for write in latest.values ()]
+                break
+            else:
+                runs.append ((offset, list (datas)))
+            run_end, run_block_end = offset + size, block_end
+
+        for offset, datas in runs:
+            if len (datas) == 1:
+                self.SaveByOffset (offset, datas [0])
+            else:
+                self.SaveByOffsetVector (offset, datas)
+
+    def load_run (self, run, run_end, datas):
+        """Load run of neighbour blocks with single read
+        """
+        if len (run) == 1:
+            offset, used, index = run [0]
+            datas [index] = self.LoadByOffset (self.offset + offset, used)
+            return
+
+        # slices of loaded run have the same type as data loaded by single block
+        run_offset = run [0][0]
+        run_data = self.LoadByOffset (self.offset + run_offset, run_end - run_offset)
+        for offset, used, index in run:
+            offset -= run_offset
+            datas [index] = run_data [offset:offset + used]
+
+#------------------------------------------------------------------------------#
+# Store Batch                                                                  #
+#------------------------------------------------------------------------------#
+class StoreBatch (object):
+    """Store batch context
+    """
+    __slots__ = ('store',)
+
+    def __init__ (self, store):
+        self.store = store
+
+    def __enter__ (self):
+        self.store.batch_depth += 1
+        return self.store
+
+    def __exit__ (self, et, eo, tb):
+        store = self.store
+        store.batch_depth -= 1
+        if not store.batch_depth:
+            store.batch_flush ()
+        return False
+
+#------------------------------------------------------------------------------#
+# Store Snapshot                                                               #
+#------------------------------------------------------------------------------#
+class StoreSnapshot (Store):
+    """Read-only view of committed state of copy-on-write store
+
+    Snapshot is pinned to the generation of the store committed at the moment
+    of its creation, it is not affected by following changes or flushes.
+    """
+
+    def __init__ (self, store, generation, names_desc):
+        self.store = store
+        self.state_init (store.offset, 0, names_desc) # changes are rejected by overridden methods
+        self.generation = generation
+        self.track = {} # changes are never tracked
+
+    def LoadByOffset (self, offset, size):
+        return self.store.LoadByOffset (offset, size)
+
+    def SaveByOffset (self, offset, data):
+        raise ValueError ('Snapshot is read-only')
+
+    def ReserveBlock (self, size, desc = None):
+        raise ValueError ('Snapshot is read-only')
+
+    def Delete (self, desc):
+        raise ValueError ('Snapshot is read-only')
+
+    def Relocate (self, desc):
+        raise ValueError ('Snapshot is read-only')
+
+    def Flush (self):
+        pass
+
+    def Dispose (self):
+        disposables, self.disposables = self.disposables, []
+        for disposable in reversed (disposables):
+            disposable.Dispose ()
+
+        store, self.store = self.store, None
+        if store is not None:
+            store.cow_unpin (self.generation)
+
 # vim: nu ft=python columns=120 :
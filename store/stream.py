@@ -1,67 +1,548 @@
 # -*- coding: utf-8 -*-
 import io
 import os
+import mmap
+import struct
+import threading
 
 from .store import Store
+from .cache import StorePageCache
+from .wal import StoreWAL
 
-__all__ = ('StreamStore', 'FileStore',)
+__all__ = ('StreamStore', 'FileStore', 'StripedStore', 'MmapFileStore',)
 #------------------------------------------------------------------------------#
 # Stream Store                                                                 #
 #------------------------------------------------------------------------------#
 class StreamStore (Store):
     """Stream based store
+
+    Stream position is shared, so seek and following read or write are done
+    under the lock. If cache_size is set, stream is accessed through page
+    cache of this size (in bytes), see StorePageCache.
     """
 
-    def __init__ (self, stream, offset = None):
+    def __init__ (self, stream, offset = None, cache_size = None, cow = None, size_classes = None,
+                  slab = None, dedup = None, readonly = None):
         self.stream = stream
+        self.stream_lock = threading.Lock ()
+        self.cache = (StorePageCache (self.stream_load, self.stream_save_vector, cache_size)
+                      if cache_size else None)
 
-        Store.__init__ (self, offset)
+        Store.__init__ (self, offset, cow, size_classes, slab, dedup, readonly)
 
     def SaveByOffset (self, offset, data):
-        self.stream.seek (offset)
-        return self.stream.write (data)
+        if self.cache is None:
+            return self.stream_save (offset, data)
+        return self.cache.Save (offset, data)
+
+    def SaveByOffsetVector (self, offset, datas):
+        if self.cache is None:
+            return self.stream_save_vector (offset, datas)
+        return self.cache.SaveVector (offset, datas)
 
     def LoadByOffset (self, offset, size):
-        self.stream.seek (offset)
-        return self.stream.read (size)
+        if self.cache is None:
+            return self.stream_load (offset, size)
+        return self.cache.Load (offset, size)
 
     def Flush (self):
         Store.Flush (self)
+        if self.cache is not None:
+            self.cache.Flush ()
         self.stream.flush ()
 
+    #--------------------------------------------------------------------------#
+    # Stream                                                                   #
+    #--------------------------------------------------------------------------#
+    def stream_save (self, offset, data):
+        """Save data to the stream by offset
+        """
+        with self.stream_lock:
+            self.stream.seek (offset)
+            return self.stream.write (data)
+
+    def stream_save_vector (self, offset, datas):
+        """Save sequence of data to the stream continuously starting from offset
+        """
+        with self.stream_lock:
+            self.stream.seek (offset)
+            return sum (self.stream.write (data) for data in datas)
+
+    def stream_load (self, offset, size):
+        """Load data from the stream by offset and size
+        """
+        with self.stream_lock:
+            self.stream.seek (offset)
+            return self.stream.read (size)
+
 #------------------------------------------------------------------------------#
 # File Store                                                                   #
 #------------------------------------------------------------------------------#
 class FileStore (StreamStore):
     """File based store
+
+    If positional I/O is available (os.pread, os.pwrite) file position is not
+    used at all, so concurrent loads do not need any locking.
+
+    If wal is set, store uses write-ahead log (see StoreWAL) located next to
+    the store file. Each flush is a durable commit, and flushes from multiple
+    threads share fsync calls. Log is replayed when store is opened, and it is
+    checkpointed when its size exceeds ``wal_checkpoint`` or store is disposed.
+
+    File is truncated to the end of allocated space when flushed (with
+    write-ahead log, when checkpointed). If extent is set, file space is
+    preallocated by extents of this size ahead of demand, and file is
+    truncated only when at least extent of free space can be released.
     """
+    wal_suffix = '-wal'
+    wal_checkpoint = 1 << 26
 
-    def __init__ (self, path, mode = None, offset = None):
+    def __init__ (self, path, mode = None, offset = None, cache_size = None, wal = None, cow = None,
+                  extent = None, size_classes = None, slab = None, dedup = None):
         mode = mode or 'r'
         self.mode = mode
 
-        if mode == 'r':
-            filemode = 'rb'
-        elif mode == 'w':
-            filemode = 'r+b'
-        elif mode == 'c':
-            if not os.path.lexists (path):
-                filemode = 'w+b'
-            else:
-                filemode = 'r+b'
-        elif mode == 'n':
-            filemode = 'w+b'
-        else:
-            raise ValueError ('Unknown mode: {}'.format (mode))
+        stream = file_open (path, mode)
+        self.fd = stream.fileno ()
+        self.extent = extent
+        self.file_end = None
+
+        # write-ahead log (existing log is always recovered)
+        self.wal = None
+        wal_path = path + self.wal_suffix
+        if mode == 'n' and os.path.exists (wal_path):
+            os.unlink (wal_path)
+        if (wal and mode != 'r') or os.path.exists (wal_path):
+            self.wal = StoreWAL (wal_path,
+                super (FileStore, self).LoadByOffset,
+                super (FileStore, self).SaveByOffsetVector,
+                self.wal_sync, mode == 'r')
+            self.wal.Recover (stream)
+            if not wal and mode != 'r':
+                self.wal.Close ()
+                self.wal = None
+        self.flush_lock = threading.Lock ()
 
-        StreamStore.__init__ (self, io.open (path, filemode, buffering = 0), offset)
+        StreamStore.__init__ (self, stream, offset, cache_size, cow, size_classes, slab, dedup, mode == 'r')
+
+    def SaveByOffset (self, offset, data):
+        if self.wal is None:
+            return StreamStore.SaveByOffset (self, offset, data)
+        return self.wal.Save (offset, data)
+
+    def SaveByOffsetVector (self, offset, datas):
+        if self.wal is None:
+            return StreamStore.SaveByOffsetVector (self, offset, datas)
+        return self.wal.SaveVector (offset, datas)
+
+    def LoadByOffset (self, offset, size):
+        if self.wal is None:
+            return StreamStore.LoadByOffset (self, offset, size)
+        return self.wal.Load (offset, size)
+
+    def wal_sync (self):
+        """Make store file durable (used by write-ahead log checkpoint)
+        """
+        if self.cache is not None:
+            self.cache.Flush ()
+        os.fsync (self.fd)
+
+    if hasattr (os, 'pread'):
+        def stream_save (self, offset, data):
+            data_size = len (data)
+            data_offset = os.pwrite (self.fd, data, offset)
+            if data_offset < data_size:
+                data = memoryview (data)
+                while data_offset < data_size:
+                    data_offset += os.pwrite (self.fd, data [data_offset:], offset + data_offset)
+            return data_size
+
+        def stream_load (self, offset, size):
+            data = os.pread (self.fd, size, offset)
+            if len (data) < size:
+                # short read is possible only at the end of file or when
+                # interrupted by signal, so retry until it returns nothing
+                chunks = [data]
+                while size > 0 and data:
+                    size -= len (data)
+                    offset += len (data)
+                    data = os.pread (self.fd, size, offset)
+                    chunks.append (data)
+                data = b''.join (chunks)
+            return data
+
+    if hasattr (os, 'pwritev'):
+        iov_max = os.sysconf ('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 1024
+
+        def stream_save_vector (self, offset, datas):
+            size = 0
+            for index in range (0, len (datas), self.iov_max):
+                chunk = datas [index:index + self.iov_max]
+                chunk_size = sum (len (data) for data in chunk)
+                chunk_written = os.pwritev (self.fd, chunk, offset)
+                if chunk_written < chunk_size:
+                    self.stream_save (offset + chunk_written, b''.join (chunk) [chunk_written:])
+                offset += chunk_size
+                size += chunk_size
+            return size
 
     def Flush (self):
-        if self.mode != 'r':
+        if self.mode == 'r':
+            return
+        elif self.wal is None:
             StreamStore.Flush (self)
+            if self.allocator is not None:
+                self.file_end = self.alloc.End
+            self.file_trim ()
+            return
+
+        with self.flush_lock:
+            Store.Flush (self)
+            commit = self.wal.Commit ()
+            if self.allocator is not None:
+                self.file_end = self.alloc.End
+        self.wal.Sync (commit)
+
+        if self.wal.Size > self.wal_checkpoint:
+            with self.flush_lock:
+                self.wal.Checkpoint ()
+                self.file_trim ()
 
     def Dispose (self):
         StreamStore.Dispose (self)
+        if self.wal is not None:
+            self.wal.Close ()
+            if self.mode != 'r':
+                self.file_trim ()
         self.stream.close ()
 
+    def file_trim (self):
+        """Truncate file to the end of committed allocated space
+
+        Or preallocate extent if file is too small. If allocator has not been
+        loaded (store has not been changed since it was opened), end of
+        allocated space is not known, and file is only extended to the extent
+        boundary.
+        """
+        if self.file_end is None and not self.extent:
+            return
+
+        size = os.fstat (self.fd).st_size
+        if self.file_end is None:
+            end = (max (size - 1, 0) // self.extent + 1) * self.extent
+            if size < end:
+                self.file_extend (size, end)
+            return
+
+        end = self.offset + self.file_end
+        if self.extent:
+            end = (end // self.extent + 1) * self.extent
+            if size < end:
+                self.file_extend (size, end)
+                return
+            elif size - end < self.extent:
+                return
+        if size > end:
+            os.ftruncate (self.fd, end)
+
+    if hasattr (os, 'posix_fallocate'):
+        def file_extend (self, size, end):
+            """Extend file from size to end (space is allocated)
+            """
+            os.posix_fallocate (self.fd, size, end - size)
+
+    else:
+        def file_extend (self, size, end):
+            """Extend file from size to end (file is sparse)
+            """
+            os.ftruncate (self.fd, end)
+
+#------------------------------------------------------------------------------#
+# Striped Store                                                                #
+#------------------------------------------------------------------------------#
+class StripedStore (Store):
+    """Store striped across multiple files
+
+    Store space is divided into stripes of ``1 << stripe_order`` bytes, which
+    are placed to the files in round-robin order, so the store (with single
+    header) can use several devices. Files are accessed with positional I/O
+    (if available), so concurrent loads from different threads are done in
+    parallel. Store must always be opened with the same paths (in the same
+    order). Stripe order and number of files are saved in the stripe header
+    (placed before the store header in the first file), if stripe order is
+    not set it is taken from the header, and ValueError is raised if they do
+    not match.
+    """
+    stripe_order_default = 20
+    stripe_magic = b'\xffstripe'
+    stripe_struct = struct.Struct ('>7sBQ') # magic, stripe order, number of files
+
+    def __init__ (self, paths, mode = None, offset = None, stripe_order = None, cow = None, size_classes = None,
+                  slab = None, dedup = None):
+        mode = mode or 'r'
+        self.mode = mode
+        offset = offset or 0
+
+        self.streams = [file_open (path, mode) for path in paths]
+        self.stream_locks = [threading.Lock () for _ in self.streams]
+        self.stripe_order = stripe_order or self.stripe_order_default
+
+        try:
+            self.stripe_header (offset, stripe_order)
+        except Exception:
+            for stream in self.streams:
+                stream.close ()
+            raise
+
+        Store.__init__ (self, offset + self.stripe_struct.size, cow, size_classes, slab, dedup, mode == 'r')
+
+    def SaveByOffset (self, offset, data):
+        data = memoryview (data)
+        data_offset = 0
+        for index, stripe_offset, size in self.stripes (offset, len (data)):
+            self.stripe_save (index, stripe_offset, data [data_offset:data_offset + size])
+            data_offset += size
+        return data_offset
+
+    def LoadByOffset (self, offset, size):
+        datas, datas_size, end = [], 0, 0
+        for index, stripe_offset, stripe_size in self.stripes (offset, size):
+            data = self.stripe_load (index, stripe_offset, stripe_size)
+            if data:
+                end = datas_size + len (data)
+            if len (data) < stripe_size:
+                # end of the file, but following stripes can still contain data
+                data += bytes (bytearray (stripe_size - len (data)))
+            datas.append (data)
+            datas_size += stripe_size
+        if len (datas) == 1:
+            return datas [0] [:end]
+        return b''.join (datas) [:end]
+
+    def Flush (self):
+        if self.mode != 'r':
+            Store.Flush (self)
+            for stream in self.streams:
+                stream.flush ()
+
+    def Dispose (self):
+        Store.Dispose (self)
+        for stream in self.streams:
+            stream.close ()
+
+    #--------------------------------------------------------------------------#
+    # Private                                                                  #
+    #--------------------------------------------------------------------------#
+    def stripe_header (self, offset, stripe_order):
+        """Validate stripe header (or save it if store is empty)
+
+        Header is always inside of the first stripe of the first file, so it
+        is loaded the same way regardless of the stripe order.
+        """
+        header = self.stripe_load (0, offset, self.stripe_struct.size)
+        if header:
+            if len (header) < self.stripe_struct.size:
+                raise ValueError ('Stripe header is truncated')
+            magic, header_order, header_count = self.stripe_struct.unpack (header)
+            if magic != self.stripe_magic:
+                raise ValueError ('Stripe header is corrupted')
+            if stripe_order is not None and stripe_order != header_order:
+                raise ValueError ('Stripe order mismatch: {} != {}'.format (stripe_order, header_order))
+            if header_count != len (self.streams):
+                raise ValueError ('Number of files mismatch: {} != {}'.format (len (self.streams), header_count))
+            self.stripe_order = header_order
+        elif self.mode != 'r':
+            self.stripe_save (0, offset, self.stripe_struct.pack (self.stripe_magic, self.stripe_order,
+                                                                  len (self.streams)))
+
+    def stripes (self, offset, size):
+        """Split range into (file index, offset inside the file, size) pieces
+        """
+        order, count = self.stripe_order, len (self.streams)
+        mask = (1 << order) - 1
+        while size > 0:
+            stripe, stripe_offset = offset >> order, offset & mask
+            stripe_size = min (size, (1 << order) - stripe_offset)
+            yield stripe % count, ((stripe // count) << order) | stripe_offset, stripe_size
+            offset += stripe_size
+            size -= stripe_size
+
+    if hasattr (os, 'pread'):
+        def stripe_save (self, index, offset, data):
+            """Save data to the file by offset
+            """
+            fd = self.streams [index].fileno ()
+            data_offset, data_size = 0, len (data)
+            while data_offset < data_size:
+                data_offset += os.pwrite (fd, data [data_offset:], offset + data_offset)
+
+        def stripe_load (self, index, offset, size):
+            """Load data from the file by offset and size
+            """
+            fd = self.streams [index].fileno ()
+            chunks = []
+            while size > 0:
+                chunk = os.pread (fd, size, offset)
+                if not chunk:
+                    break
+                chunks.append (chunk)
+                size -= len (chunk)
+                offset += len (chunk)
+            return chunks [0] if len (chunks) == 1 else b''.join (chunks)
+
+    else:
+        def stripe_save (self, index, offset, data):
+            """Save data to the file by offset
+            """
+            with self.stream_locks [index]:
+                stream = self.streams [index]
+                stream.seek (offset)
+                stream.write (data)
+
+        def stripe_load (self, index, offset, size):
+            """Load data from the file by offset and size
+            """
+            with self.stream_locks [index]:
+                stream = self.streams [index]
+                stream.seek (offset)
+                return stream.read (size)
+
+#------------------------------------------------------------------------------#
+# Memory Mapped File Store                                                     #
+#------------------------------------------------------------------------------#
+class MmapFileStore (Store):
+    """Memory mapped file based store
+
+    Loaded data is a memory view into the mapping, so it is neither copied nor
+    requires any system call (on python 2 it is copied from the mapping).
+    Loaded data is only valid until the block it belongs to is saved or
+    deleted. File (and mapping) grows by ``grow_size`` steps as needed.
+    """
+    grow_size = 1 << 20
+
+    def __init__ (self, path, mode = None, offset = None, cow = None, size_classes = None, slab = None,
+                  dedup = None):
+        mode = mode or 'r'
+        self.mode = mode
+
+        self.stream = file_open (path, mode)
+        self.mmap = None
+        self.mmap_view = None
+        self.mmap_size = 0
+
+        size = os.fstat (self.stream.fileno ()).st_size
+        if size:
+            self.mmap_remap (size)
+
+        Store.__init__ (self, offset, cow, size_classes, slab, dedup, mode == 'r')
+
+    def SaveByOffset (self, offset, data):
+        data_end = offset + len (data)
+        if data_end > self.mmap_size:
+            self.mmap_remap (data_end)
+        self.mmap_view [offset:data_end] = data
+        return len (data)
+
+    def SaveByOffsetVector (self, offset, datas):
+        size = sum (len (data) for data in datas)
+        if offset + size > self.mmap_size:
+            self.mmap_remap (offset + size)
+        for data in datas:
+            data_size = len (data)
+            self.mmap_view [offset:offset + data_size] = data
+            offset += data_size
+        return size
+
+    def LoadByOffset (self, offset, size):
+        if offset >= self.mmap_size:
+            return b''
+        return self.mmap_view [offset:offset + size]
+
+    def Flush (self):
+        if self.mode != 'r':
+            Store.Flush (self)
+            if self.mmap is not None:
+                self.mmap.flush ()
+
+    def Dispose (self):
+        Store.Dispose (self)
+        self.mmap_close ()
+        self.stream.close ()
+
+    #--------------------------------------------------------------------------#
+    # Private                                                                  #
+    #--------------------------------------------------------------------------#
+    def mmap_remap (self, size):
+        """Map at least size bytes of the file
+
+        Grows file if it is smaller then requested size. Previous mapping stays
+        alive until all memory views into it are released.
+        """
+        fd = self.stream.fileno ()
+        if self.mode == 'r':
+            access = mmap.ACCESS_READ
+            size = os.fstat (fd).st_size
+        else:
+            access = mmap.ACCESS_WRITE
+            size = (size + self.grow_size - 1) // self.grow_size * self.grow_size
+            if os.fstat (fd).st_size < size:
+                self.stream.truncate (size)
+
+        self.mmap_close ()
+        mapping = mmap.mmap (fd, size, access = access)
+        try:
+            self.mmap_view = memoryview (mapping)
+        except TypeError:
+            # mmap of python 2 does not support memory views, so loaded data
+            # is copied from the mapping
+            self.mmap_view = mapping
+        self.mmap = mapping
+        self.mmap_size = size
+
+    def mmap_close (self):
+        """Close current mapping
+        """
+        if self.mmap is None:
+            return
+
+        mapping, self.mmap = self.mmap, None
+        if self.mmap_view is not mapping:
+            self.mmap_view.release ()
+        self.mmap_view = None
+        self.mmap_size = 0
+
+        if self.mode != 'r':
+            mapping.flush ()
+        try:
+            mapping.close ()
+        except BufferError:
+            # loaded data still references this mapping, it will be
+            # unmapped as soon as last memory view is released
+            pass
+
+#------------------------------------------------------------------------------#
+# Helpers                                                                      #
+#------------------------------------------------------------------------------#
+def file_open (path, mode):
+    """Open unbuffered file according to store mode
+
+    Modes: 'r' - read only, 'w' - read-write, 'c' - read-write create if not
+    exists, 'n' - always create new store.
+    """
+    if mode == 'r':
+        filemode = 'rb'
+    elif mode == 'w':
+        filemode = 'r+b'
+    elif mode == 'c':
+        if not os.path.lexists (path):
+            filemode = 'w+b'
+        else:
+            filemode = 'r+b'
+    elif mode == 'n':
+        filemode = 'w+b'
+    else:
+        raise ValueError ('Unknown mode: {}'.format (mode))
+
+    return io.open (path, filemode, buffering = 0)
+
 # vim: nu ft=python columns=120 :
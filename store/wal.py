@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+import binascii
+import threading
+from collections import OrderedDict
+
+__all__ = ('StoreWAL',)
+#------------------------------------------------------------------------------#
+# Store Write-Ahead Log                                                        #
+#------------------------------------------------------------------------------#
+class StoreWAL (object):
+    """Store write-ahead log
+
+    Saved data is kept in memory until it is committed. Commit appends all
+    pending writes to the log as a single frame, and sync makes appended frames
+    durable. Concurrent syncs are grouped, single thread does fsync on behalf of
+    all threads waiting for it (group commit). Committed writes are kept in
+    memory and are applied in place lazily by checkpoint. Until then loads are
+    served from the overlay of pages affected by not yet applied writes.
+
+    Frame format:
+
+        +-------+--------------+-------+----------------------------------+
+        | magic | payload size | crc32 | (offset, size, data) ...         |
+        +-------+--------------+-------+----------------------------------+
+
+    ``load (offset, size)`` and ``save_vector (offset, datas)`` are used to
+    access underlying storage, ``sync ()`` must make underlying storage durable.
+    """
+    frame_magic  = b'SWAL'
+    frame_struct = struct.Struct ('>4sQI')
+    write_struct = struct.Struct ('>QI')
+    page_order   = 12
+
+    def __init__ (self, path, load, save_vector, sync, readonly = None):
+        self.path = path
+        self.load = load
+        self.save_vector = save_vector
+        self.sync = sync
+        self.readonly = readonly
+
+        self.fd = os.open (path, os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = 0
+        self.lock = threading.RLock ()
+
+        # group commit
+        self.sync_cond = threading.Condition (threading.Lock ())
+        self.sync_size = 0
+        self.sync_active = False
+
+        self.pending = OrderedDict () # not yet committed writes (ordered by the last write)
+        self.committed = []           # committed but not yet applied writes
+        self.pages = {}               # overlay pages
+        self.pages_pending = set ()
+
+    #--------------------------------------------------------------------------#
+    # Properties                                                               #
+    #--------------------------------------------------------------------------#
+    @property
+    def Size (self):
+        """Size of the log
+        """
+        return self.size
+
+    #--------------------------------------------------------------------------#
+    # Load                                                                     #
+    #--------------------------------------------------------------------------#
+    def Load (self, offset, size):
+        """Load data by offset and size
+        """
+        page_order = self.page_order
+        with self.lock:
+            pages = self.pages
+            index_begin, index_end = offset >> page_order, ((offset + size - 1) >> page_order) + 1
+            for index in range (index_begin, index_end):
+                if index in pages:
+                    break
+            else:
+                return self.load (offset, size)
+
+            datas = []
+            data_end = offset + size
+            for index in range (index_begin, index_end):
+                page_offset = index << page_order
+                begin, end = max (offset, page_offset), min (data_end, page_offset + (1 << page_order))
+                page = pages.get (index)
+                if page is None:
+                    datas.append (self.load (begin, end - begin))
+                else:
+                    datas.append (bytes (page [begin - page_offset:end - page_offset]))
+            return b''.join (datas)
+
+    #--------------------------------------------------------------------------#
+    # Save                                                                     #
+    #--------------------------------------------------------------------------#
+    def Save (self, offset, data):
+        """Save data by offset
+        """
+        return self.SaveVector (offset, (data,))
+
+    def SaveVector (self, offset, datas):
+        """Save sequence of data continuously starting from offset
+        """
+        data = b''.join (datas)
+        with self.lock:
+            # reinsert, so writes are ordered by the time of last write
+            self.pending.pop (offset, None)
+            self.pending [offset] = data
+            self.pages_pending.update (self.page_write (offset, data))
+        return len (data)
+
+    #--------------------------------------------------------------------------#
+    # Commit                                                                   #
+    #--------------------------------------------------------------------------#
+    def Commit (self):
+        """Append pending writes to the log
+
+        Returns log position which must be passed to Sync to make this commit
+        durable.
+        """
+        with self.lock:
+            if not self.pending:
+                return self.size
+
+            frame = self.FrameEncode (self.pending.items ())
+            frame_offset = 0
+            while frame_offset < len (frame):
+                frame_offset += self.log_write (frame [frame_offset:], self.size + frame_offset)
+            self.size += len (frame)
+
+            self.committed.extend (self.pending.items ())
+            self.pending.clear ()
+            self.pages_pending.clear ()
+
+            return self.size
+
+    def Sync (self, size = None):
+        """Make log durable at least up to specified position
+        """
+        size = self.size if size is None else size
+        with self.sync_cond:
+            while self.sync_size < size:
+                if self.sync_active:
+                    # other thread is syncing, it may cover this commit too
+                    self.sync_cond.wait ()
+                    continue
+
+                self.sync_active = True
+                sync_size, synced = self.size, False
+                self.sync_cond.release ()
+                try:
+                    os.fsync (self.fd)
+                    synced = True
+                finally:
+                    self.sync_cond.acquire ()
+                    self.sync_active = False
+                    if synced:
+                        self.sync_size = max (self.sync_size, sync_size)
+                    self.sync_cond.notify_all ()
+
+    #--------------------------------------------------------------------------#
+    # Checkpoint                                                               #
+    #--------------------------------------------------------------------------#
+    def Checkpoint (self):
+        """Apply committed writes in place and truncate log
+        """
+        with self.lock:
+            if not self.size:
+                return
+
+            self.Sync (self.size)
+            for offset, data in self.committed:
+                self.save_vector (offset, (data,))
+            self.sync ()
+
+            # keep only pages affected by pending writes
+            del self.committed [:]
+            self.pages = dict ((index, self.pages [index]) for index in self.pages_pending)
+            os.ftruncate (self.fd, 0)
+            os.fsync (self.fd)
+            with self.sync_cond:
+                self.size = 0
+                self.sync_size = 0
+
+    #--------------------------------------------------------------------------#
+    # Recover                                                                  #
+    #--------------------------------------------------------------------------#
+    def Recover (self, stream):
+        """Recover committed writes from the log
+
+        Writes of all complete frames are applied to the stream, which is then
+        synced, and the log is truncated. If log is read only, writes are kept
+        in memory instead. Returns number of recovered frames.
+        """
+        def stream_load (offset, size):
+            stream.seek (offset)
+            return stream.read (size)
+
+        def log_load (offset, size):
+            return self.log_read (size, offset)
+
+        frames = 0
+        offset = 0
+        while True:
+            writes, frame_size = self.FrameDecode (log_load, offset)
+            if writes is None:
+                break # torn frame
+
+            for write_offset, data in writes:
+                if self.readonly:
+                    self.page_write (write_offset, data, stream_load)
+                else:
+                    stream.seek (write_offset)
+                    data = memoryview (data)
+                    while data:
+                        data = data [stream.write (data):]
+
+            offset += frame_size
+            frames += 1
+
+        if self.readonly:
+            self.size = offset
+        elif offset or os.fstat (self.fd).st_size:
+            stream.flush ()
+            os.fsync (stream.fileno ())
+            os.ftruncate (self.fd, 0)
+            os.fsync (self.fd)
+
+        return frames
+
+    #--------------------------------------------------------------------------#
+    # Frame                                                                    #
+    #--------------------------------------------------------------------------#
+    @classmethod
+    def FrameEncode (cls, writes):
+        """Encode frame from iterable of (offset, data) writes
+        """
+        payload = []
+        for offset, data in writes:
+            payload.append (cls.write_struct.pack (offset, len (data)))
+            payload.append (data)
+        payload = b''.join (payload)
+
+        return cls.frame_struct.pack (cls.frame_magic, len (payload),
+            binascii.crc32 (payload) & 0xffffffff) + payload
+
+    @classmethod
+    def FrameDecode (cls, load, offset):
+        """Decode frame located at offset
+
+        ``load (offset, size)`` is used to read frame. Returns list of (offset,
+        data) writes and size of the frame, or (None, 0) if there is no complete
+        frame at the offset.
+        """
+        header = load (offset, cls.frame_struct.size)
+        if len (header) < cls.frame_struct.size:
+            return None, 0
+        magic, payload_size, crc32 = cls.frame_struct.unpack (header)
+        if magic != cls.frame_magic:
+            return None, 0
+        payload = load (offset + cls.frame_struct.size, payload_size)
+        if len (payload) < payload_size or binascii.crc32 (payload) & 0xffffffff != crc32:
+            return None, 0
+
+        writes = []
+        payload_offset = 0
+        while payload_offset < payload_size:
+            write_offset, write_size = cls.write_struct.unpack_from (payload, payload_offset)
+            payload_offset += cls.write_struct.size
+            writes.append ((write_offset, payload [payload_offset:payload_offset + write_size]))
+            payload_offset += write_size
+        return writes, cls.frame_struct.size + payload_size
+
+    #--------------------------------------------------------------------------#
+    # Close                                                                    #
+    #--------------------------------------------------------------------------#
+    def Close (self):
+        """Checkpoint and close log
+
+        Log file is removed, so store file is self contained.
+        """
+        if self.fd is None:
+            return
+        if not self.readonly:
+            self.Checkpoint ()
+            os.unlink (self.path)
+        os.close (self.fd)
+        self.fd = None
+
+    #--------------------------------------------------------------------------#
+    # Private                                                                  #
+    #--------------------------------------------------------------------------#
+    if hasattr (os, 'pread'):
+        def log_write (self, data, offset):
+            """Write data to the log by offset, returns number of written bytes
+            """
+            return os.pwrite (self.fd, data, offset)
+
+        def log_read (self, size, offset):
+            """Read data from the log by offset
+            """
+            return os.pread (self.fd, size, offset)
+
+    else:
+        def log_write (self, data, offset):
+            """Write data to the log by offset, returns number of written bytes
+            """
+            os.lseek (self.fd, offset, os.SEEK_SET)
+            return os.write (self.fd, data)
+
+        def log_read (self, size, offset):
+            """Read data from the log by offset
+            """
+            os.lseek (self.fd, offset, os.SEEK_SET)
+            return os.read (self.fd, size)
+
+    def page_write (self, offset, data, load = None):
+        """Write data to overlay pages
+
+        Returns indices of affected pages.
+        """
+        load = load or self.load
+        page_order = self.page_order
+        page_size = 1 << page_order
+
+        indices = range (offset >> page_order, ((offset + len (data) - 1) >> page_order) + 1)
+        data_end = offset + len (data)
+        for index in indices:
+            page_offset = index << page_order
+            page = self.pages.get (index)
+            if page is None:
+                page = bytearray (load (page_offset, page_size))
+                page.extend (bytearray (page_size - len (page)))
+                self.pages [index] = page
+            begin, end = max (offset, page_offset), min (data_end, page_offset + page_size)
+            page [begin - page_offset:end - page_offset] = data [begin - offset:end - offset]
+        return indices
+
+# vim: nu ft=python columns=120 :
@@ -1,16 +1,24 @@
 # -*- coding: utf-8 -*-
-import zlib
 import json
 
-__all__ = ('StoreStream',)
+from .store.alloc import desc_size, descs_size
+from .codec import CodecGet
+
+__all__ = ('StoreStream', 'StoreStreamReader',)
 #------------------------------------------------------------------------------#
 # Store Stream                                                                 #
 #------------------------------------------------------------------------------#
 class StoreStream (object):
     """Stream object with Store backend.
+
+    Stream position is part of the stream object, use Reader to get
+    independent read only handles (one per thread). Chunks are compressed by
+    codec (see CodecGet), dictionary of the codec is trained on the first
+    saved chunk.
     """
     default_compress  = 9
     default_chunk_size = 1 << 16
+    relocate_batch = 1 << 4
 
     def __init__ (self, store, header, buffer_size = None, compress = None):
         self.store = store
@@ -22,13 +30,20 @@ class StoreStream (object):
             self.chunks = []
             self.size = 0
             self.compress = self.default_compress if compress is None else compress
+            self.codec_desc = 0
+            self.codec = CodecGet (self.compress)
         else:
-            header = json.loads (header.decode ())
+            header = json.loads (bytes (header).decode ())
             self.chunk_size = header ['chunk_size']
             self.chunks = header ['chunks']
             self.size = header ['size']
             self.compress = header ['compress']
+            self.codec_desc = header.get ('compress_dict', 0)
+            self.codec = CodecGet (self.compress)
+            if self.codec is not None and self.codec.dictionary:
+                self.codec.zdict = bytes (store.Load (self.codec_desc))
 
+        self.size_on_store = descs_size (self.chunks)
         self.seek_pos = None
 
         self.chunk_index = None
@@ -36,6 +51,9 @@ class StoreStream (object):
         self.chunk_zero = b'\x00' * self.chunk_size
         self.chunk_switch (0)
 
+        self.relocator = False # relocator is registered in the store
+        self.relocator_attach ()
+
     def chunk_switch (self, index = None):
         """Switch current chunk
         """
@@ -43,26 +61,85 @@ class StoreStream (object):
             return
 
         if self.chunk_dirty:
-            self.chunk_dirty = False
-            chunk_desc = self.store.Save (self.chunk.bytes () if not self.compress else
-                zlib.compress (self.chunk.bytes (), self.compress))
-            if self.chunk_index < len (self.chunks):
-                self.chunks [self.chunk_index] = chunk_desc
-            else:
-                self.chunks.append (chunk_desc)
+            self.chunk_save ()
 
         self.chunk_index = self.chunk_index + 1 if index is None else index
         if self.chunk_index < len (self.chunks):
             self.chunk_desc = self.chunks [self.chunk_index]
-            self.chunk = Chunk (self.chunk_size,
-                    self.chunk_zero if self.chunk_desc is None else
-                    self.store.Load (self.chunk_desc) if not self.compress else
-                    zlib.decompress (self.store.Load (self.chunk_desc)))
+            self.chunk = Chunk (self.chunk_size, self.chunk_load (self.chunk_desc))
         else:
             self.chunks.extend ((None,) * (self.chunk_index - len (self.chunks)))
             self.chunk_desc = None
             self.chunk = Chunk (self.chunk_size)
 
+    def chunk_save (self):
+        """Save current chunk
+
+        Chunk is saved in place of its previous version if there is enough space.
+        """
+        self.chunk_dirty = False
+        if self.chunk_desc:
+            self.size_on_store -= desc_size (self.chunk_desc)
+
+        codec = self.codec
+        if codec is not None and codec.dictionary and codec.zdict is None:
+            self.codec_desc = self.store.Save (codec.Train ([self.chunk.bytes ()]))
+        self.chunk_desc = self.store.Save (self.chunk.bytes () if codec is None else
+            codec.Compress (self.chunk.bytes ()), self.chunk_desc)
+        if self.chunk_desc:
+            self.size_on_store += desc_size (self.chunk_desc)
+        if self.chunk_index < len (self.chunks):
+            self.chunks [self.chunk_index] = self.chunk_desc
+        else:
+            self.chunks.append (self.chunk_desc)
+
+    def chunk_load (self, desc):
+        """Load chunk data by its descriptor
+        """
+        if desc is None:
+            return self.chunk_zero
+        return (self.store.Load (desc) if self.codec is None else
+                self.codec.Decompress (self.store.Load (desc)))
+
+    def relocator_attach (self):
+        """Register relocator in the store (if it is not registered)
+        """
+        if not self.relocator:
+            self.store.RelocatorRegister (self.relocate)
+            self.relocator = True
+
+    def relocator_detach (self):
+        """Unregister relocator from the store (if it is registered)
+        """
+        if self.relocator:
+            self.store.RelocatorUnregister (self.relocate)
+            self.relocator = False
+
+    def relocate (self):
+        """Relocate chunks (store relocator)
+        """
+        index = 0
+        while index < len (self.chunks):
+            for index in range (index, min (index + self.relocate_batch, len (self.chunks))):
+                desc = self.chunks [index]
+                if desc and self.store.Relocatable (desc):
+                    desc = self.store.Relocate (desc)
+                    self.chunks [index] = desc
+                    if index == self.chunk_index:
+                        self.chunk_desc = desc
+            index += 1
+            self.Flush ()
+            yield
+
+    def chunk_data (self, index):
+        """Get data of the chunk by its index
+        """
+        if index == self.chunk_index:
+            return self.chunk.bytes ()
+        elif index < len (self.chunks):
+            return self.chunk_load (self.chunks [index])
+        return b''
+
     #--------------------------------------------------------------------------#
     # Write                                                                    #
     #--------------------------------------------------------------------------#
@@ -170,12 +247,31 @@ class StoreStream (object):
 
         chunks, self.chunks = self.chunks [self.chunk_index + 1:], self.chunks [:self.chunk_index + 1]
         for chunk in chunks:
-            self.store.Delete (chunk)
+            if chunk:
+                self.size_on_store -= desc_size (chunk)
+                self.store.Delete (chunk)
         self.chunk.truncate ()
         self.chunk_dirty = True
 
     def truncate (self, pos): self.Truncate (pos)
 
+    #--------------------------------------------------------------------------#
+    # Size                                                                     #
+    #--------------------------------------------------------------------------#
+    @property
+    def SizeOnStore (self):
+        """Size occupied on store by chunks (maintained incrementally)
+        """
+        return self.size_on_store
+
+    #--------------------------------------------------------------------------#
+    # Reader                                                                   #
+    #--------------------------------------------------------------------------#
+    def Reader (self):
+        """Create read only handle with its own position
+        """
+        return StoreStreamReader (self)
+
     #--------------------------------------------------------------------------#
     # Flush                                                                    #
     #--------------------------------------------------------------------------#
@@ -183,20 +279,18 @@ class StoreStream (object):
         """Flush stream
         """
         if self.chunk_dirty:
-            self.chunk_dirty = False
-            chunk_desc = self.store.Save (self.chunk.bytes () if not self.compress else
-                zlib.compress (self.chunk.bytes (), self.compress))
-            if self.chunk_index < len (self.chunks):
-                self.chunks [self.chunk_index] = chunk_desc
-            else:
-                self.chunks.append (chunk_desc)
+            self.relocator_attach () # stream is being used after dispose
+            self.chunk_save ()
 
-        header = json.dumps ({
+        header = {
             'chunk_size': self.chunk_size,
             'chunks': self.chunks,
             'size': self.size,
             'compress': self.compress,
-        }).encode ()
+        }
+        if self.codec_desc:
+            header ['compress_dict'] = self.codec_desc
+        header = json.dumps (header).encode ()
         if self.header () != header:
             self.header (header)
 
@@ -208,8 +302,11 @@ class StoreStream (object):
     #--------------------------------------------------------------------------#
     def Dispose (self):
         """Dispose stream
+
+        Stream can be disposed more than once.
         """
         self.Flush ()
+        self.relocator_detach ()
 
     def __enter__ (self):
         return self
@@ -218,6 +315,79 @@ class StoreStream (object):
         self.Dispose ()
         return False
 
+#------------------------------------------------------------------------------#
+# Store Stream Reader                                                          #
+#------------------------------------------------------------------------------#
+class StoreStreamReader (object):
+    """Read only handle of store stream
+
+    Reader has its own position and current chunk, so any number of readers
+    can be used concurrently with each other (but not with stream writes).
+    """
+
+    def __init__ (self, stream):
+        self.stream = stream
+        self.pos = 0
+        self.chunk_index = None
+        self.chunk_data = b''
+
+    #--------------------------------------------------------------------------#
+    # Read                                                                     #
+    #--------------------------------------------------------------------------#
+    def Read (self, size = None):
+        """Read data from stream
+        """
+        stream = self.stream
+        size_left = stream.size - self.pos
+        if size is not None:
+            size_left = min (size, size_left)
+
+        data = []
+        while size_left > 0:
+            index, offset = divmod (self.pos, stream.chunk_size)
+            if index != self.chunk_index:
+                self.chunk_index = index
+                self.chunk_data = stream.chunk_data (index)
+
+            chunk = self.chunk_data [offset:offset + size_left]
+            if not chunk:
+                break
+            data.append (chunk)
+            size_left -= len (chunk)
+            self.pos += len (chunk)
+
+        return b''.join (data)
+
+    def read (self, size = None): return self.Read (size)
+
+    #--------------------------------------------------------------------------#
+    # Seek                                                                     #
+    #--------------------------------------------------------------------------#
+    def Seek (self, pos, whence = 0):
+        """Seek stream
+        """
+        if whence == 0:   # SEEK_SET
+            self.pos = pos
+        elif whence == 1: # SEEK_CUR
+            self.pos += pos
+        elif whence == 2: # SEEK_END
+            self.pos = self.stream.size + pos
+        else:
+            raise ValueError ('Invalid whence argument: {}'.format (whence))
+        return self.pos
+
+    def seek (self, pos, whence = 0): return self.Seek (pos, whence)
+
+    #--------------------------------------------------------------------------#
+    # Tell                                                                     #
+    #--------------------------------------------------------------------------#
+    def Tell (self):
+        """Tell current position inside stream
+        """
+        return self.pos
+
+    def tell (self): return self.Tell ()
+
 #------------------------------------------------------------------------------#
 # Chunk                                                                        #
 #------------------------------------------------------------------------------#
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
+import io
+import time
 import random
 import unittest
 
-from ..store.alloc import StoreBlock ,StoreAllocator
+from ..store.alloc import (StoreBlock ,StoreAllocator, desc_order, desc_offset, desc_used, desc_size,
+                          descs_size, descs_locations)
+from ..serialize import Serializer
 
 __all__ = ('StoreAllocatorTest',)
 #------------------------------------------------------------------------------#
@@ -19,7 +23,9 @@ class StoreAllocatorTest (unittest.TestCase):
         blocks = []
 
         def reload ():
-            alloc.blocks = [StoreBlock.FromDesc (block.ToDesc ()) for block in alloc.blocks]
+            stream = alloc.ToStream (io.BytesIO ())
+            stream.seek (0)
+            return StoreAllocator.FromStream (stream)
 
         # fill
         for _ in range (1 << 16):
@@ -28,7 +34,7 @@ class StoreAllocatorTest (unittest.TestCase):
             blocks.append (alloc.AllocByOrder (order))
         self.assertEqual (len (set (block.offset for block in blocks)), len (blocks))
         self.assertEqual (alloc.Size, size)
-        reload ()
+        alloc = reload ()
 
         # remove half
         for block in blocks [1 << 15:]:
@@ -37,7 +43,7 @@ class StoreAllocatorTest (unittest.TestCase):
         blocks = blocks [:1 << 15]
         self.assertEqual (len (set (block.offset for block in blocks)), len (blocks))
         self.assertEqual (alloc.Size, size)
-        reload ()
+        alloc = reload ()
 
         # add more
         for _ in range (1 << 15):
@@ -46,7 +52,7 @@ class StoreAllocatorTest (unittest.TestCase):
             blocks.append (alloc.AllocByOrder (order))
         self.assertEqual (len (set (block.offset for block in blocks)), len (blocks))
         self.assertEqual (alloc.Size, size)
-        reload ()
+        alloc = reload ()
 
         # remove some
         for block in blocks [1 << 14:]:
@@ -55,7 +61,7 @@ class StoreAllocatorTest (unittest.TestCase):
         blocks = blocks [:1 << 14]
         self.assertEqual (len (set (block.offset for block in blocks)), len (blocks))
         self.assertEqual (alloc.Size, size)
-        reload ()
+        alloc = reload ()
 
         # remove all
         for block in blocks:
@@ -63,6 +69,173 @@ class StoreAllocatorTest (unittest.TestCase):
             alloc.Free (block)
         self.assertEqual (size, 0)
         self.assertEqual (alloc.Size, 0)
-        reload ()
+        alloc = reload ()
+
+    def testDesc (self):
+        """Integer descriptor helpers
+        """
+        blocks = [StoreBlock (0, 0, 1), StoreBlock (0, 1, 1)]
+        for _ in range (1 << 12):
+            order = random.randint (3, 40)
+            blocks.append (StoreBlock (order, random.randint (0, 1 << 12) << order,
+                random.randint (0, 1 << order), random.randint (0, 3) if order >= 8 else 0))
+            slot = random.randint (0, 15)
+            blocks.append (StoreBlock (slot, random.randint (0, 1 << 30) << 4, random.randint (1, (slot + 1) << 4),
+                0, True))
+
+        descs = [block.ToDesc () for block in blocks]
+        for block, desc in zip (blocks, descs):
+            self.assertEqual (desc_order (desc), StoreBlock.slab_order if block.slab else block.order)
+            self.assertEqual ((desc_offset (desc), desc_used (desc), desc_size (desc)),
+                              (block.offset, block.used, block.size))
+        self.assertEqual (descs_size (descs + [0]), sum (block.size for block in blocks))
+        self.assertEqual (descs_locations ([0] + descs),
+            [(block.offset, block.used, index + 1) for index, block in enumerate (blocks)])
+
+        # offset must not reach size class
+        block = StoreBlock (8, StoreBlock.offset_limit - (1 << 8), 1 << 8, 3)
+        self.assertEqual ((desc_offset (block.ToDesc ()), desc_size (block.ToDesc ())), (block.offset, block.size))
+        self.assertRaises (ValueError, StoreBlock (8, StoreBlock.offset_limit).ToDesc)
+
+    def testSizeClasses (self):
+        """Size classes allocator tests
+        """
+        alloc = StoreAllocator (size_classes = True)
+        blocks = []
+        for _ in range (1 << 14):
+            size = random.randint (1, 1 << 14)
+            block = alloc.Alloc (size)
+            self.assertTrue (block.size >= size)
+            self.assertTrue (block.size < size * 1.25 or block.order < alloc.class_order_min)
+            blocks.append (StoreBlock.FromDesc (block.ToDesc ()))
+
+        # blocks do not overlap
+        ranges = sorted ((block.offset, block.offset + block.size) for block in blocks)
+        for (_, end), (start, _) in zip (ranges, ranges [1:]):
+            self.assertTrue (end <= start)
+        self.assertEqual (alloc.Size, sum (block.size for block in blocks))
+
+        random.shuffle (blocks)
+        for block in blocks:
+            alloc.Free (block)
+        self.assertEqual (alloc.Size, 0)
+        self.assertEqual (alloc.blocks, [StoreBlock (StoreAllocator.max_order, 0)])
+
+    def testRealloc (self):
+        """Realloc tests
+        """
+        for size_classes in (False, True):
+            alloc = StoreAllocator (size_classes = size_classes)
+
+            # grows into free buddy, shrinks in place
+            block = alloc.Alloc (100)
+            grown = alloc.Realloc (block, 1000)
+            self.assertEqual ((grown.offset, grown.size >= 1000), (block.offset, True))
+            shrunk = alloc.Realloc (grown, 10)
+            self.assertEqual (shrunk.offset, block.offset)
+            blocks = [shrunk, alloc.Alloc (10)]
+            self.assertEqual (blocks [1].offset, shrunk.size) # tail has been freed
+            self.assertEqual (alloc.Realloc (blocks [0], 1000), None)
+
+            # random reallocations never overlap
+            blocks.extend (alloc.Alloc (random.randint (1, 1 << 12)) for _ in range (1 << 10))
+            for _ in range (1 << 12):
+                index = random.randrange (len (blocks))
+                size = random.randint (1, 1 << 13)
+                block = alloc.Realloc (blocks [index], size)
+                if block is None:
+                    alloc.Free (blocks [index])
+                    block = alloc.Alloc (size)
+                else:
+                    self.assertEqual (block.offset, blocks [index].offset)
+                self.assertTrue (block.size >= size)
+                blocks [index] = block
+
+            ranges = sorted ((block.offset, block.offset + block.size) for block in blocks)
+            for (_, end), (start, _) in zip (ranges, ranges [1:]):
+                self.assertTrue (end <= start)
+            self.assertEqual (alloc.Size, sum (block.size for block in blocks))
+            self.assertEqual (sum (alloc.orders_size), alloc.Size)
+
+            for block in blocks:
+                alloc.Free (block)
+            self.assertEqual (alloc.blocks, [StoreBlock (StoreAllocator.max_order, 0)])
+
+    def testStats (self):
+        """Allocator statistics tests
+        """
+        alloc = StoreAllocator ()
+        blocks = [alloc.Alloc (random.randint (1, 1 << 12)) for _ in range (1 << 10)]
+        for block in blocks [::2]:
+            alloc.Free (block)
+        blocks = blocks [1::2]
+
+        stats = alloc.Stats ()
+        self.assertEqual (stats ['allocated'], sum (block.size for block in blocks))
+        self.assertEqual (stats ['end'], max (block.offset + block.size for block in blocks))
+        self.assertEqual (stats ['free'], stats ['end'] - stats ['allocated'])
+        self.assertTrue (0 < stats ['free_largest'] <= stats ['free'])
+        self.assertTrue (0 < stats ['fragmentation'] < 1)
+        orders = {}
+        for block in blocks:
+            orders [block.order] = orders.get (block.order, 0) + block.size
+        self.assertEqual (stats ['orders'], orders)
+
+        # counters are unknown for loaded allocator
+        stream = io.BytesIO ()
+        alloc.ToStream (stream)
+        stream.seek (0)
+        self.assertEqual (StoreAllocator.FromStream (stream).Stats () ['orders'], None)
+
+        for block in blocks:
+            alloc.Free (block)
+        stats = alloc.Stats ()
+        self.assertEqual ((stats ['allocated'], stats ['end'], stats ['fragmentation'], stats ['orders']),
+                          (0, 0, 0.0, {}))
+
+#------------------------------------------------------------------------------#
+# Benchmark                                                                    #
+#------------------------------------------------------------------------------#
+def Benchmark (count = None, ops = None):
+    """Allocation and free rates of the allocator with count free blocks
+
+    Run with ``python -m <package>.tests.alloc``
+    """
+    count = count or 1 << 20
+    ops = ops or 1 << 16
+    order = 4
+
+    # every other block of the order is free, the rest of the space is free
+    stride = 1 << (order + 1)
+    blocks = [StoreBlock (order, offset) for offset in range (0, count * stride, stride)]
+    end = count * stride
+    while end < 1 << StoreAllocator.max_order:
+        blocks.append (StoreBlock (end.bit_length () - 1, end))
+        end <<= 1
+    stream = Serializer (io.BytesIO ())
+    stream.StructListWrite ([block.ToDesc () for block in blocks], StoreAllocator.desc_struct)
+    stream.Stream.seek (0)
+
+    start = time.time ()
+    alloc = StoreAllocator.FromStream (stream.Stream)
+    print ('load:  {:.3f}s ({} free blocks)'.format (time.time () - start, count))
+
+    start = time.time ()
+    allocated = [alloc.AllocByOrder (order) for _ in range (ops)]
+    print ('alloc: {:.0f} ops/s'.format (ops / (time.time () - start)))
+
+    start = time.time ()
+    for block in allocated:
+        alloc.Free (block)
+    print ('free:  {:.0f} ops/s'.format (ops / (time.time () - start)))
+
+    orders = [random.randint (0, 16) for _ in range (ops)]
+    start = time.time ()
+    for order in orders:
+        alloc.Free (alloc.AllocByOrder (order))
+    print ('mixed: {:.0f} ops/s'.format (2 * ops / (time.time () - start)))
+
+if __name__ == '__main__':
+    Benchmark ()
 
 # vim: nu ft=python columns=120 :
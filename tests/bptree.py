@@ -3,6 +3,7 @@ import io
 import random
 import unittest
 
+from ..codec import CodecGet
 from ..mapping.bptree import BPTree
 from ..mapping.provider.memory import MemoryBPTreeProvider
 from ..mapping.provider.store import StoreBPTreeProvider
@@ -90,6 +91,31 @@ class BPTreeTest (unittest.TestCase):
 
         return provider
 
+    def testRangePrefetch (self):
+        """Range loads limited number of sibling leafs together
+        """
+        provider = self.provider ()
+        tree = BPTree (provider)
+        for i in range (1 << 10):
+            tree [i] = str (i)
+
+        loads = []
+        descs_nodes = provider.DescsToNodes
+        def descs_nodes_record (descs):
+            nodes = descs_nodes (descs)
+            loads.append (nodes)
+            return nodes
+        provider.DescsToNodes = descs_nodes_record
+
+        self.assertEqual (list (tree [:]), [(key, str (key)) for key in range (1 << 10)])
+        self.assertTrue (loads)
+        self.assertTrue (max (len (nodes) for nodes in loads) <= tree.prefetch_leafs)
+
+        # leafs following high key are not loaded
+        del loads [:]
+        self.assertEqual (list (tree [100:105]), [(key, str (key)) for key in range (100, 106)])
+        self.assertTrue (all (node.keys [0] <= 105 for nodes in loads for node in nodes))
+
     def provider (self, provider = None):
         """Memory B+Tree provider
         """
@@ -120,4 +146,28 @@ class StoreBPTreeTest (BPTreeTest):
         provider.Drop ()
         self.assertEqual (provider.Store.Size, 0)
 
+    def testCodec (self):
+        """Compression codecs
+        """
+        items = [(index, 'value:{}'.format (index * 7)) for index in range (1 << 10)]
+        sizes = {}
+        for compress in (0, 9, 'zlib:1', 'zlib+dict:1', 'lzma', 'bz2'):
+            try:
+                CodecGet (compress)
+            except ValueError:
+                continue # codec is not available
+            stream = io.BytesIO ()
+            with StreamStore (stream) as store:
+                with store.Mapping ('mapping', order = 16, compress = compress) as mapping:
+                    mapping.update (items)
+            with StreamStore (stream) as store:
+                mapping = store.Mapping ('mapping')
+                self.assertEqual (list (mapping.items ()), items)
+                sizes [compress] = mapping.SizeOnStore
+                mapping.Drop ()
+                self.assertEqual (store.Size, 0)
+        self.assertTrue (sizes ['zlib:1'] < sizes [0])
+        if 'zlib+dict:1' in sizes:
+            self.assertTrue (sizes ['zlib+dict:1'] < sizes ['zlib:1'])
+
 # vim: nu ft=python columns=120 :
\ No newline at end of file
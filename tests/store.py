@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 import io
+import os
 import random
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
 
-from ..store import StreamStore
+from ..store import (StreamStore, FileStore, StripedStore, MmapFileStore, MemoryStore, StoreFollower,
+                     StoreInstrument)
+from ..store.alloc import StoreBlock
+from ..serialize import Serializer
 
 #------------------------------------------------------------------------------#
 # Store Test                                                                   #
@@ -12,6 +20,12 @@ class StoreTest (unittest.TestCase):
     """Store unit tests
     """
 
+    def setUp (self):
+        self.path = tempfile.mkdtemp () # directory of file based stores
+
+    def tearDown (self):
+        shutil.rmtree (self.path)
+
     def testSimple (self):
         """Simple tests
         """
@@ -74,4 +88,825 @@ class StoreTest (unittest.TestCase):
             for data, desc in zip (datas, descs):
                 self.assertEqual (data, store.Load (desc))
 
+    def testLoadMany (self):
+        """Load many tests
+        """
+        with StreamStore (io.BytesIO ()) as store:
+            datas = [str (i).encode () * random.randint (1, 1 << 8) for i in range (1 << 10)]
+            descs = [store.Save (data) for data in datas]
+            for index in range (0, len (descs), 3):
+                store.Delete (descs [index])
+                datas [index], descs [index] = b'', 0
+
+            order = list (range (len (descs)))
+            random.shuffle (order)
+            self.assertEqual ([bytes (data) for data in store.LoadMany ([descs [index] for index in order])],
+                              [datas [index] for index in order])
+
+            # single and coalesced blocks are loaded as the same type
+            self.assertEqual (set (type (data) for data in store.LoadMany (descs [1:])), set ((bytes,)))
+
+    def testBatch (self):
+        """Batch tests
+        """
+        stream = io.BytesIO ()
+        with StreamStore (stream) as store:
+            datas, descs = [], []
+            with store.Batch ():
+                for index in range (1 << 10):
+                    data = str (index).encode () * random.randint (1, 1 << 6)
+                    if index % 3:
+                        data = [data [:index % 7], data [index % 7:]]
+                    datas.append (b''.join (data) if isinstance (data, list) else data)
+                    descs.append (store.Save (data))
+
+                # overlapping writes, freed block is reused with different order
+                desc = store.Save (b'a' * 1024)
+                store.Delete (desc)
+                desc_small = store.Save (b'b' * 16)
+                store.Delete (desc_small)
+                desc = store.Save (b'c' * 1024)
+
+                # load inside batch
+                self.assertEqual (store.Load (descs [-1]), datas [-1])
+
+            self.assertEqual (store.Load (desc), b'c' * 1024)
+            for data, desc in zip (datas, descs):
+                self.assertEqual (store.Load (desc), data)
+
+        with StreamStore (stream) as store:
+            for data, desc in zip (datas, descs):
+                self.assertEqual (store.Load (desc), data)
+
+        # freed pair of blocks is reused by a larger block, which overlaps the
+        # second block while starting at a different offset
+        with StreamStore (io.BytesIO ()) as store:
+            with store.Batch ():
+                desc_x, desc_y = store.Save (b'x' * 60), store.Save (b'y' * 60)
+                store.Delete (desc_x)
+                store.Delete (desc_y)
+                desc = store.Save (b'z' * 120)
+                self.assertNotEqual (StoreBlock.FromDesc (desc).offset, StoreBlock.FromDesc (desc_y).offset)
+            self.assertEqual (store.Load (desc), b'z' * 120)
+
+    def testCache (self):
+        """Page cache tests
+        """
+        stream = io.BytesIO ()
+        datas = [str (i).encode () * random.randint (1, 1 << 10) for i in range (1 << 10)]
+        with StreamStore (stream, 1, cache_size = 1 << 14) as store:
+            descs = [store.Save (data) for data in datas]
+            for data, desc in zip (datas, descs):
+                self.assertEqual (store.Load (desc), data)
+            for data, desc in zip (datas, descs):
+                self.assertEqual (store.Load (desc), data)
+            self.assertTrue (store.cache.hits > 0)
+            self.assertTrue (store.cache.evictions > 0)
+            self.assertTrue (store.cache.Size <= 1 << 14)
+
+        # coalesced loads across partially filled pages
+        with StreamStore (io.BytesIO (), cache_size = 1 << 20) as store:
+            blobs = [os.urandom (random.randint (1, 3000)) for _ in range (300)]
+            blob_descs = [store.Save (blob) for blob in blobs]
+            self.assertEqual ([bytes (blob) for blob in store.LoadMany (blob_descs)], blobs)
+
+        # reload without cache
+        with StreamStore (stream, 1) as store:
+            for data, desc in zip (datas, descs):
+                self.assertEqual (store.Load (desc), data)
+
+    def testWAL (self):
+        """Write-ahead log tests
+        """
+        path_store = os.path.join (self.path, 'store')
+        path_wal = path_store + FileStore.wal_suffix
+
+        store = FileStore (path_store, 'n', wal = True)
+        mapping = store.Mapping ('mapping')
+        for i in range (1 << 10):
+            mapping [i] = str (i)
+        mapping.Flush ()
+        store.Flush ()
+        self.assertTrue (store.wal.Size > 0)
+        self.assertTrue (os.path.getsize (path_wal) > 0)
+
+        # uncommitted changes
+        for i in range (1 << 10):
+            mapping [i] = str (-i)
+        mapping.Flush ()
+
+        # committed data is visible to readers before checkpoint
+        with FileStore (path_store, 'r') as reader:
+            self.assertEqual (list (reader.Mapping ('mapping').items ()),
+                              [(i, str (i)) for i in range (1 << 10)])
+
+        # crash (store is never disposed), torn frame at the end of the log
+        with open (path_wal, 'ab') as wal:
+            wal.write (FileStore.wal_suffix.encode () * 16)
+        with FileStore (path_store, 'w') as recovered:
+            self.assertEqual (list (recovered.Mapping ('mapping').items ()),
+                              [(i, str (i)) for i in range (1 << 10)])
+        self.assertFalse (os.path.exists (path_wal))
+        store.stream.close ()
+
+        # checkpoint
+        with FileStore (path_store, 'w', wal = True) as store:
+            store.wal_checkpoint = 0
+            mapping = store.Mapping ('mapping')
+            mapping [0] = 'zero'
+            mapping.Flush ()
+            store.Flush ()
+            self.assertEqual (store.wal.Size, 0)
+        with FileStore (path_store) as store:
+            self.assertEqual (store.Mapping ('mapping') [0], 'zero')
+
+    def testSnapshot (self):
+        """Copy-on-write snapshot tests
+        """
+        stream = io.BytesIO ()
+        with StreamStore (stream, cow = True) as store:
+            mapping = store.Mapping ('mapping')
+            for i in range (1 << 10):
+                mapping [i] = str (i)
+            mapping.Flush ()
+            store.Flush ()
+
+            with store.Snapshot () as snapshot:
+                # uncommitted and committed changes are not visible
+                for i in range (1 << 10):
+                    mapping [i] = str (-i)
+                mapping.Flush ()
+                for i in range (1 << 9):
+                    mapping.pop (i)
+                mapping.Flush ()
+                store.Flush ()
+
+                snapshot_mapping = snapshot.Mapping ('mapping')
+                self.assertEqual (list (snapshot_mapping.items ()), [(i, str (i)) for i in range (1 << 10)])
+                with self.assertRaises (ValueError):
+                    snapshot.Save (b'data')
+
+            # freed blocks are released and reused
+            store.Flush ()
+            size = store.alloc.Size
+            for _ in range (8):
+                for i in range (1 << 9, 1 << 10):
+                    mapping [i] = str (i)
+                mapping.Flush ()
+                store.Flush ()
+            self.assertTrue (store.alloc.Size <= size * 2)
+
+        with StreamStore (stream) as store:
+            self.assertEqual (list (store.Mapping ('mapping').items ()),
+                              [(i, str (i)) for i in range (1 << 9, 1 << 10)])
+
+        # not released blocks are freed on load
+        stream = io.BytesIO ()
+        with StreamStore (stream, cow = True) as store:
+            for i in range (8):
+                store [b'name'] = str (i).encode () * (1 << i)
+                store.Flush ()
+        with StreamStore (stream) as store:
+            self.assertEqual (store [b'name'], b'7' * (1 << 7))
+            del store [b'name']
+        self.assertEqual (StreamStore (stream).alloc.Size, 0)
+
+    def testCompact (self):
+        """Compaction tests
+        """
+        stream = io.BytesIO ()
+        with StreamStore (stream) as store:
+            mapping = store.Mapping ('mapping')
+            data = store.Stream ('stream', buffer_size = 1 << 10)
+            descs = [store.Save (str (i).encode () * 64) for i in range (1 << 12)]
+            for i in range (1 << 12):
+                mapping [i] = str (i)
+            data.Write (b'data' * (1 << 12))
+            store [b'name'] = b'value'
+            mapping.Flush ()
+            data.Flush ()
+            store.Flush ()
+
+            for desc in descs:
+                store.Delete (desc)
+            for i in range (0, 1 << 12, 2):
+                mapping.pop (i)
+            mapping.Flush ()
+            store.Flush ()
+
+            def end ():
+                descs = list (store.names.values ()) + [desc for desc in data.chunks if desc]
+                descs.extend (node.desc for node in mapping.provider)
+                return max (StoreBlock.FromDesc (desc).offset + StoreBlock.FromDesc (desc).size
+                    for desc in descs)
+            end_before = end ()
+
+            steps = 1
+            while not store.Compact (budget = 0):
+                steps += 1
+            self.assertTrue (steps > 1)
+            self.assertTrue (end () < end_before / 4)
+
+            self.assertEqual (list (mapping.items ()), [(i, str (i)) for i in range (1, 1 << 12, 2)])
+            self.assertEqual (data.Seek (0), 0)
+            self.assertEqual (data.Read (), b'data' * (1 << 12))
+            self.assertEqual (store [b'name'], b'value')
+
+        with StreamStore (stream) as store:
+            self.assertEqual (list (store.Mapping ('mapping').items ()),
+                              [(i, str (i)) for i in range (1, 1 << 12, 2)])
+            self.assertEqual (store.Stream ('stream').Read (), b'data' * (1 << 12))
+            self.assertEqual (store [b'name'], b'value')
+
+        # disposed mappings and streams are not relocated
+        with StreamStore (io.BytesIO ()) as store:
+            for _ in range (3):
+                with store.Mapping ('mapping') as mapping:
+                    descs = [store.Save (b'x' * 64) for _ in range (1 << 8)]
+                    mapping.update ((i, str (i) * 8) for i in range (1 << 8))
+                with store.Stream ('stream') as data:
+                    data.Write (b'data' * (1 << 8))
+                for desc in descs:
+                    store.Delete (desc)
+                store.Flush ()
+                self.assertNotIn (mapping.provider.relocate, store.relocators)
+                self.assertNotIn (data.relocate, store.relocators)
+                while not store.Compact (budget = 0):
+                    pass
+            self.assertEqual (list (store.Mapping ('mapping').items ()), [(i, str (i) * 8) for i in range (1 << 8)])
+            self.assertEqual (store.Stream ('stream').Read (), b'data' * (1 << 8))
+
+    def testTrim (self):
+        """File trim and preallocation tests
+        """
+        path_store = os.path.join (self.path, 'store')
+        with FileStore (path_store, 'n') as store:
+            store [b'small'] = b'small'
+            desc = store.Save (b'large' * (1 << 16))
+            store.Flush ()
+            self.assertTrue (os.path.getsize (path_store) > 1 << 18)
+            store.Delete (desc)
+            store.Flush ()
+            self.assertTrue (os.path.getsize (path_store) < 1 << 12)
+        self.assertTrue (os.path.getsize (path_store) < 1 << 12)
+
+        extent = 1 << 20
+        with FileStore (path_store, 'w', extent = extent) as store:
+            store.Flush ()
+            self.assertEqual (os.path.getsize (path_store), extent)
+            desc = store.Save (b'\x00' * (1 << 19))
+            store.Flush ()
+            self.assertEqual (os.path.getsize (path_store), 2 * extent)
+            store.Delete (desc)
+            store.Flush ()
+            self.assertEqual (os.path.getsize (path_store), extent)
+
+        with FileStore (path_store, 'w', wal = True) as store:
+            self.assertEqual (store [b'small'], b'small')
+            store.Save (b'large' * (1 << 16))
+        self.assertTrue (os.path.getsize (path_store) > 1 << 18)
+
+    def testNames (self):
+        """Names directory tests
+        """
+        stream = io.BytesIO ()
+        names = dict ((str (i).encode (), str (i).encode () * 8) for i in range (1 << 12))
+        with StreamStore (stream) as store:
+            for name, data in names.items ():
+                store [name] = data
+
+        with StreamStore (stream) as store:
+            for name, data in names.items ():
+                self.assertEqual (store [name], data)
+
+            # clean names are not saved
+            writes = []
+            store.SaveByOffset = lambda offset, data: writes.append (offset)
+            store.SaveByOffsetVector = lambda offset, datas: writes.append (offset)
+            store.Flush ()
+            self.assertTrue (len (writes) <= 2)
+            del store.SaveByOffset, store.SaveByOffsetVector
+
+        # legacy flat names table
+        stream = io.BytesIO ()
+        store = StreamStore (stream)
+        descs = dict ((name, store.Save (data)) for name, data in names.items ())
+        serializer = Serializer (io.BytesIO ())
+        serializer.BytesListWrite (tuple (descs.keys ()))
+        serializer.StructListWrite (tuple (descs.values ()), store.desc_struct)
+        names_desc = store.Save (serializer.Stream.getvalue ())
+        store.Flush ()
+        store.SaveByOffset (0, store.header_struct.pack (store.alloc_desc, names_desc))
+
+        with StreamStore (stream) as store:
+            for name, data in names.items ():
+                self.assertEqual (store [name], data)
+            store [b'name'] = b'value'
+        with StreamStore (stream) as store:
+            self.assertTrue (bytes (store.Load (store.names_desc)).startswith (store.names_magic))
+            for name, data in names.items ():
+                self.assertEqual (store [name], data)
+            self.assertEqual (store [b'name'], b'value')
+
+    def testAllocPages (self):
+        """Incremental allocator persistence tests
+        """
+        stream = io.BytesIO ()
+        with StreamStore (stream) as store:
+            datas = [b'data' * random.randint (1, 1 << 12) for _ in range (1 << 12)]
+            descs = [store.Save (data) for data in datas]
+            for desc in descs [::2]:
+                store.Delete (desc)
+            store.Flush ()
+            self.assertTrue (len (store.alloc_pages) > 1)
+
+            # only dirty regions are saved
+            writes = []
+            save_by_offset = store.SaveByOffset
+            store.SaveByOffset = lambda offset, data: writes.append (offset) or save_by_offset (offset, data)
+            store.Delete (descs [1])
+            store.Flush ()
+            self.assertTrue (len (writes) <= 4)
+            del store.SaveByOffset
+            blocks = list (store.alloc.blocks)
+
+        with StreamStore (stream) as store:
+            self.assertEqual (store.allocator, None)
+            self.assertEqual (store.Load (descs [3]), datas [3])
+            self.assertEqual (store.allocator, None)
+            self.assertEqual (store.alloc.blocks, blocks)
+
+        # legacy allocator state
+        stream = io.BytesIO ()
+        store = StreamStore (stream)
+        desc = store.Save (b'data')
+        store.Flush ()
+        for page_desc in store.alloc_pages.values ():
+            store.Delete (page_desc)
+        store.Delete (store.alloc_desc)
+        alloc_desc = 0
+        while True:
+            alloc_desc, alloc_desc_prev = store.Save (store.alloc.ToStream (io.BytesIO ()).getvalue (),
+                                                      alloc_desc), alloc_desc
+            if alloc_desc == alloc_desc_prev:
+                break
+        store.SaveByOffset (0, store.header_struct.pack (alloc_desc, store.names_desc))
+        blocks = list (store.alloc.blocks)
+
+        with StreamStore (stream) as store:
+            self.assertEqual (store.alloc.blocks, blocks)
+            self.assertEqual (store.Load (desc), b'data')
+        with StreamStore (stream) as store:
+            self.assertTrue (bytes (store.Load (store.alloc_desc)).startswith (store.alloc_magic))
+            store.Delete (desc)
+        self.assertEqual (StreamStore (stream).alloc.Size, 0)
+
+    def testRealloc (self):
+        """In place resize tests
+        """
+        store = StreamStore (io.BytesIO ())
+        desc = store.Save (b'1' * 100)
+        desc_grown = store.Save (b'2' * 1000, desc)
+        self.assertEqual (StoreBlock.FromDesc (desc_grown).offset, StoreBlock.FromDesc (desc).offset)
+        self.assertEqual (store.Load (desc_grown), b'2' * 1000)
+
+        desc_shrunk = store.Save (b'3' * 10, desc_grown)
+        self.assertEqual (StoreBlock.FromDesc (desc_shrunk).offset, StoreBlock.FromDesc (desc).offset)
+        self.assertEqual (store.Load (desc_shrunk), b'3' * 10)
+        self.assertEqual (store.Size, 16)
+
+        # neighbour is not free
+        desc_other = store.Save (b'4' * 16)
+        self.assertNotEqual (StoreBlock.FromDesc (store.Save (b'5' * 100, desc_shrunk)).offset,
+                             StoreBlock.FromDesc (desc).offset)
+        self.assertEqual (store.Load (desc_other), b'4' * 16)
+
+    def testSizeClasses (self):
+        """Size classes allocator mode tests
+        """
+        datas = [b'data' * random.randint (1 << 8, 1 << 12) for _ in range (1 << 10)]
+        sizes = []
+        for size_classes in (False, True):
+            stream = io.BytesIO ()
+            with StreamStore (stream, size_classes = size_classes) as store:
+                descs = [store.Save (data) for data in datas]
+            sizes.append (len (stream.getvalue ()))
+
+            # mode is persisted
+            with StreamStore (stream) as store:
+                for data, desc in zip (datas, descs):
+                    self.assertEqual (store.Load (desc), data)
+                self.assertEqual (store.alloc.size_classes, size_classes)
+                for desc in descs:
+                    store.Delete (desc)
+            self.assertEqual (StreamStore (stream).alloc.Size, 0)
+        self.assertTrue (sizes [1] < sizes [0])
+
+    def testStats (self):
+        """Space accounting tests
+        """
+        def check (store, stream):
+            stats = store.Stats ()
+            self.assertEqual (stats ['allocated'], store.alloc.Size)
+            self.assertEqual (stats ['requested'], sum (StoreBlock.FromDesc (desc).used
+                for desc in store.alloc_pages.values ()) + sum (StoreBlock.FromDesc (desc).used
+                for desc in descs + [store.alloc_desc, store.names_desc] if desc) +
+                sum (StoreBlock.FromDesc (node.desc).used for node in store.names.provider) +
+                sum (StoreBlock.FromDesc (node.desc).used for node in mapping.provider) +
+                sum (StoreBlock.FromDesc (desc).used for desc in stream.chunks if desc) +
+                sum (len (store.LoadByName (name)) for name in store.names))
+            self.assertEqual (mapping.SizeOnStore, sum (StoreBlock.FromDesc (node.desc).size
+                for node in mapping.provider))
+            self.assertEqual (stream.SizeOnStore, sum (StoreBlock.FromDesc (desc).size
+                for desc in stream.chunks if desc))
+            self.assertEqual (store.Size, sum (StoreBlock.FromDesc (desc).size for desc in descs) +
+                mapping.SizeOnStore + stream.SizeOnStore)
+
+        store_stream = io.BytesIO ()
+        with StreamStore (store_stream) as store:
+            mapping = store.Mapping ('mapping', order = 8)
+            stream = store.Stream ('stream', buffer_size = 1 << 10)
+            descs = [store.Save (b'data' * random.randint (1, 1 << 10)) for _ in range (1 << 8)]
+            for index in range (1 << 8):
+                mapping [index] = index
+                store [str (index).encode ()] = b'name' * random.randint (1, 1 << 8)
+                stream.Write (b'stream' * random.randint (1, 1 << 6))
+            mapping.Flush ()
+            stream.Flush ()
+            store.Flush ()
+            check (store, stream)
+
+            # counters are persisted
+            stream.Dispose ()
+            mapping.Dispose ()
+
+        with StreamStore (store_stream) as store:
+            mapping = store.Mapping ('mapping')
+            stream = store.Stream ('stream')
+            for index in range (1 << 7):
+                del mapping [index]
+                del store [str (index).encode ()]
+                store.Delete (descs.pop ())
+            stream.Truncate (1 << 10)
+            mapping.Flush ()
+            stream.Flush ()
+            store.Flush ()
+            check (store, stream)
+
+    def testSlab (self):
+        """Slab packing tests
+        """
+        sizes = []
+        for slab in (False, True):
+            datas = [b'x' * size for size in range (1, 1 << 8)] * 8
+            stream = io.BytesIO ()
+            with StreamStore (stream, slab = slab) as store:
+                descs = [store.Save (data) for data in datas]
+                self.assertEqual ([bytes (data) for data in store.LoadMany (descs)], datas)
+                sizes.append (store.alloc.Size)
+
+                # update in place or move to another slot
+                for index in range (0, len (datas), 4):
+                    datas [index] = b'y' * random.randint (1, 1 << 9)
+                    descs [index] = store.Save (datas [index], descs [index])
+                store [b'name'] = b'small'
+
+            with StreamStore (stream) as store:
+                self.assertEqual ([bytes (store.Load (desc)) for desc in descs], datas)
+                self.assertEqual (store [b'name'], b'small')
+                for index in range (0, len (datas), 2):
+                    store.Delete (descs [index])
+            with StreamStore (stream) as store:
+                for index in range (1, len (datas), 2):
+                    self.assertEqual (store.Load (descs [index]), datas [index])
+                    store.Delete (descs [index])
+                del store [b'name']
+            stats = StreamStore (stream).Stats ()
+            self.assertEqual ((stats ['allocated'], stats ['slab_pages']), (0, 0))
+        self.assertTrue (sizes [1] < sizes [0] * 0.95)
+
+        with self.assertRaises (ValueError):
+            StreamStore (io.BytesIO (), cow = True, slab = True)
+
+    def testDedup (self):
+        """Deduplication tests
+        """
+        datas = [str (index).encode () * (1 << 10) for index in range (1 << 4)]
+        stream = io.BytesIO ()
+        with StreamStore (stream, dedup = True) as store:
+            descs = [store.Save (datas [index % len (datas)]) for index in range (1 << 8)]
+            self.assertEqual (len (set (descs)), len (datas))
+            small = [store.Save (b'small'), store.Save (b'small')]
+            self.assertNotEqual (small [0], small [1])
+
+            # update of deduplicated data does not change other references
+            desc = store.Save (b'other' * (1 << 10), descs [0])
+            self.assertEqual (store.Load (descs [len (datas)]), datas [0])
+            descs [0] = desc
+            self.assertEqual (store.Save (b'other' * (1 << 10), desc), desc)
+
+            # shared block is not overwritten by data which is not deduplicated
+            descs [1] = store.Save (b'small', descs [1])
+            self.assertEqual (store.Load (descs [len (datas) + 1]), datas [1])
+
+            with store.Stream ('stream', buffer_size = 1 << 12, compress = 0) as stream_store:
+                for _ in range (1 << 4):
+                    stream_store.Write (b'chunk...' * (1 << 12))
+            chunks = stream_store.chunks
+            self.assertEqual (len (set (chunks)), 1)
+            size = store.alloc.Size
+        self.assertTrue (size < 1 << 17)
+
+        # references are counted even if dedup is not set
+        with StreamStore (stream) as store:
+            descs [2] = store.Save (b'other' * (1 << 10), descs [2])
+            self.assertEqual (store.Load (descs [len (datas) + 2]), datas [2])
+            for desc in descs [:len (datas)]:
+                store.Delete (desc)
+            for index, desc in enumerate (descs [len (datas):]):
+                self.assertEqual (store.Load (desc), datas [index % len (datas)])
+            for desc in descs [len (datas):] + small:
+                store.Delete (desc)
+            for desc in chunks:
+                store.Delete (desc)
+            del store [b'.stream:stream']
+        self.assertEqual (StreamStore (stream).alloc.Size, 0)
+
+    def testInstrument (self):
+        """Instrumentation tests
+        """
+        store = StreamStore (io.BytesIO ())
+        instrument = store.Instrument (StoreInstrument ())
+        ops = []
+        instrument.Hook (lambda op, arg, size, elapsed: ops.append ((op, arg, size)))
+
+        desc = store.Save (b'data')
+        self.assertEqual (store.Load (desc), b'data')
+        with instrument.Scope ('scope'):
+            store.Save (b'scope' * 10)
+        store.Delete (desc)
+
+        stats = instrument.Stats ()
+        self.assertEqual ((stats ['Save']['count'], stats ['Save']['bytes']), (2, 54))
+        self.assertEqual ((stats ['Load']['count'], stats ['Load']['bytes']), (1, 4))
+        self.assertEqual ((stats ['Delete']['count'], stats ['Delete']['bytes']), (1, 4))
+        self.assertEqual (sum (count for _, count in stats ['Save']['histogram']), 2)
+        self.assertEqual ((stats ['SaveByOffset']['count'], stats ['seeks']), (2, 3))
+        self.assertEqual (stats ['scopes'], {'scope': {'Save': {'count': 1, 'bytes': 50},
+            'SaveByOffset': {'count': 1, 'bytes': 50}}})
+        self.assertEqual (ops [:2], [('SaveByOffset', store.offset, 4), ('Save', desc, 4)])
+
+        store.Flush ()
+        self.assertEqual (instrument.Stats () ['Flush']['count'], 1)
+
+        # detached instrument is not called any more
+        store.Instrument ()
+        count = len (ops)
+        store.Load (desc)
+        self.assertEqual (len (ops), count)
+        self.assertFalse ('Load' in store.__dict__)
+
+    def testReadOnly (self):
+        """Read-only store tests
+        """
+        path_store = os.path.join (self.path, 'store')
+        with FileStore (path_store, 'n') as store:
+            desc = store.Save (b'data')
+            for index in range (1 << 8):
+                store [str (index).encode ()] = str (index).encode () * 8
+
+        with FileStore (path_store, 'r') as store:
+            loads = []
+            store.Instrument (StoreInstrument ()).Hook (lambda op, arg, size, elapsed: loads.append (op))
+
+            # nothing but header is loaded until names are accessed
+            self.assertEqual (store.names_mapping, None)
+            self.assertEqual (store.Load (desc), b'data')
+            self.assertEqual (store [b'7'], b'7' * 8)
+            self.assertEqual (store.allocator, None)
+            self.assertEqual (loads.count ('Load'), 5) # data, names header, root and leaf, value
+
+            self.assertRaises (ValueError, store.Save, b'data')
+            self.assertRaises (ValueError, store.Delete, desc)
+            self.assertEqual (len (store.names), 1 << 8)
+
+    def testDelta (self):
+        """Changes tracking and delta tests
+        """
+        path_store, path_copy = os.path.join (self.path, 'store'), os.path.join (self.path, 'copy')
+        datas = [str (i).encode () * random.randint (1, 1 << 12) for i in range (1 << 10)]
+
+        with FileStore (path_store, 'n') as store:
+            descs = [store.Save (data) for data in datas]
+            with store.Mapping ('mapping') as mapping:
+                for i in range (1 << 10):
+                    mapping [i] = str (i)
+            store.Checkpoint (b'backup')
+        shutil.copyfile (path_store, path_copy)
+
+        # tracking state is persisted
+        with FileStore (path_store, 'w') as store:
+            self.assertEqual (store.Checkpoints (), [b'backup'])
+            for index in range (0, len (datas), 100):
+                datas [index] = b'changed' * (index + 1)
+                descs [index] = store.Save (datas [index], descs [index])
+            store [b'name'] = b'value'
+
+        with FileStore (path_store, 'w') as store:
+            with store.Mapping ('mapping') as mapping:
+                mapping [7] = 'seven'
+            delta = io.BytesIO ()
+            self.assertTrue (store.Delta (b'backup', delta) < os.path.getsize (path_store) / 4)
+            self.assertRaises (ValueError, store.Delta, b'unknown', io.BytesIO ())
+
+        # incomplete delta is not applied
+        with open (path_copy, 'r+b') as stream:
+            self.assertRaises (ValueError, FileStore.DeltaApply, io.BytesIO (delta.getvalue () [:-1]), stream)
+            self.assertTrue (FileStore.DeltaApply (io.BytesIO (delta.getvalue ()), stream) > 0)
+
+        with FileStore (path_copy, 'r') as store:
+            for data, desc in zip (datas, descs):
+                self.assertEqual (store.Load (desc), data)
+            self.assertEqual (store [b'name'], b'value')
+            self.assertEqual (store.Mapping ('mapping') [7], 'seven')
+
+        # checkpoint is restarted by delta
+        with FileStore (path_store, 'w') as store:
+            store [b'name'] = b'other value'
+            delta = io.BytesIO ()
+            store.Delta (b'backup', delta)
+            store.CheckpointDrop (b'backup')
+            self.assertEqual (store.Checkpoints (), [])
+        with open (path_copy, 'r+b') as stream:
+            FileStore.DeltaApply (io.BytesIO (delta.getvalue ()), stream)
+        with FileStore (path_copy, 'r') as store:
+            self.assertEqual (store [b'name'], b'other value')
+            self.assertEqual (store.Mapping ('mapping') [7], 'seven')
+
+    def testReplicate (self):
+        """Replication tests
+        """
+        path_store, path_follower, path_log = (os.path.join (self.path, name) for name in ('store', 'follower', 'log'))
+        datas = [str (i).encode () * random.randint (1, 1 << 12) for i in range (1 << 9)]
+
+        with io.open (path_log, 'w+b') as log, FileStore (path_store, 'n') as store, \
+             StoreFollower (path_follower) as follower:
+            descs = [store.Save (data) for data in datas]
+            with store.Mapping ('mapping') as mapping:
+                for i in range (1 << 10):
+                    mapping [i] = str (i)
+            store.Replicate (log, True)
+            with io.open (path_log, 'rb') as log_reader:
+                self.assertEqual (follower.Follow (log_reader), 1)
+
+            with follower.Reader () as replica:
+                for data, desc in zip (datas, descs):
+                    self.assertEqual (replica.Load (desc), data)
+                self.assertEqual (replica.Mapping ('mapping') [7], '7')
+                self.assertRaises (ValueError, replica.Save, b'data')
+
+            # commit is applied only when it is completely received
+            log_offset = log.tell ()
+            with store.Mapping ('mapping') as mapping:
+                mapping [7] = 'seven'
+            store [b'name'] = b'value'
+            store.Flush ()
+            store.Flush () # nothing is shipped
+            log.seek (log_offset)
+            frame = log.read ()
+            self.assertEqual (follower.Apply (frame [:-1]), 0)
+            with follower.Reader () as replica:
+                self.assertEqual (replica.Mapping ('mapping') [7], '7')
+            self.assertEqual (follower.Apply (frame [-1:]), 1)
+            with follower.Reader () as replica:
+                self.assertEqual (replica.Mapping ('mapping') [7], 'seven')
+                self.assertEqual (replica [b'name'], b'value')
+            self.assertEqual (follower.Commits, 2)
+
+            self.assertRaises (ValueError, follower.Apply, b'\x00' * 32)
+            store.Replicate (None)
+
+    def testMmap (self):
+        """Memory mapped file store tests
+        """
+        path_store = os.path.join (self.path, 'store')
+        datas = [str (i).encode () * random.randint (1, 1 << 12) for i in range (1 << 10)]
+
+        with MmapFileStore (path_store, 'n') as store:
+            descs = [store.Save (data) for data in datas]
+            store [b'name'] = b'value'
+            with store.Mapping ('mapping') as mapping:
+                for i in range (1 << 10):
+                    mapping [i] = str (i)
+
+        # compatible with file store
+        with FileStore (path_store, 'r') as store:
+            for data, desc in zip (datas, descs):
+                self.assertEqual (store.Load (desc), data)
+
+        with MmapFileStore (path_store, 'r') as store:
+            if sys.version_info [0] > 2:
+                self.assertTrue (isinstance (store.Load (descs [0]), memoryview))
+            for data, desc in zip (datas, descs):
+                self.assertEqual (store.Load (desc), data)
+            self.assertEqual (store [b'name'], b'value')
+            mapping = store.Mapping ('mapping')
+            self.assertEqual (list (mapping.items ()), [(i, str (i)) for i in range (1 << 10)])
+
+    def testMemory (self):
+        """Memory store tests
+        """
+        path_store = os.path.join (self.path, 'store')
+        datas = [str (i).encode () * random.randint (1, 1 << 12) for i in range (1 << 10)]
+
+        store = MemoryStore (chunk_order = 14)
+        descs = [store.Save (data) for data in datas]
+        store [b'name'] = b'value'
+        if sys.version_info [0] > 2:
+            self.assertTrue (isinstance (store.Load (descs [0]), memoryview))
+        self.assertEqual ([bytes (data) for data in store.LoadMany (descs)], datas)
+        with store.Mapping ('mapping') as mapping:
+            for i in range (1 << 10):
+                mapping [i] = str (i)
+        store.Dump (path_store)
+
+        # compatible with file store
+        with FileStore (path_store, 'r') as store:
+            for data, desc in zip (datas, descs):
+                self.assertEqual (store.Load (desc), data)
+
+        store = MemoryStore (path_store, chunk_order = 12)
+        for data, desc in zip (datas, descs):
+            self.assertEqual (store.Load (desc), data)
+        self.assertEqual (store [b'name'], b'value')
+        mapping = store.Mapping ('mapping')
+        self.assertEqual (list (mapping.items ()), [(i, str (i)) for i in range (1 << 10)])
+
+    def testStriped (self):
+        """Striped store tests
+        """
+        paths = [os.path.join (self.path, 'store{}'.format (index)) for index in range (3)]
+        datas = [str (i).encode () * random.randint (1, 1 << 14) for i in range (1 << 9)]
+
+        with StripedStore (paths, 'n', stripe_order = 12) as store:
+            descs = [store.Save (data) for data in datas]
+            store [b'name'] = b'value'
+        sizes = [os.path.getsize (path_stripe) for path_stripe in paths]
+        self.assertTrue (all (sizes))
+
+        with StripedStore (paths, 'w', stripe_order = 12) as store:
+            self.assertEqual ([bytes (data) for data in store.LoadMany (descs)], datas)
+            self.assertEqual (store [b'name'], b'value')
+            for desc in descs [::2]:
+                store.Delete (desc)
+
+        with StripedStore (paths, 'r') as store:
+            self.assertEqual (store.stripe_order, 12)
+            for data, desc in list (zip (datas, descs)) [1::2]:
+                self.assertEqual (store.Load (desc), data)
+
+        # stripe order and number of files are validated
+        self.assertRaises (ValueError, StripedStore, paths, 'r', stripe_order = 13)
+        self.assertRaises (ValueError, StripedStore, paths [:2], 'r')
+
+    def testConcurrent (self):
+        """Concurrent readers tests
+        """
+        path_store = os.path.join (self.path, 'store')
+        count = 1 << 12
+        with FileStore (path_store, 'n') as store:
+            with store.Mapping ('mapping', order = 16) as mapping:
+                for i in range (count):
+                    mapping [i] = str (i)
+
+        errors = []
+        with FileStore (path_store, 'r') as store:
+            mapping = store.Mapping ('mapping', concurrent = True)
+            def reader (seed):
+                try:
+                    keys = list (range (count))
+                    random.Random (seed).shuffle (keys)
+                    for key in keys:
+                        if mapping [key] != str (key):
+                            errors.append (key)
+                except Exception as error:
+                    errors.append (error)
+            threads = [threading.Thread (target = reader, args = (seed,)) for seed in range (4)]
+            for thread in threads:
+                thread.start ()
+            for thread in threads:
+                thread.join ()
+        self.assertEqual (errors, [])
+
+        # range iterator remains valid if mapping is changed between steps
+        store = StreamStore (io.BytesIO ())
+        mapping = store.Mapping ('mapping', order = 4, concurrent = True)
+        mapping.update ((i, str (i)) for i in range (count))
+        keys = []
+        for key, value in mapping.items ():
+            keys.append (key)
+            del mapping [key]
+        self.assertEqual (keys, list (range (count)))
+        self.assertEqual (len (mapping), 0)
+
 # vim: nu ft=python columns=120 :
\ No newline at end of file
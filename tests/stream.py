@@ -2,6 +2,7 @@
 import io
 import unittest
 
+from ..codec import CodecGet
 from ..store import StreamStore
 
 class StoreStreamTest (unittest.TestCase):
@@ -42,4 +43,32 @@ class StoreStreamTest (unittest.TestCase):
             self.assertEqual (a.read (), b'stream a')
             self.assertEqual (b.read (), b'stream b')
 
+    def testCodec (self):
+        data = b''.join (str (index).encode () for index in range (1 << 12))
+        for compress in (0, 9, 'zlib:1', 'zlib+dict', 'lzma', 'bz2'):
+            try:
+                CodecGet (compress)
+            except ValueError:
+                continue # codec is not available
+            store = StreamStore (io.BytesIO ())
+            with store.Stream ('test', buffer_size = 1 << 10, compress = compress) as stream:
+                stream.write (data)
+            with store.Stream ('test') as stream:
+                self.assertEqual (stream.read (), data)
+
+    def testReader (self):
+        store = StreamStore (io.BytesIO ())
+        stream = store.Stream ('test', buffer_size = 8)
+        stream.write (b'0123456789abcdef0123')
+
+        readers = [stream.Reader () for _ in range (3)]
+        self.assertEqual (readers [0].read (), b'0123456789abcdef0123')
+        self.assertEqual (readers [1].seek (5), 5)
+        self.assertEqual (readers [1].read (6), b'56789a')
+        self.assertEqual (readers [2].seek (-4, 2), 16)
+        self.assertEqual (readers [1].read (), b'bcdef0123')
+        self.assertEqual (readers [2].read (), b'0123')
+        self.assertEqual (readers [2].tell (), 20)
+        self.assertEqual (stream.tell (), 20)
+
 # vim: nu ft=python columns=120 :